@@ -0,0 +1,32 @@
+"""add top links snapshots
+
+Revision ID: 2d6f8b1e4a93
+Revises: e7a3c95b1f08
+Create Date: 2026-10-18 23:12:05.418263
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2d6f8b1e4a93'
+down_revision: Union[str, None] = 'e7a3c95b1f08'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('top_links_snapshots',
+    sa.Column('worker_id', sa.String(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.Column('snapshot', sa.JSON(), nullable=False),
+    sa.PrimaryKeyConstraint('worker_id'),
+    prefixes=['UNLOGGED']
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('top_links_snapshots')
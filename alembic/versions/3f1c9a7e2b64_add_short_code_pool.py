@@ -0,0 +1,31 @@
+"""add short code pool and block sequence
+
+Revision ID: 3f1c9a7e2b64
+Revises: 1253f33bc62d
+Create Date: 2026-10-18 10:12:41.218034
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c9a7e2b64'
+down_revision: Union[str, None] = '1253f33bc62d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('short_code_pool',
+    sa.Column('code', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('code')
+    )
+    op.execute(sa.schema.CreateSequence(sa.Sequence('short_code_block_seq')))
+
+
+def downgrade() -> None:
+    op.execute(sa.schema.DropSequence(sa.Sequence('short_code_block_seq')))
+    op.drop_table('short_code_pool')
@@ -0,0 +1,33 @@
+"""add link click buckets
+
+Revision ID: 5b8e0f6c4d21
+Revises: 9c4e2d81a7f3
+Create Date: 2026-10-18 19:20:05.611870
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b8e0f6c4d21'
+down_revision: Union[str, None] = '9c4e2d81a7f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('link_click_buckets',
+    sa.Column('link_id', sa.Integer(), nullable=False),
+    sa.Column('granularity', sa.String(length=4), nullable=False),
+    sa.Column('bucket', sa.DateTime(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['link_id'], ['links.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('link_id', 'granularity', 'bucket')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('link_click_buckets')
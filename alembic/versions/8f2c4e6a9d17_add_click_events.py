@@ -0,0 +1,43 @@
+"""add click events
+
+Revision ID: 8f2c4e6a9d17
+Revises: 2d6f8b1e4a93
+Create Date: 2026-10-19 00:41:52.706114
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f2c4e6a9d17'
+down_revision: Union[str, None] = '2d6f8b1e4a93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('click_events',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('short_code', sa.String(), nullable=False),
+    sa.Column('clicked_at', sa.DateTime(), nullable=False),
+    sa.Column('client_ip', sa.String(), nullable=False),
+    sa.Column('user_agent', sa.String(), nullable=False),
+    sa.Column('referrer', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_click_events_clicked_at', 'click_events', ['clicked_at'], unique=False, postgresql_using='brin')
+    op.create_table('click_log_segments',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('events', sa.Integer(), nullable=False),
+    sa.Column('ingested_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('click_log_segments')
+    op.drop_index('ix_click_events_clicked_at', table_name='click_events', postgresql_using='brin')
+    op.drop_table('click_events')
@@ -0,0 +1,85 @@
+"""add url digest to links
+
+Revision ID: 9c4e2d81a7f3
+Revises: 3f1c9a7e2b64
+Create Date: 2026-10-18 12:41:07.508213
+
+"""
+import hashlib
+from typing import Sequence, Union
+from urllib.parse import urlsplit, urlunsplit
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c4e2d81a7f3'
+down_revision: Union[str, None] = '3f1c9a7e2b64'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BACKFILL_BATCH_SIZE = 10000
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+# a frozen copy of app/urls.py as of this revision, so later changes to the application cannot change what
+# this migration writes; digests of rows created afterwards come from the application
+def canonicalize_url(url: str):
+    url = url.strip()
+    if "://" not in url:
+        url = "http://" + url
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if ":" in netloc:
+        netloc = f"[{netloc}]"
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{port}"
+    if parts.username is not None:
+        userinfo = parts.username if parts.password is None else f"{parts.username}:{parts.password}"
+        netloc = f"{userinfo}@{netloc}"
+
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, parts.fragment))
+
+
+def url_digest(url: str):
+    return hashlib.sha256(canonicalize_url(url).encode("utf-8")).digest()
+
+
+def upgrade() -> None:
+    op.add_column('links', sa.Column('url_digest', sa.LargeBinary(), nullable=True))
+
+    links = sa.table('links', sa.column('id', sa.Integer), sa.column('original_url', sa.String), sa.column('url_digest', sa.LargeBinary))
+    connection = op.get_bind()
+
+    # every batch commits on its own and the index is built concurrently, so writers are never blocked for long
+    with op.get_context().autocommit_block():
+        last_id = 0
+        while True:
+            rows = connection.execute(
+                sa.select(links.c.id, links.c.original_url)
+                .where(links.c.id > last_id)
+                .order_by(links.c.id)
+                .limit(BACKFILL_BATCH_SIZE)
+            ).all()
+            if not rows:
+                break
+
+            digests = sa.values(sa.column('id', sa.Integer), sa.column('url_digest', sa.LargeBinary), name='digests').data(
+                [(row.id, url_digest(row.original_url)) for row in rows]
+            )
+            connection.execute(links.update().where(links.c.id == digests.c.id).values(url_digest=digests.c.url_digest))
+            last_id = rows[-1].id
+
+        op.create_index(op.f('ix_links_url_digest'), 'links', ['url_digest'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_links_url_digest'), table_name='links')
+    op.drop_column('links', 'url_digest')
@@ -0,0 +1,154 @@
+"""partition links by expiry
+
+Revision ID: b71d5e3a0c42
+Revises: 8f2c4e6a9d17
+Create Date: 2026-10-19 03:12:08.514327
+
+"""
+from datetime import timedelta
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b71d5e3a0c42'
+down_revision: Union[str, None] = '8f2c4e6a9d17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+LINK_COLUMNS = "id, original_url, short_code, created_at, last_accessed_at, access_count, expires_at, url_digest, visitors"
+
+LINK_FUNCTIONS = [
+    """
+    CREATE OR REPLACE FUNCTION links_claim_short_code() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO link_short_codes (short_code, link_id) VALUES (NEW.short_code, NEW.id) ON CONFLICT DO NOTHING;
+        IF NOT FOUND THEN
+            RETURN NULL;
+        END IF;
+        RETURN NEW;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION links_rename_short_code() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM link_short_codes WHERE short_code = OLD.short_code AND link_id = OLD.id;
+        INSERT INTO link_short_codes (short_code, link_id) VALUES (NEW.short_code, NEW.id);
+        RETURN NEW;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION links_release() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM link_short_codes AS codes USING deleted_links WHERE codes.short_code = deleted_links.short_code AND codes.link_id = deleted_links.id;
+        DELETE FROM link_click_buckets AS buckets USING deleted_links WHERE buckets.link_id = deleted_links.id;
+        DELETE FROM link_visitor_sketches AS sketches USING deleted_links WHERE sketches.link_id = deleted_links.id;
+        RETURN NULL;
+    END $$
+    """,
+]
+
+LINK_TRIGGERS = [
+    "CREATE TRIGGER links_claim_short_code BEFORE INSERT ON links FOR EACH ROW EXECUTE FUNCTION links_claim_short_code()",
+    "CREATE TRIGGER links_rename_short_code BEFORE UPDATE OF short_code ON links FOR EACH ROW "
+    "WHEN (OLD.short_code IS DISTINCT FROM NEW.short_code) EXECUTE FUNCTION links_rename_short_code()",
+    "CREATE TRIGGER links_release AFTER DELETE ON links REFERENCING OLD TABLE AS deleted_links FOR EACH STATEMENT EXECUTE FUNCTION links_release()",
+]
+
+
+def upgrade() -> None:
+    # the foreign keys cannot point at a partitioned table without a unique id, the links_release trigger replaces them
+    op.drop_constraint('link_click_buckets_link_id_fkey', 'link_click_buckets', type_='foreignkey')
+    op.drop_constraint('link_visitor_sketches_link_id_fkey', 'link_visitor_sketches', type_='foreignkey')
+
+    op.execute("ALTER TABLE links RENAME TO links_unpartitioned")
+    op.execute("ALTER TABLE links_unpartitioned RENAME CONSTRAINT links_pkey TO links_unpartitioned_pkey")
+    op.execute("ALTER TABLE links_unpartitioned RENAME CONSTRAINT links_short_code_key TO links_unpartitioned_short_code_key")
+    op.execute("ALTER INDEX ix_links_id RENAME TO ix_links_unpartitioned_id")
+    op.execute("ALTER INDEX ix_links_url_digest RENAME TO ix_links_unpartitioned_url_digest")
+    op.execute("ALTER SEQUENCE links_id_seq OWNED BY NONE")
+
+    op.execute(
+        "CREATE TABLE links ("
+        "id integer NOT NULL DEFAULT nextval('links_id_seq'), "
+        "original_url varchar NOT NULL, "
+        "short_code varchar NOT NULL, "
+        "created_at timestamp, "
+        "last_accessed_at timestamp, "
+        "access_count integer, "
+        "expires_at timestamp, "
+        "url_digest bytea, "
+        "visitors bytea"
+        ") PARTITION BY RANGE ((coalesce(expires_at, 'infinity'::timestamp)))"
+    )
+    op.execute("CREATE TABLE links_never PARTITION OF links FOR VALUES FROM ('infinity') TO (MAXVALUE)")
+    # every month that existing links expire in and the next three, later months are attached by the application
+    months = op.get_bind().execute(sa.text(
+        "SELECT DISTINCT date_trunc('month', expires_at) AS month FROM links_unpartitioned WHERE expires_at IS NOT NULL "
+        "UNION SELECT generate_series(date_trunc('month', localtimestamp), date_trunc('month', localtimestamp) + interval '3 months', interval '1 month') "
+        "ORDER BY month"
+    )).scalars().all()
+    for month in months:
+        following = (month + timedelta(days=32)).replace(day=1)
+        op.execute(f"CREATE TABLE links_{month:%Y_%m} PARTITION OF links FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')")
+
+    op.create_table('link_short_codes',
+    sa.Column('short_code', sa.String(), nullable=False),
+    sa.Column('link_id', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('short_code')
+    )
+    # rows are copied before the triggers and indexes exist, the codes are already unique
+    op.execute(f"INSERT INTO links ({LINK_COLUMNS}) SELECT {LINK_COLUMNS} FROM links_unpartitioned")
+    op.execute("INSERT INTO link_short_codes (short_code, link_id) SELECT short_code, id FROM links_unpartitioned")
+
+    op.create_index('ix_links_id', 'links', ['id'], unique=False)
+    op.create_index('ix_links_url_digest', 'links', ['url_digest'], unique=False)
+    op.create_index('ix_links_short_code', 'links', ['short_code'], unique=False)
+    op.create_index('ix_links_expires_at', 'links', ['expires_at'], unique=False, postgresql_where=sa.text('expires_at IS NOT NULL'))
+    for statement in LINK_FUNCTIONS + LINK_TRIGGERS:
+        op.execute(statement)
+
+    op.execute("ALTER SEQUENCE links_id_seq OWNED BY links.id")
+    op.drop_table('links_unpartitioned')
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER links_release ON links")
+    op.execute("DROP TRIGGER links_rename_short_code ON links")
+    op.execute("DROP TRIGGER links_claim_short_code ON links")
+
+    op.execute("ALTER TABLE links RENAME TO links_partitioned")
+    op.execute("ALTER INDEX ix_links_id RENAME TO ix_links_partitioned_id")
+    op.execute("ALTER INDEX ix_links_url_digest RENAME TO ix_links_partitioned_url_digest")
+    op.execute("ALTER SEQUENCE links_id_seq OWNED BY NONE")
+
+    op.create_table('links',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('links_id_seq')"), nullable=False),
+    sa.Column('original_url', sa.String(), nullable=False),
+    sa.Column('short_code', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('last_accessed_at', sa.DateTime(), nullable=True),
+    sa.Column('access_count', sa.Integer(), nullable=True),
+    sa.Column('expires_at', sa.DateTime(), nullable=True),
+    sa.Column('url_digest', sa.LargeBinary(), nullable=True),
+    sa.Column('visitors', sa.LargeBinary(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('short_code')
+    )
+    op.execute(f"INSERT INTO links ({LINK_COLUMNS}) SELECT {LINK_COLUMNS} FROM links_partitioned")
+    op.create_index('ix_links_id', 'links', ['id'], unique=False)
+    op.create_index('ix_links_url_digest', 'links', ['url_digest'], unique=False)
+    op.execute("ALTER SEQUENCE links_id_seq OWNED BY links.id")
+    op.drop_table('links_partitioned')
+    op.drop_table('link_short_codes')
+    for function in ('links_claim_short_code', 'links_rename_short_code', 'links_release'):
+        op.execute(f"DROP FUNCTION {function}()")
+
+    # nothing kept rows of deleted links from staying behind while there were no foreign keys
+    op.execute("DELETE FROM link_click_buckets WHERE link_id NOT IN (SELECT id FROM links)")
+    op.execute("DELETE FROM link_visitor_sketches WHERE link_id NOT IN (SELECT id FROM links)")
+    op.create_foreign_key('link_click_buckets_link_id_fkey', 'link_click_buckets', 'links', ['link_id'], ['id'], ondelete='CASCADE')
+    op.create_foreign_key('link_visitor_sketches_link_id_fkey', 'link_visitor_sketches', 'links', ['link_id'], ['id'], ondelete='CASCADE')
@@ -0,0 +1,59 @@
+"""add expires_at to link_short_codes
+
+Revision ID: c5d2a9e7f1b3
+Revises: b71d5e3a0c42
+Create Date: 2026-10-19 05:26:41.208735
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5d2a9e7f1b3'
+down_revision: Union[str, None] = 'b71d5e3a0c42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def claim_function(columns, values):
+    return f"""
+    CREATE OR REPLACE FUNCTION links_claim_short_code() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO link_short_codes ({columns}) VALUES ({values}) ON CONFLICT DO NOTHING;
+        IF NOT FOUND THEN
+            RETURN NULL;
+        END IF;
+        RETURN NEW;
+    END $$
+    """
+
+
+def rename_function(columns, values):
+    return f"""
+    CREATE OR REPLACE FUNCTION links_rename_short_code() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM link_short_codes WHERE short_code = OLD.short_code AND link_id = OLD.id;
+        INSERT INTO link_short_codes ({columns}) VALUES ({values});
+        RETURN NEW;
+    END $$
+    """
+
+
+def upgrade() -> None:
+    op.add_column('link_short_codes', sa.Column('expires_at', sa.DateTime(), nullable=True))
+    op.execute(claim_function("short_code, link_id, expires_at", "NEW.short_code, NEW.id, NEW.expires_at"))
+    op.execute(rename_function("short_code, link_id, expires_at", "NEW.short_code, NEW.id, NEW.expires_at"))
+    # lookups compare the partition key with this copy, a code left without it would not find its link
+    op.execute(
+        "UPDATE link_short_codes AS codes SET expires_at = links.expires_at FROM links "
+        "WHERE links.short_code = codes.short_code AND links.id = codes.link_id AND links.expires_at IS NOT NULL"
+    )
+
+
+def downgrade() -> None:
+    op.execute(claim_function("short_code, link_id", "NEW.short_code, NEW.id"))
+    op.execute(rename_function("short_code, link_id", "NEW.short_code, NEW.id"))
+    op.drop_column('link_short_codes', 'expires_at')
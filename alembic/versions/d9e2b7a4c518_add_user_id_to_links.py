@@ -0,0 +1,27 @@
+"""add user_id to links
+
+Revision ID: d9e2b7a4c518
+Revises: a6d3f9b2c417
+Create Date: 2026-10-19 10:21:06.843179
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd9e2b7a4c518'
+down_revision: Union[str, None] = 'a6d3f9b2c417'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # a nullable column without a default only changes the catalog, the partitions are not rewritten
+    op.add_column('links', sa.Column('user_id', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('links', 'user_id')
@@ -0,0 +1,41 @@
+"""widen link ids to bigint
+
+Revision ID: e1f7b3c8a920
+Revises: c5d2a9e7f1b3
+Create Date: 2026-10-19 06:02:17.431950
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1f7b3c8a920'
+down_revision: Union[str, None] = 'c5d2a9e7f1b3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# every column that holds a link id; with shards the ids grow SHARD_ID_STRIDE times faster than the links
+LINK_ID_COLUMNS = [
+    ('links', 'id'),
+    ('link_short_codes', 'link_id'),
+    ('link_click_buckets', 'link_id'),
+    ('link_visitor_sketches', 'link_id'),
+]
+
+
+def upgrade() -> None:
+    # each table is rewritten under an exclusive lock, writes to links have to be stopped meanwhile
+    op.execute("ALTER SEQUENCE links_id_seq AS bigint")
+    for table, column in LINK_ID_COLUMNS:
+        op.alter_column(table, column, existing_type=sa.Integer(), type_=sa.BigInteger(), existing_nullable=False)
+
+
+def downgrade() -> None:
+    # fails if an id above 2147483647 has already been handed out
+    for table, column in LINK_ID_COLUMNS:
+        op.alter_column(table, column, existing_type=sa.BigInteger(), type_=sa.Integer(), existing_nullable=False)
+    op.execute("ALTER SEQUENCE links_id_seq AS integer")
@@ -0,0 +1,38 @@
+"""add visitor sketches
+
+Revision ID: e7a3c95b1f08
+Revises: 5b8e0f6c4d21
+Create Date: 2026-10-18 21:04:37.092518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7a3c95b1f08'
+down_revision: Union[str, None] = '5b8e0f6c4d21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('links', sa.Column('visitors', sa.LargeBinary(), nullable=True))
+    op.create_table('link_visitor_sketches',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('link_id', sa.Integer(), nullable=False),
+    sa.Column('granularity', sa.String(length=4), nullable=False),
+    sa.Column('bucket', sa.DateTime(), nullable=False),
+    sa.Column('sketch', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['link_id'], ['links.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_link_visitor_sketches_link_id_bucket', 'link_visitor_sketches', ['link_id', 'bucket'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_link_visitor_sketches_link_id_bucket', table_name='link_visitor_sketches')
+    op.drop_table('link_visitor_sketches')
+    op.drop_column('links', 'visitors')
@@ -0,0 +1,31 @@
+"""add claim_id to link_short_codes
+
+Revision ID: f4a8c2d6e913
+Revises: e1f7b3c8a920
+Create Date: 2026-10-19 09:14:52.607318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f4a8c2d6e913'
+down_revision: Union[str, None] = 'e1f7b3c8a920'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute(sa.schema.CreateSequence(sa.Sequence('link_short_codes_claim_seq')))
+    # the volatile default numbers the existing codes while the table is rewritten
+    op.add_column('link_short_codes', sa.Column('claim_id', sa.BigInteger(), server_default=sa.text("nextval('link_short_codes_claim_seq')"), nullable=False))
+    op.create_index('ix_link_short_codes_claim_id', 'link_short_codes', ['claim_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_link_short_codes_claim_id', table_name='link_short_codes')
+    op.drop_column('link_short_codes', 'claim_id')
+    op.execute(sa.schema.DropSequence(sa.Sequence('link_short_codes_claim_seq')))
@@ -1,12 +1,19 @@
+import hashlib
+import time
+from collections import OrderedDict, namedtuple
 from datetime import datetime, timezone, timedelta
 from jose import jwt
-from .config import SECRET, ALG
+from .config import SECRET, ALG, AUTH_CACHE_SIZE, USER_CACHE_TTL
 
 
 SECRET_KEY = SECRET
 ALGORITHM = ALG
 ACCESS_TOKEN_EXPIRE_IN_MINUTES = 30
 
+CachedPrincipal = namedtuple("CachedPrincipal", ["username", "expires_at"])
+CachedUser = namedtuple("CachedUser", ["id", "username", "email", "cached_until"])
+
+
 def create_access_token(username: str):
     data = {"sub" : username}
     expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_IN_MINUTES)
@@ -14,3 +21,118 @@ def create_access_token(username: str):
     encoded_jwt = jwt.encode(data, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+
+class PrincipalCache:
+    # verified tokens by digest, each one kept only until its exp, plus short-lived user snapshots
+    def __init__(self, max_size: int, user_ttl: float):
+        self.max_size = max_size
+        self.user_ttl = user_ttl
+        self._principals = OrderedDict()
+        self._users = OrderedDict()
+        self.token_hits = 0
+        self.token_misses = 0
+        self.user_hits = 0
+        self.user_misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.verifications = 0
+        self.verify_seconds = 0.0
+
+    @staticmethod
+    def token_digest(token: str):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get_principal(self, token: str):
+        digest = self.token_digest(token)
+        entry = self._principals.get(digest)
+        if entry is None or entry.expires_at <= time.time():
+            if entry is not None:
+                del self._principals[digest]
+            self.token_misses += 1
+            return None
+
+        self._principals.move_to_end(digest)
+        self.token_hits += 1
+        return entry.username
+
+    def put_principal(self, token: str, username: str, expires_at):
+        if self.max_size <= 0 or expires_at is None:
+            return
+        digest = self.token_digest(token)
+        self._principals[digest] = CachedPrincipal(username, expires_at)
+        self._principals.move_to_end(digest)
+        self._evict(self._principals)
+
+    def record_verification(self, seconds: float):
+        self.verifications += 1
+        self.verify_seconds += seconds
+
+    def get_user(self, username: str):
+        entry = self._users.get(username)
+        if entry is None or entry.cached_until < time.monotonic():
+            if entry is not None:
+                del self._users[username]
+            self.user_misses += 1
+            return None
+
+        self._users.move_to_end(username)
+        self.user_hits += 1
+        return entry
+
+    def put_user(self, user):
+        entry = CachedUser(user.id, user.username, user.email, time.monotonic() + self.user_ttl)
+        if self.max_size <= 0:
+            return entry
+        self._users[user.username] = entry
+        self._users.move_to_end(user.username)
+        self._evict(self._users)
+        return entry
+
+    def invalidate_user(self, *usernames: str):
+        for username in usernames:
+            if self._users.pop(username, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self._principals.clear()
+        self._users.clear()
+
+    def _evict(self, entries: OrderedDict):
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        average_verify_seconds = self.verify_seconds / self.verifications if self.verifications else 0.0
+        return {
+            "principals": len(self._principals),
+            "users": len(self._users),
+            "max_size": self.max_size,
+            "user_ttl": self.user_ttl,
+            "token_hits": self.token_hits,
+            "token_misses": self.token_misses,
+            "user_hits": self.user_hits,
+            "user_misses": self.user_misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "verifications": self.verifications,
+            "average_verify_ms": round(average_verify_seconds * 1000, 4),
+            "saved_verify_ms": round(self.token_hits * average_verify_seconds * 1000, 3),
+        }
+
+
+principal_cache = PrincipalCache(AUTH_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def decode_access_token(token: str):
+    username = principal_cache.get_principal(token)
+    if username is not None:
+        return username
+
+    started = time.perf_counter()
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    principal_cache.record_verification(time.perf_counter() - started)
+    username = payload.get("sub")
+    if username is not None:
+        principal_cache.put_principal(token, username, payload.get("exp"))
+    return username
@@ -0,0 +1,172 @@
+import hashlib
+import math
+import time
+from sqlalchemy import select, text
+from . import models
+from .singleflight import SingleFlight
+from .config import SHORT_CODE_FILTER_ERROR_RATE, SHORT_CODE_FILTER_MIN_CAPACITY
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        # double hashing, two 64-bit halves of one digest give all k positions
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, key: str):
+        added = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        self.count += added
+        return added
+
+    def __contains__(self, key: str):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def estimated_false_positive_rate(self):
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+    def memory_bytes(self):
+        return len(self.bits)
+
+
+class ShortCodeFilter:
+    # all short codes that may exist; a code the filter has never seen certainly does not exist,
+    # so unknown codes are answered without a query. Deleted codes stay in it until the next rebuild
+    def __init__(self, error_rate: float, min_capacity: int, refresh_overlap: int = 1000):
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.refresh_overlap = refresh_overlap
+        self.bloom = None
+        self.max_claim_ids = []
+        self.built_at = None
+        self.refreshed_at = None
+        self._rebuilding = None
+        self._catch_ups = SingleFlight()
+        self.rejected = 0
+        self.passed = 0
+        self.caught_up = 0
+        self.false_positives = 0
+        self.skipped_candidates = 0
+
+    @property
+    def ready(self):
+        return self.bloom is not None
+
+    def __contains__(self, short_code: str):
+        return self.bloom is None or short_code in self.bloom
+
+    async def might_exist(self, short_code: str, refresh):
+        if self.bloom is None:
+            return True
+        if short_code in self.bloom:
+            self.passed += 1
+            return True
+        # codes claimed on other workers reach the filter with the next refresh, so a miss is only final once
+        # a refresh that started after it has not found the code either; misses arriving together share one
+        arrived = time.monotonic()
+        while self.refreshed_at < arrived:
+            await self._catch_ups.do("refresh", refresh)
+        if short_code in self.bloom:
+            self.caught_up += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def add(self, *short_codes: str):
+        for short_code in short_codes:
+            if self.bloom is not None:
+                self.bloom.add(short_code)
+            if self._rebuilding is not None:
+                self._rebuilding.append(short_code)
+
+    def needs_rebuild(self):
+        return self.bloom is None or self.bloom.count > self.bloom.capacity
+
+    async def rebuild(self, *dbs, yield_per: int = 10000):
+        # one session per link shard
+        started = time.monotonic()
+        estimate = 0
+        for db in dbs:
+            # links is partitioned, its own reltuples stays at zero
+            estimate += await db.scalar(text(
+                "SELECT sum(greatest(child.reltuples, 0))::bigint FROM pg_inherits AS inherits "
+                "JOIN pg_class AS child ON child.oid = inherits.inhrelid WHERE inherits.inhparent = 'links'::regclass"
+            )) or 0
+        bloom = BloomFilter(max(self.min_capacity, 2 * estimate), self.error_rate)
+        max_claim_ids = []
+        # codes added while the scan runs may be missing from its snapshot, they are replayed at the end
+        self._rebuilding = []
+        try:
+            for db in dbs:
+                max_claim_id = 0
+                rows = await db.stream(
+                    select(models.LinkShortCode.claim_id, models.LinkShortCode.short_code).execution_options(yield_per=yield_per)
+                )
+                async for batch in rows.partitions():
+                    for claim_id, short_code in batch:
+                        bloom.add(short_code)
+                        max_claim_id = max(max_claim_id, claim_id)
+                max_claim_ids.append(max_claim_id)
+            for short_code in self._rebuilding:
+                bloom.add(short_code)
+        finally:
+            self._rebuilding = None
+        self.bloom = bloom
+        self.max_claim_ids = max_claim_ids
+        self.built_at = started
+        self.refreshed_at = max(self.refreshed_at or started, started)
+
+    async def refresh(self, *dbs):
+        # picks up codes claimed by other workers and the import CLI, renamed links included; numbers a bit below
+        # the last seen one are rescanned because concurrent transactions can commit out of claim order
+        started = time.monotonic()
+        for shard, db in enumerate(dbs):
+            max_claim_id = self.max_claim_ids[shard] if shard < len(self.max_claim_ids) else 0
+            rows = await db.execute(
+                select(models.LinkShortCode.claim_id, models.LinkShortCode.short_code)
+                .where(models.LinkShortCode.claim_id > max_claim_id - self.refresh_overlap)
+            )
+            for claim_id, short_code in rows:
+                self.add(short_code)
+                max_claim_id = max(max_claim_id, claim_id)
+            self.max_claim_ids[shard:shard + 1] = [max_claim_id]
+        self.refreshed_at = max(self.refreshed_at or started, started)
+
+    def clear(self):
+        self.bloom = None
+        self.max_claim_ids = []
+        self.built_at = None
+        self.refreshed_at = None
+
+    def stats(self):
+        unknown = self.rejected + self.false_positives
+        return {
+            "ready": self.ready,
+            "codes": self.bloom.count if self.bloom is not None else 0,
+            "capacity": self.bloom.capacity if self.bloom is not None else 0,
+            "hash_count": self.bloom.hash_count if self.bloom is not None else 0,
+            "memory_bytes": self.bloom.memory_bytes() if self.bloom is not None else 0,
+            "estimated_false_positive_rate": self.bloom.estimated_false_positive_rate() if self.bloom is not None else 0.0,
+            "rejected": self.rejected,
+            "passed": self.passed,
+            "caught_up": self.caught_up,
+            "false_positives": self.false_positives,
+            "observed_false_positive_rate": self.false_positives / unknown if unknown else 0.0,
+            "skipped_candidates": self.skipped_candidates,
+        }
+
+
+short_code_filter = ShortCodeFilter(SHORT_CODE_FILTER_ERROR_RATE, SHORT_CODE_FILTER_MIN_CAPACITY)
@@ -0,0 +1,75 @@
+import time
+from collections import OrderedDict, namedtuple
+from .config import LINK_CACHE_SIZE, LINK_CACHE_TTL
+
+
+CachedLink = namedtuple("CachedLink", ["id", "original_url", "expires_at", "cached_until"])
+
+
+class LinkCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, short_code: str):
+        entry = self._entries.get(short_code)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if entry.cached_until < time.monotonic():
+            del self._entries[short_code]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(short_code)
+        self.hits += 1
+        return entry
+
+    def __contains__(self, short_code: str):
+        entry = self._entries.get(short_code)
+        return entry is not None and entry.cached_until >= time.monotonic()
+
+    def put(self, short_code: str, link_id: int, original_url: str, expires_at):
+        entry = CachedLink(link_id, original_url, expires_at, time.monotonic() + self.ttl)
+        if self.max_size <= 0:
+            return entry
+
+        self._entries[short_code] = entry
+        self._entries.move_to_end(short_code)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def invalidate(self, *short_codes: str):
+        for short_code in short_codes:
+            if self._entries.pop(short_code, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+link_cache = LinkCache(LINK_CACHE_SIZE, LINK_CACHE_TTL)
@@ -0,0 +1,227 @@
+import asyncio
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from . import models
+from .config import (
+    CLICK_LOG_DIR, CLICK_LOG_SEGMENT_BYTES, CLICK_LOG_SEGMENT_SECONDS, CLICK_LOG_FSYNC, CLICK_LOG_MAX_PENDING,
+)
+import pytz
+
+
+tz = pytz.timezone('Europe/Moscow')
+
+# a record is its payload length and crc32 followed by the payload, so a torn tail is detected on recovery
+RECORD_HEADER = struct.Struct("<II")
+# timestamp in microseconds and the lengths of short_code, client, user_agent and referrer
+EVENT_HEADER = struct.Struct("<qHHHH")
+OPEN_SUFFIX = ".open"
+CLOSED_SUFFIX = ".log"
+FSYNC_POLICIES = ("always", "segment", "never")
+EVENT_COLUMNS = ["short_code", "clicked_at", "client_ip", "user_agent", "referrer"]
+
+
+def encode_event(timestamp_us: int, short_code: str, client: str, user_agent: str, referrer: str):
+    fields = [value.encode("utf-8")[:0xFFFF] for value in (short_code, client, user_agent, referrer)]
+    payload = EVENT_HEADER.pack(timestamp_us, *map(len, fields)) + b"".join(fields)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_events(data: bytes):
+    # returns the events up to the first torn or corrupted record and the length of the valid prefix
+    events = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if length < EVENT_HEADER.size or len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        timestamp_us, *lengths = EVENT_HEADER.unpack_from(payload)
+        fields, position = [], EVENT_HEADER.size
+        for field_length in lengths:
+            fields.append(payload[position:position + field_length].decode("utf-8", "replace"))
+            position += field_length
+        events.append((timestamp_us, *fields))
+        offset = start + length
+    return events, offset
+
+
+def read_segment(path: str):
+    with open(path, "rb") as segment:
+        return decode_events(segment.read())[0]
+
+
+def fsync_directory(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def segment_owner_alive(name: str):
+    pid = int(name.split(".")[0].split("-")[1])
+    if pid == os.getpid():
+        # this process has not opened a segment yet, so the file is left from an earlier process with the same pid
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ClickLog:
+    # redirects only append to an in-memory list; a background task writes batches to the active
+    # segment in a thread, and segments are sealed (renamed from .open to .log) by size or age.
+    # Only sealed segments are ingested, so after a crash at most the unsynced tail of the open one is lost
+    def __init__(self, directory: str, segment_bytes: int, segment_seconds: float, fsync: str, max_pending: int):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.fsync = fsync
+        self.max_pending = max_pending
+        self._pending = []
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._opened_at = None
+        self._size = 0
+        self.appended = 0
+        self.dropped = 0
+        self.written = 0
+        self.sealed = 0
+        self.recovered = 0
+        self.ingested_segments = 0
+        self.ingested_events = 0
+
+    def append(self, short_code: str, client: str, user_agent: str, referrer: str):
+        if len(self._pending) >= self.max_pending:
+            # the writer fell behind, clicks are still counted by the click buffer
+            self.dropped += 1
+            return
+        self._pending.append((time.time_ns() // 1000, short_code, client, user_agent, referrer))
+        self.appended += 1
+
+    def take(self):
+        pending, self._pending = self._pending, []
+        return pending
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(OPEN_SUFFIX) and not segment_owner_alive(name):
+                self.recover(os.path.join(self.directory, name))
+
+    def recover(self, path: str):
+        with open(path, "rb+") as segment:
+            events, valid_length = decode_events(segment.read())
+            segment.truncate(valid_length)
+            os.fsync(segment.fileno())
+        if events:
+            os.rename(path, path[:-len(OPEN_SUFFIX)] + CLOSED_SUFFIX)
+            self.recovered += len(events)
+        else:
+            os.remove(path)
+        fsync_directory(self.directory)
+
+    def write(self, events):
+        with self._lock:
+            if events:
+                if self._file is None:
+                    self._path = os.path.join(self.directory, f"{time.time_ns():020d}-{os.getpid()}{OPEN_SUFFIX}")
+                    self._file = open(self._path, "ab")
+                    self._opened_at = time.monotonic()
+                    self._size = 0
+                data = b"".join(encode_event(*event) for event in events)
+                self._file.write(data)
+                self._file.flush()
+                if self.fsync == "always":
+                    os.fsync(self._file.fileno())
+                self._size += len(data)
+                self.written += len(events)
+            if self._file is not None and (self._size >= self.segment_bytes or time.monotonic() - self._opened_at >= self.segment_seconds):
+                self._seal()
+
+    def seal(self):
+        with self._lock:
+            self._seal()
+
+    def _seal(self):
+        if self._file is None:
+            return
+        if self.fsync != "never":
+            os.fsync(self._file.fileno())
+        self._file.close()
+        os.rename(self._path, self._path[:-len(OPEN_SUFFIX)] + CLOSED_SUFFIX)
+        if self.fsync != "never":
+            fsync_directory(self.directory)
+        self._file = None
+        self.sealed += 1
+
+    def closed_segments(self):
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory)) if name.endswith(CLOSED_SUFFIX)]
+
+    def stats(self):
+        return {
+            "appended": self.appended,
+            "dropped": self.dropped,
+            "pending": len(self._pending),
+            "written": self.written,
+            "sealed_segments": self.sealed,
+            "recovered_events": self.recovered,
+            "ingested_segments": self.ingested_segments,
+            "ingested_events": self.ingested_events,
+        }
+
+
+async def ingest_segment(db, path: str):
+    # the checkpoint row and the events are committed together, so a segment is loaded exactly once
+    # even if several workers share the directory or the process dies before removing the file
+    events = await asyncio.to_thread(read_segment, path)
+    claimed = await db.scalar(
+        pg_insert(models.ClickLogSegment)
+        .values(name=os.path.basename(path), events=len(events), ingested_at=datetime.now(tz).replace(tzinfo=None))
+        .on_conflict_do_nothing()
+        .returning(models.ClickLogSegment.name)
+    )
+    if claimed is not None and events:
+        records = [
+            (short_code, datetime.fromtimestamp(timestamp_us // 1000000, tz).replace(tzinfo=None, microsecond=timestamp_us % 1000000), client, user_agent, referrer)
+            for timestamp_us, short_code, client, user_agent, referrer in events
+        ]
+        connection = await db.connection()
+        raw_connection = await connection.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table("click_events", records=records, columns=EVENT_COLUMNS)
+    await db.commit()
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return len(events) if claimed is not None else None
+
+
+async def ingest_click_log(db, log: ClickLog):
+    for path in log.closed_segments():
+        try:
+            ingested = await ingest_segment(db, path)
+        except FileNotFoundError:
+            # ingested and removed by another worker
+            await db.rollback()
+            continue
+        if ingested is None:
+            continue
+        log.ingested_segments += 1
+        log.ingested_events += ingested
+
+
+click_log = ClickLog(CLICK_LOG_DIR, CLICK_LOG_SEGMENT_BYTES, CLICK_LOG_SEGMENT_SECONDS, CLICK_LOG_FSYNC, CLICK_LOG_MAX_PENDING)
@@ -0,0 +1,356 @@
+import asyncio
+import time
+from datetime import datetime
+from sqlalchemy import update, delete, values, column, func, select, literal, tuple_, cast, and_, Integer, BigInteger, DateTime, LargeBinary
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from . import models
+from .hll import HyperLogLog
+import pytz
+
+
+tz = pytz.timezone('Europe/Moscow')
+
+
+def link_expiries(batch: dict):
+    # the partition key of every link in a batch, recorded with its clicks
+    return {link_id: pending[2] for link_id, pending in batch.items()}
+
+
+def rollup_upsert(buckets: dict, expiries: dict):
+    rows = values(
+        column("link_id", BigInteger), column("bucket", DateTime), column("clicks", Integer), name="buckets"
+    ).data([(link_id, hour, count) for (link_id, hour), count in buckets.items()])
+    # joining on links drops clicks of links deleted before the flush instead of failing on the foreign key
+    insert = pg_insert(models.LinkClickBucket).from_select(
+        ["link_id", "granularity", "bucket", "count"],
+        select(rows.c.link_id, literal("hour"), rows.c.bucket, rows.c.clicks).join(
+            models.Link, and_(models.Link.id == rows.c.link_id, models.link_partitions_of(expiries[link_id] for link_id, _ in buckets)),
+        ),
+    )
+    return insert.on_conflict_do_update(
+        index_elements=["link_id", "granularity", "bucket"],
+        set_={"count": models.LinkClickBucket.count + insert.excluded["count"]},
+    )
+
+
+async def compact_click_buckets(db, before: datetime):
+    # hourly buckets older than the cutoff are folded into one daily bucket per link in a single statement
+    moved = (
+        delete(models.LinkClickBucket)
+        .where(models.LinkClickBucket.granularity == "hour", models.LinkClickBucket.bucket < before)
+        .returning(models.LinkClickBucket.link_id, models.LinkClickBucket.bucket, models.LinkClickBucket.count)
+        .cte("moved")
+    )
+    day = func.date_trunc("day", moved.c.bucket)
+    insert = pg_insert(models.LinkClickBucket).from_select(
+        ["link_id", "granularity", "bucket", "count"],
+        select(moved.c.link_id, literal("day"), day, func.sum(moved.c.count)).group_by(moved.c.link_id, day),
+    )
+    result = await db.execute(insert.on_conflict_do_update(
+        index_elements=["link_id", "granularity", "bucket"],
+        set_={"count": models.LinkClickBucket.count + insert.excluded["count"]},
+    ))
+    await db.commit()
+    return result.rowcount
+
+
+def visitor_sketches_insert(sketches: dict, expiries: dict):
+    rows = values(
+        column("link_id", BigInteger), column("bucket", DateTime), column("sketch", LargeBinary), name="sketches"
+    ).data([(link_id, hour, sketch.to_bytes()) for (link_id, hour), sketch in sketches.items()])
+    return pg_insert(models.LinkVisitorSketch).from_select(
+        ["link_id", "granularity", "bucket", "sketch"],
+        select(rows.c.link_id, literal("hour"), rows.c.bucket, rows.c.sketch).join(
+            models.Link, and_(models.Link.id == rows.c.link_id, models.link_partitions_of(expiries[link_id] for link_id, _ in sketches)),
+        ),
+    )
+
+
+def locked_visitors(link_ids, expiries: dict, skip_locked: bool = False):
+    # every row of the batch is locked in id order, so flushes of several workers cannot deadlock
+    return (
+        select(models.Link.id, models.Link.visitors)
+        .where(models.Link.id.in_(link_ids), models.link_partitions_of(expiries[link_id] for link_id in link_ids))
+        .order_by(models.Link.id)
+        .with_for_update(skip_locked=skip_locked)
+    )
+
+
+def clicks_update(batch: dict, visitors: dict):
+    clicks = values(
+        column("id", BigInteger), column("clicks", Integer), column("accessed_at", DateTime), column("visitors", LargeBinary),
+        name="clicks",
+    ).data([(link_id, count, accessed_at, visitors.get(link_id)) for link_id, (count, accessed_at, _) in batch.items()])
+    return (
+        update(models.Link)
+        .where(models.Link.id == clicks.c.id, models.link_partitions_of(expires_at for _, _, expires_at in batch.values()))
+        .values(
+            access_count=models.Link.access_count + clicks.c.clicks,
+            last_accessed_at=func.greatest(models.Link.last_accessed_at, clicks.c.accessed_at),
+            # a VALUES column holding only NULLs is typed as text
+            visitors=func.coalesce(cast(clicks.c.visitors, LargeBinary), models.Link.visitors),
+        )
+    )
+
+
+async def compact_visitor_sketches(db, closed: datetime, before: datetime):
+    # every flush appends partial sketches, here the partials of finished hours are merged into one row each
+    # and hours older than the cutoff into one row per day, so writers never have to read-modify-write a bucket
+    duplicated = (
+        select(models.LinkVisitorSketch.link_id, models.LinkVisitorSketch.granularity, models.LinkVisitorSketch.bucket)
+        .where(models.LinkVisitorSketch.bucket < closed)
+        .group_by(models.LinkVisitorSketch.link_id, models.LinkVisitorSketch.granularity, models.LinkVisitorSketch.bucket)
+        .having(func.count() > 1)
+    )
+    moved = await db.execute(
+        delete(models.LinkVisitorSketch)
+        .where(
+            models.LinkVisitorSketch.bucket < closed,
+            (
+                (models.LinkVisitorSketch.granularity == "hour") & (models.LinkVisitorSketch.bucket < before)
+            ) | tuple_(models.LinkVisitorSketch.link_id, models.LinkVisitorSketch.granularity, models.LinkVisitorSketch.bucket).in_(duplicated),
+        )
+        .returning(models.LinkVisitorSketch.link_id, models.LinkVisitorSketch.granularity, models.LinkVisitorSketch.bucket, models.LinkVisitorSketch.sketch)
+    )
+    merged = {}
+    for link_id, granularity, bucket, sketch in moved:
+        if granularity == "hour" and bucket < before:
+            granularity, bucket = "day", bucket.replace(hour=0)
+        key = (link_id, granularity, bucket)
+        sketch = HyperLogLog.from_bytes(sketch)
+        merged[key] = merged[key].merge(sketch) if key in merged else sketch
+
+    if merged:
+        await db.execute(pg_insert(models.LinkVisitorSketch), [
+            {"link_id": link_id, "granularity": granularity, "bucket": bucket, "sketch": sketch.to_bytes()}
+            for (link_id, granularity, bucket), sketch in merged.items()
+        ])
+    await db.commit()
+    return len(merged)
+
+
+class ClickBuffer:
+    def __init__(self):
+        self._pending = {}
+        self._buckets = {}
+        self._sketches = {}
+        self._minute = None
+        self._accessed_at = None
+        self._hour = None
+        # batches taken by a flush that is still running, stats keep counting them until they are applied or put back
+        self._in_flight = []
+        self._applying = 0
+        self._settled = None
+        self.applies = 0
+        self.lock = asyncio.Lock()
+        self.flushes = 0
+        self.flushed_clicks = 0
+
+    def accessed_at(self):
+        # last_accessed_at has minute granularity, so it is only rebuilt when the minute changes
+        minute = int(time.time() // 60)
+        if minute != self._minute:
+            self._minute = minute
+            self._accessed_at = datetime.strptime(datetime.now(tz).strftime("%Y-%m-%d %H:%M"), "%Y-%m-%d %H:%M")
+            self._hour = self._accessed_at.replace(minute=0)
+        return self._accessed_at
+
+    def record(self, link_id: int, visitor: int = None, expires_at: datetime = None):
+        # expires_at is the partition key of the link, the flush only touches the partitions of its batch
+        accessed_at = self.accessed_at()
+        pending = self._pending.get(link_id)
+        if pending is None:
+            self._pending[link_id] = [1, accessed_at, expires_at]
+        else:
+            pending[0] += 1
+            if pending[1] is not accessed_at:
+                pending[1] = accessed_at
+        bucket = (link_id, self._hour)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        if visitor is not None:
+            sketch = self._sketches.get(bucket)
+            if sketch is None:
+                sketch = self._sketches[bucket] = HyperLogLog()
+            sketch.add(visitor)
+
+    def pending(self, link_id: int):
+        count, accessed_at = 0, None
+        for batch in [self._pending] + [batch for batch, _, _ in self._in_flight]:
+            pending = batch.get(link_id)
+            if pending is not None:
+                count += pending[0]
+                if accessed_at is None or pending[1] > accessed_at:
+                    accessed_at = pending[1]
+        return count, accessed_at
+
+    def pending_buckets(self, link_id: int):
+        pending = {}
+        for buckets in [self._buckets] + [buckets for _, buckets, _ in self._in_flight]:
+            for (bucket_link_id, hour), count in buckets.items():
+                if bucket_link_id == link_id:
+                    pending[hour] = pending.get(hour, 0) + count
+        return pending
+
+    def pending_sketches(self, link_id: int):
+        pending = {}
+        for sketches in [self._sketches] + [sketches for _, _, sketches in self._in_flight]:
+            for (bucket_link_id, hour), sketch in sketches.items():
+                if bucket_link_id == link_id:
+                    pending[hour] = pending[hour].merge(sketch) if hour in pending else sketch.copy()
+        return pending
+
+    async def take(self):
+        # the lock is only held while the pending clicks are swapped out, never while they are written
+        async with self.lock:
+            if not self._pending:
+                return None
+            snapshot = (self._pending, self._buckets, self._sketches)
+            self._pending, self._buckets, self._sketches = {}, {}, {}
+            self._in_flight.append(snapshot)
+            return snapshot
+
+    async def read_settled(self, read, attempts: int = 3):
+        # a batch written while the store is read may or may not be visible to that read, so its clicks would be
+        # counted twice or not at all next to the in-flight ones; only such a read waits for the batch and is repeated
+        for _ in range(attempts):
+            applies, applying = self.applies, self._applying
+            stored = await read()
+            if not applying and not self._applying and self.applies == applies:
+                break
+            if self._applying:
+                await self._settled.wait()
+        return stored
+
+    async def settle(self, snapshot, apply):
+        # the snapshot leaves the in-flight list in the same step as the write is counted as done, clicks that
+        # could not be written are already back in the pending ones by then
+        if not self._applying:
+            self._settled = asyncio.Event()
+        self._applying += 1
+        try:
+            return await apply()
+        finally:
+            self._in_flight.remove(snapshot)
+            self._applying -= 1
+            self.applies += 1
+            if not self._applying:
+                self._settled.set()
+
+    async def merged_visitors(self, db, link_ids, expiries: dict, sketches: dict, skip_locked: bool = False):
+        link_sketches = {}
+        for (link_id, hour), sketch in sketches.items():
+            link_sketches.setdefault(link_id, []).append(sketch)
+
+        stored = await db.execute(locked_visitors(link_ids, expiries, skip_locked))
+        found = set()
+        visitors = {}
+        for link_id, stored_sketch in stored:
+            found.add(link_id)
+            if link_id in link_sketches:
+                merged = HyperLogLog.union(link_sketches[link_id])
+                if stored_sketch is not None:
+                    merged.merge(HyperLogLog.from_bytes(stored_sketch))
+                visitors[link_id] = merged.to_bytes()
+        return found, visitors
+
+    def restore(self, batch: dict, buckets: dict, sketches: dict):
+        for link_id, (count, accessed_at, expires_at) in batch.items():
+            pending = self._pending.setdefault(link_id, [0, accessed_at, expires_at])
+            pending[0] += count
+        for bucket, count in buckets.items():
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + count
+        for bucket, sketch in sketches.items():
+            self._sketches[bucket] = sketch.merge(self._sketches[bucket]) if bucket in self._sketches else sketch
+
+    async def apply(self, db, batch: dict, buckets: dict, sketches: dict, visitors: dict):
+        expiries = link_expiries(batch)
+        await db.execute(clicks_update(batch, visitors))
+        if buckets:
+            await db.execute(rollup_upsert(buckets, expiries))
+        if sketches:
+            await db.execute(visitor_sketches_insert(sketches, expiries))
+        await db.commit()
+
+    async def flush(self, *dbs):
+        # one session per link shard, in shard order; every shard is asked for every link of the batch
+        snapshot = await self.take()
+        if snapshot is None:
+            return 0
+        batch, buckets, sketches = snapshot
+        expiries = link_expiries(batch)
+
+        async def write():
+            try:
+                located = [await self.merged_visitors(db, list(batch), expiries, sketches) for db in dbs]
+                if len(dbs) > 1:
+                    # a link moving to another shard stays locked on the source until it is committed on the
+                    # target, so one found nowhere has just moved to a shard locked before it; locked rows are
+                    # skipped there instead of waited for, which would lock shards out of order
+                    missing = set(batch).difference(*(found for found, _ in located))
+                    if missing:
+                        for db, (found, visitors) in zip(dbs, located):
+                            more_found, more_visitors = await self.merged_visitors(db, list(missing), expiries, sketches, skip_locked=True)
+                            found |= more_found
+                            visitors.update(more_visitors)
+            except Exception:
+                for db in dbs:
+                    await db.rollback()
+                self.restore(batch, buckets, sketches)
+                raise
+
+            failure = None
+            for db, (found, visitors) in zip(dbs, located):
+                # a link briefly present on two shards is counted on both, the source copy is deleted by the move
+                shard_batch = batch if len(dbs) == 1 else {link_id: pending for link_id, pending in batch.items() if link_id in found}
+                if not shard_batch:
+                    await db.commit()
+                    continue
+                shard_buckets = buckets if len(dbs) == 1 else {key: count for key, count in buckets.items() if key[0] in found}
+                shard_sketches = sketches if len(dbs) == 1 else {key: sketch for key, sketch in sketches.items() if key[0] in found}
+                try:
+                    await self.apply(db, shard_batch, shard_buckets, shard_sketches, visitors)
+                except Exception as error:
+                    await db.rollback()
+                    self.restore(shard_batch, shard_buckets, shard_sketches)
+                    failure = failure or error
+            if failure is not None:
+                raise failure
+
+        await self.settle(snapshot, write)
+        flushed_clicks = sum(pending[0] for pending in batch.values())
+        self.flushes += 1
+        self.flushed_clicks += flushed_clicks
+        return flushed_clicks
+
+    async def drain(self, apply):
+        # for embedded stores, apply(batch, buckets, sketches) writes the whole batch and it is put back if that fails
+        snapshot = await self.take()
+        if snapshot is None:
+            return 0
+        batch, buckets, sketches = snapshot
+
+        async def write():
+            try:
+                await apply(batch, buckets, sketches)
+            except Exception:
+                self.restore(batch, buckets, sketches)
+                raise
+
+        await self.settle(snapshot, write)
+        flushed_clicks = sum(pending[0] for pending in batch.values())
+        self.flushes += 1
+        self.flushed_clicks += flushed_clicks
+        return flushed_clicks
+
+    def stats(self):
+        return {
+            "pending_links": len(self._pending),
+            "pending_clicks": sum(pending[0] for pending in self._pending.values()),
+            "pending_sketches": len(self._sketches),
+            "in_flight_batches": len(self._in_flight),
+            "flushes": self.flushes,
+            "flushed_clicks": self.flushed_clicks,
+        }
+
+
+click_buffer = ClickBuffer()
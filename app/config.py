@@ -6,8 +6,92 @@ load_dotenv()
 
 DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
-DB_HOST = os.getenv("DB_HOST")
+DB_HOST = os.getenv("DB_HOST", "database")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
 SECRET = os.getenv("SECRET")
-ALG = os.getenv("ALG")
\ No newline at end of file
+ALG = os.getenv("ALG")
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))
+
+# postgres, or a store embedded in the process for a single node: sqlite (a file at SQLITE_PATH) or memory
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "links.sqlite3")
+
+DB_REPLICA_HOST = os.getenv("DB_REPLICA_HOST")
+DB_REPLICA_PORT = os.getenv("DB_REPLICA_PORT", DB_PORT)
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+
+# extra link shards as host:port or host:port/dbname, the main database is always shard 0
+LINK_SHARDS = [shard.strip() for shard in os.getenv("LINK_SHARDS", "").split(",") if shard.strip()]
+LINK_SHARDS_PREVIOUS_COUNT = int(os.getenv("LINK_SHARDS_PREVIOUS_COUNT")) if os.getenv("LINK_SHARDS_PREVIOUS_COUNT") else None
+
+LINK_CACHE_SIZE = int(os.getenv("LINK_CACHE_SIZE", 10000))
+LINK_CACHE_TTL = float(os.getenv("LINK_CACHE_TTL", 60))
+
+CLICK_FLUSH_INTERVAL = float(os.getenv("CLICK_FLUSH_INTERVAL", 5))
+CLICK_HOURLY_RETENTION_DAYS = int(os.getenv("CLICK_HOURLY_RETENTION_DAYS", 14))
+CLICK_COMPACT_INTERVAL = float(os.getenv("CLICK_COMPACT_INTERVAL", 3600))
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", 10))
+
+CLICK_LOG = os.getenv("CLICK_LOG", "true").lower() in ("1", "true", "yes")
+CLICK_LOG_DIR = os.getenv("CLICK_LOG_DIR", "click_log")
+CLICK_LOG_SEGMENT_BYTES = int(os.getenv("CLICK_LOG_SEGMENT_BYTES", 16 * 1024 * 1024))
+CLICK_LOG_SEGMENT_SECONDS = float(os.getenv("CLICK_LOG_SEGMENT_SECONDS", 60))
+CLICK_LOG_FSYNC = os.getenv("CLICK_LOG_FSYNC", "segment")
+CLICK_LOG_FLUSH_INTERVAL = float(os.getenv("CLICK_LOG_FLUSH_INTERVAL", 0.2))
+CLICK_LOG_MAX_PENDING = int(os.getenv("CLICK_LOG_MAX_PENDING", 100000))
+CLICK_LOG_INGEST_INTERVAL = float(os.getenv("CLICK_LOG_INGEST_INTERVAL", 10))
+
+TOP_LINKS_CAPACITY = int(os.getenv("TOP_LINKS_CAPACITY", 1000))
+TOP_LINKS_PUBLISH_INTERVAL = float(os.getenv("TOP_LINKS_PUBLISH_INTERVAL", 5))
+TOP_LINKS_PREWARM = int(os.getenv("TOP_LINKS_PREWARM", 100))
+
+SHORT_CODE_STRATEGY = os.getenv("SHORT_CODE_STRATEGY", "random")
+SHORT_CODE_LENGTH = int(os.getenv("SHORT_CODE_LENGTH", 6))
+SHORT_CODE_BLOCK_SIZE = int(os.getenv("SHORT_CODE_BLOCK_SIZE", 1000))
+
+SHORTEN_BATCH_MAX_SIZE = int(os.getenv("SHORTEN_BATCH_MAX_SIZE", 10000))
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 10000))
+
+EXPIRED_LINKS_YIELD_PER = int(os.getenv("EXPIRED_LINKS_YIELD_PER", 1000))
+
+REMOVE_UNUSED_LINKS_BATCH_SIZE = int(os.getenv("REMOVE_UNUSED_LINKS_BATCH_SIZE", 5000))
+REMOVE_UNUSED_LINKS_BATCH_PAUSE = float(os.getenv("REMOVE_UNUSED_LINKS_BATCH_PAUSE", 0.1))
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", 7))
+
+EXPIRY_SWEEP_INTERVAL = float(os.getenv("EXPIRY_SWEEP_INTERVAL", 1))
+EXPIRY_HORIZON_HOURS = float(os.getenv("EXPIRY_HORIZON_HOURS", 24))
+EXPIRED_CODES_MAX_SIZE = int(os.getenv("EXPIRED_CODES_MAX_SIZE", 100000))
+EXPIRED_LINKS_RETENTION_DAYS = float(os.getenv("EXPIRED_LINKS_RETENTION_DAYS")) if os.getenv("EXPIRED_LINKS_RETENTION_DAYS") else None
+EXPIRED_LINKS_PURGE_INTERVAL = float(os.getenv("EXPIRED_LINKS_PURGE_INTERVAL", 3600))
+# expires_at may be at most this far ahead, every month up to it is partitioned in advance
+LINK_MAX_TTL_DAYS = float(os.getenv("LINK_MAX_TTL_DAYS", 1830))
+LINK_PARTITIONS_AHEAD_MONTHS = int(os.getenv("LINK_PARTITIONS_AHEAD_MONTHS", 3))
+LINK_PARTITION_LOCK_TIMEOUT_MS = int(os.getenv("LINK_PARTITION_LOCK_TIMEOUT_MS", 5000))
+
+DEDUPLICATE_LINKS = os.getenv("DEDUPLICATE_LINKS", "false").lower() in ("1", "true", "yes")
+
+FAST_REDIRECT = os.getenv("FAST_REDIRECT", "true").lower() in ("1", "true", "yes")
+
+METRICS = os.getenv("METRICS", "true").lower() in ("1", "true", "yes")
+
+SHORT_CODE_FILTER = os.getenv("SHORT_CODE_FILTER", "true").lower() in ("1", "true", "yes")
+SHORT_CODE_FILTER_ERROR_RATE = float(os.getenv("SHORT_CODE_FILTER_ERROR_RATE", 0.01))
+SHORT_CODE_FILTER_MIN_CAPACITY = int(os.getenv("SHORT_CODE_FILTER_MIN_CAPACITY", 100000))
+SHORT_CODE_FILTER_REFRESH_INTERVAL = float(os.getenv("SHORT_CODE_FILTER_REFRESH_INTERVAL", 1))
+SHORT_CODE_FILTER_REBUILD_INTERVAL = float(os.getenv("SHORT_CODE_FILTER_REBUILD_INTERVAL", 86400))
+
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", 16))
+PASSWORD_HASH_NICE = int(os.getenv("PASSWORD_HASH_NICE", 10))
@@ -0,0 +1,550 @@
+import asyncio
+import bisect
+from itertools import count
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, LargeBinary, ForeignKey, Index, event, select, update, delete, bindparam, or_, literal_column
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from .hll import HyperLogLog
+from .metrics import instrument_engine
+from .repositories import LinkRepository, UserRepository
+from .short_codes import short_code_generator
+from .config import EXPIRED_LINKS_YIELD_PER
+
+
+LINK_COLUMNS = ("id", "original_url", "short_code", "created_at", "last_accessed_at", "access_count", "expires_at", "url_digest", "visitors", "user_id")
+
+
+def merged_sketch(stored: bytes, sketches):
+    merged = HyperLogLog.union(sketches)
+    if stored is not None:
+        merged.merge(HyperLogLog.from_bytes(stored))
+    return merged.to_bytes()
+
+
+def truncate_to(bucket, granularity: str):
+    return bucket.replace(hour=0) if granularity == "day" else bucket
+
+
+class StoredLink:
+    __slots__ = LINK_COLUMNS
+
+    def __init__(self, **columns):
+        for name in LINK_COLUMNS:
+            setattr(self, name, columns.get(name))
+
+
+class StoredUser:
+    __slots__ = ("id", "username", "email", "password")
+
+    def __init__(self, id: int, username: str, email: str, password: str):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.password = password
+
+
+class MemoryUserRepository(UserRepository):
+    def __init__(self):
+        self._ids = count(1)
+        self.users = {}
+
+    async def get(self, username: str):
+        return self.users.get(username)
+
+    async def create(self, username: str, email: str, password: str):
+        if username in self.users:
+            raise ValueError("User already exists")
+        user = self.users[username] = StoredUser(next(self._ids), username, email, password)
+        return user
+
+    async def set_password(self, username: str, password: str):
+        self.users[username].password = password
+
+
+class MemoryLinkRepository(LinkRepository):
+    # links in dicts by id, short code and url digest, plus an (expires_at, id) list kept sorted for the expiry
+    # sweep and purge; ids only grow, so the id dict iterates in id order. Nothing survives a restart
+    def __init__(self):
+        self._ids = count(1)
+        self.links = {}
+        self.by_short_code = {}
+        self.by_url_digest = {}
+        self.expiries = []
+        self.buckets = {}
+        self.sketches = {}
+
+    async def next_short_code(self):
+        return await short_code_generator.next_code(None)
+
+    async def find_by_url(self, digest: bytes, read_only: bool = False):
+        link_ids = self.by_url_digest.get(digest)
+        return self.links[next(iter(link_ids))].short_code if link_ids else None
+
+    async def find_duplicate(self, digest: bytes, expires_at):
+        for link_id in self.by_url_digest.get(digest, ()):
+            if self.links[link_id].expires_at == expires_at:
+                return self.links[link_id].short_code
+        return None
+
+    async def taken_short_codes(self, short_codes):
+        return {short_code for short_code in short_codes if short_code in self.by_short_code}
+
+    async def insert(self, rows):
+        inserted = set()
+        for row in rows:
+            if row["short_code"] in self.by_short_code:
+                continue
+            link = StoredLink(id=next(self._ids), **row)
+            self.links[link.id] = link
+            self.by_short_code[link.short_code] = link
+            self.by_url_digest.setdefault(link.url_digest, {})[link.id] = None
+            if link.expires_at is not None:
+                bisect.insort(self.expiries, (link.expires_at, link.id))
+            inserted.add(link.short_code)
+        return inserted
+
+    def _remove(self, link: StoredLink):
+        del self.links[link.id]
+        del self.by_short_code[link.short_code]
+        link_ids = self.by_url_digest[link.url_digest]
+        del link_ids[link.id]
+        if not link_ids:
+            del self.by_url_digest[link.url_digest]
+        if link.expires_at is not None:
+            del self.expiries[bisect.bisect_left(self.expiries, (link.expires_at, link.id))]
+        self.buckets.pop(link.id, None)
+        self.sketches.pop(link.id, None)
+
+    async def get_redirect_target(self, short_code: str, read_only: bool = False):
+        return self.by_short_code.get(short_code)
+
+    async def get_many(self, short_codes):
+        return [self.by_short_code[short_code] for short_code in short_codes if short_code in self.by_short_code]
+
+    async def delete(self, short_code: str):
+        link = self.by_short_code.get(short_code)
+        if link is None:
+            return False
+        self._remove(link)
+        return True
+
+    async def rename(self, short_code_old: str, short_code_new: str):
+        link = self.by_short_code.get(short_code_old)
+        if link is None:
+            return None
+        if short_code_new != short_code_old:
+            if short_code_new in self.by_short_code:
+                raise ValueError("Short code is already taken")
+            del self.by_short_code[short_code_old]
+            link.short_code = short_code_new
+            self.by_short_code[short_code_new] = link
+        return link
+
+    async def read_stats(self, short_code: str, granularity: str = None, since=None, before=None, read_only: bool = False):
+        link = self.by_short_code.get(short_code)
+        if link is None:
+            return None
+        if granularity is None:
+            return link, None, None
+
+        buckets = {}
+        for (_, bucket), clicks in self.buckets.get(link.id, {}).items():
+            if since <= bucket < before:
+                bucket = truncate_to(bucket, granularity)
+                buckets[bucket] = buckets.get(bucket, 0) + clicks
+        sketches = [(bucket, sketch) for (_, bucket), sketch in self.sketches.get(link.id, {}).items() if since <= bucket < before]
+        return link, buckets, sketches
+
+    async def expired_links(self, now, after: int = None, limit: int = None, read_only: bool = False):
+        # (now,) sorts before every (now, id), so this is the first link that has not expired yet
+        end = bisect.bisect_left(self.expiries, (now,))
+        link_ids = sorted(link_id for _, link_id in self.expiries[:end] if after is None or link_id > after)[:limit]
+        for start in range(0, len(link_ids), EXPIRED_LINKS_YIELD_PER):
+            yield [self.links[link_id] for link_id in link_ids[start:start + EXPIRED_LINKS_YIELD_PER] if link_id in self.links]
+
+    async def upcoming_expiries(self, since, until):
+        upcoming = self.expiries[bisect.bisect_left(self.expiries, (since,)):bisect.bisect_left(self.expiries, (until,))]
+        for expires_at, link_id in upcoming:
+            if link_id in self.links:
+                yield self.links[link_id].short_code, expires_at
+
+    async def delete_unused(self, last_accessed_before, batch_size: int, pause: float, on_deleted):
+        unused = [link for link in self.links.values() if link.last_accessed_at is None or link.last_accessed_at < last_accessed_before]
+        deleted = 0
+        for start in range(0, len(unused), batch_size):
+            # a link clicked or deleted during a pause is left alone
+            batch = [
+                link for link in unused[start:start + batch_size]
+                if self.links.get(link.id) is link and (link.last_accessed_at is None or link.last_accessed_at < last_accessed_before)
+            ]
+            for link in batch:
+                self._remove(link)
+            await on_deleted([link.short_code for link in batch])
+            deleted += len(batch)
+            if start + batch_size < len(unused):
+                await asyncio.sleep(pause)
+        return deleted
+
+    async def purge_expired(self, before, on_removed):
+        if before is None:
+            return 0
+        expired = [self.links[link_id] for _, link_id in self.expiries[:bisect.bisect_left(self.expiries, (before,))]]
+        for link in expired:
+            self._remove(link)
+        if expired:
+            on_removed([link.short_code for link in expired])
+        return len(expired)
+
+    async def flush_clicks(self, buffer):
+        return await buffer.drain(self.apply_clicks)
+
+    async def apply_clicks(self, batch: dict, buckets: dict, sketches: dict):
+        # clicks of links deleted before the flush are dropped
+        link_sketches = {}
+        for (link_id, hour), sketch in sketches.items():
+            if link_id in self.links:
+                link_sketches.setdefault(link_id, []).append(sketch)
+                stored = self.sketches.setdefault(link_id, {})
+                stored[("hour", hour)] = merged_sketch(stored.get(("hour", hour)), [sketch])
+        for link_id, (clicks, accessed_at, _) in batch.items():
+            link = self.links.get(link_id)
+            if link is None:
+                continue
+            link.access_count = (link.access_count or 0) + clicks
+            if link.last_accessed_at is None or accessed_at > link.last_accessed_at:
+                link.last_accessed_at = accessed_at
+            if link_id in link_sketches:
+                link.visitors = merged_sketch(link.visitors, link_sketches[link_id])
+        for (link_id, hour), clicks in buckets.items():
+            if link_id in self.links:
+                stored = self.buckets.setdefault(link_id, {})
+                stored[("hour", hour)] = stored.get(("hour", hour), 0) + clicks
+
+    async def compact_clicks(self, closed, before):
+        # sketches are merged as they are written, so only hours older than the cutoff are folded into days
+        for history in self.buckets.values():
+            for key in [key for key in history if key[0] == "hour" and key[1] < before]:
+                day = ("day", truncate_to(key[1], "day"))
+                history[day] = history.get(day, 0) + history.pop(key)
+        for history in self.sketches.values():
+            for key in [key for key in history if key[0] == "hour" and key[1] < before]:
+                day = ("day", truncate_to(key[1], "day"))
+                history[day] = merged_sketch(history.get(day), [HyperLogLog.from_bytes(history.pop(key))])
+
+
+metadata = MetaData()
+
+users = Table(
+    "users", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("username", String, unique=True),
+    Column("email", String, unique=True),
+    Column("password", String),
+)
+
+# ids are never reused, the expired links listing pages by id
+links = Table(
+    "links", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("original_url", String, nullable=False),
+    Column("short_code", String, nullable=False, unique=True),
+    Column("created_at", DateTime),
+    Column("last_accessed_at", DateTime),
+    Column("access_count", Integer, default=0),
+    Column("expires_at", DateTime),
+    Column("url_digest", LargeBinary),
+    Column("visitors", LargeBinary),
+    Column("user_id", Integer),
+    Index("ix_links_url_digest", "url_digest"),
+    Index("ix_links_expires_at", "expires_at", sqlite_where=literal_column("expires_at IS NOT NULL")),
+    sqlite_autoincrement=True,
+)
+
+link_click_buckets = Table(
+    "link_click_buckets", metadata,
+    Column("link_id", Integer, ForeignKey("links.id", ondelete="CASCADE"), primary_key=True),
+    Column("granularity", String(4), primary_key=True),
+    Column("bucket", DateTime, primary_key=True),
+    Column("count", Integer, nullable=False),
+)
+
+# one merged sketch per bucket, writers are serialized by SQLite anyway
+link_visitor_sketches = Table(
+    "link_visitor_sketches", metadata,
+    Column("link_id", Integer, ForeignKey("links.id", ondelete="CASCADE"), primary_key=True),
+    Column("granularity", String(4), primary_key=True),
+    Column("bucket", DateTime, primary_key=True),
+    Column("sketch", LargeBinary, nullable=False),
+)
+
+
+class SqliteStore:
+    # a single file for one node: WAL lets the redirects read while a flush writes
+    def __init__(self, path: str):
+        self.engine = create_async_engine(f"sqlite+aiosqlite:///{path}", connect_args={"timeout": 30})
+        instrument_engine(self.engine, "sqlite")
+        event.listen(self.engine.sync_engine, "connect", self.configure_connection)
+        self.links = SqliteLinkRepository(self.engine)
+        self.users = SqliteUserRepository(self.engine)
+
+    @staticmethod
+    def configure_connection(connection, record):
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+class SqliteUserRepository(UserRepository):
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def get(self, username: str):
+        async with self.engine.connect() as connection:
+            return (await connection.execute(select(users).where(users.c.username == username))).first()
+
+    async def create(self, username: str, email: str, password: str):
+        async with self.engine.begin() as connection:
+            return (await connection.execute(
+                users.insert().values(username=username, email=email, password=password).returning(*users.c)
+            )).one()
+
+    async def set_password(self, username: str, password: str):
+        async with self.engine.begin() as connection:
+            await connection.execute(update(users).where(users.c.username == username).values(password=password))
+
+
+class SqliteLinkRepository(LinkRepository):
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def prepare(self):
+        async with self.engine.begin() as connection:
+            await connection.run_sync(metadata.create_all)
+            # files created before imported links had an owner
+            columns = {row[1] for row in await connection.exec_driver_sql("PRAGMA table_info(links)")}
+            if "user_id" not in columns:
+                await connection.exec_driver_sql("ALTER TABLE links ADD COLUMN user_id INTEGER")
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def next_short_code(self):
+        return await short_code_generator.next_code(None)
+
+    async def first_short_code(self, condition):
+        async with self.engine.connect() as connection:
+            return await connection.scalar(select(links.c.short_code).where(condition).order_by(links.c.id).limit(1))
+
+    async def find_by_url(self, digest: bytes, read_only: bool = False):
+        return await self.first_short_code(links.c.url_digest == digest)
+
+    async def find_duplicate(self, digest: bytes, expires_at):
+        return await self.first_short_code((links.c.url_digest == digest) & links.c.expires_at.is_not_distinct_from(expires_at))
+
+    async def taken_short_codes(self, short_codes):
+        async with self.engine.connect() as connection:
+            return set(await connection.scalars(select(links.c.short_code).where(links.c.short_code.in_(list(short_codes)))))
+
+    async def insert(self, rows):
+        if not rows:
+            return set()
+        async with self.engine.begin() as connection:
+            return set(await connection.scalars(
+                sqlite_insert(links).on_conflict_do_nothing(index_elements=["short_code"]).returning(links.c.short_code), rows
+            ))
+
+    async def get_redirect_target(self, short_code: str, read_only: bool = False):
+        async with self.engine.connect() as connection:
+            return (await connection.execute(
+                select(links.c.id, links.c.original_url, links.c.expires_at).where(links.c.short_code == short_code)
+            )).first()
+
+    async def get_many(self, short_codes):
+        async with self.engine.connect() as connection:
+            return (await connection.execute(
+                select(links.c.id, links.c.short_code, links.c.original_url, links.c.expires_at).where(links.c.short_code.in_(list(short_codes)))
+            )).all()
+
+    async def delete(self, short_code: str):
+        async with self.engine.begin() as connection:
+            return (await connection.execute(delete(links).where(links.c.short_code == short_code))).rowcount > 0
+
+    async def rename(self, short_code_old: str, short_code_new: str):
+        async with self.engine.begin() as connection:
+            link = (await connection.execute(select(links).where(links.c.short_code == short_code_old))).first()
+            if link is None or short_code_new == short_code_old:
+                return link
+            if await connection.scalar(select(links.c.id).where(links.c.short_code == short_code_new)) is not None:
+                raise ValueError("Short code is already taken")
+            await connection.execute(update(links).where(links.c.id == link.id).values(short_code=short_code_new))
+            return link
+
+    async def read_stats(self, short_code: str, granularity: str = None, since=None, before=None, read_only: bool = False):
+        async with self.engine.connect() as connection:
+            link = (await connection.execute(select(links).where(links.c.short_code == short_code))).first()
+            if link is None:
+                return None
+            if granularity is None:
+                return link, None, None
+
+            buckets = {}
+            for bucket, clicks in await connection.execute(
+                select(link_click_buckets.c.bucket, link_click_buckets.c.count).where(
+                    link_click_buckets.c.link_id == link.id, link_click_buckets.c.bucket >= since, link_click_buckets.c.bucket < before,
+                )
+            ):
+                bucket = truncate_to(bucket, granularity)
+                buckets[bucket] = buckets.get(bucket, 0) + clicks
+            sketches = (await connection.execute(
+                select(link_visitor_sketches.c.bucket, link_visitor_sketches.c.sketch).where(
+                    link_visitor_sketches.c.link_id == link.id, link_visitor_sketches.c.bucket >= since, link_visitor_sketches.c.bucket < before,
+                )
+            )).all()
+            return link, buckets, sketches
+
+    async def expired_links(self, now, after: int = None, limit: int = None, read_only: bool = False):
+        # keyset batches, a connection is not held between them
+        last_id = after or 0
+        sent = 0
+        while limit is None or sent < limit:
+            batch_size = EXPIRED_LINKS_YIELD_PER if limit is None else min(EXPIRED_LINKS_YIELD_PER, limit - sent)
+            async with self.engine.connect() as connection:
+                batch = (await connection.execute(
+                    select(links.c.id, links.c.original_url, links.c.short_code, links.c.created_at, links.c.expires_at)
+                    .where(links.c.expires_at.isnot(None), links.c.expires_at < now, links.c.id > last_id)
+                    .order_by(links.c.id)
+                    .limit(batch_size)
+                )).all()
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1].id
+            sent += len(batch)
+            if len(batch) < batch_size:
+                return
+
+    async def upcoming_expiries(self, since, until):
+        async with self.engine.connect() as connection:
+            upcoming = (await connection.execute(
+                select(links.c.short_code, links.c.expires_at).where(links.c.expires_at >= since, links.c.expires_at < until)
+            )).all()
+        for short_code, expires_at in upcoming:
+            yield short_code, expires_at
+
+    async def delete_in_batches(self, condition, batch_size: int, pause: float, on_deleted):
+        deleted = 0
+        while True:
+            async with self.engine.begin() as connection:
+                short_codes = (await connection.scalars(
+                    delete(links).where(links.c.id.in_(select(links.c.id).where(condition).limit(batch_size))).returning(links.c.short_code)
+                )).all()
+            if short_codes:
+                await on_deleted(short_codes)
+            deleted += len(short_codes)
+            if len(short_codes) < batch_size:
+                return deleted
+            await asyncio.sleep(pause)
+
+    async def delete_unused(self, last_accessed_before, batch_size: int, pause: float, on_deleted):
+        unused = or_(links.c.last_accessed_at.is_(None), links.c.last_accessed_at < last_accessed_before)
+        return await self.delete_in_batches(unused, batch_size, pause, on_deleted)
+
+    async def purge_expired(self, before, on_removed):
+        if before is None:
+            return 0
+        async def removed(short_codes):
+            on_removed(short_codes)
+
+        return await self.delete_in_batches(links.c.expires_at.isnot(None) & (links.c.expires_at < before), EXPIRED_LINKS_YIELD_PER, 0, removed)
+
+    async def flush_clicks(self, buffer):
+        return await buffer.drain(self.apply_clicks)
+
+    async def apply_clicks(self, batch: dict, buckets: dict, sketches: dict):
+        link_sketches = {}
+        for (link_id, hour), sketch in sketches.items():
+            link_sketches.setdefault(link_id, []).append(sketch)
+
+        async with self.engine.begin() as connection:
+            # clicks of links deleted before the flush are dropped
+            stored = {
+                link.id: link for link in await connection.execute(
+                    select(links.c.id, links.c.last_accessed_at, links.c.visitors).where(links.c.id.in_(list(batch)))
+                )
+            }
+            if not stored:
+                return
+            await connection.execute(
+                update(links).where(links.c.id == bindparam("link_id")).values(
+                    access_count=links.c.access_count + bindparam("clicks"),
+                    last_accessed_at=bindparam("accessed_at"),
+                    visitors=bindparam("merged_visitors"),
+                ),
+                [
+                    {
+                        "link_id": link_id,
+                        "clicks": clicks,
+                        "accessed_at": max(accessed_at, stored[link_id].last_accessed_at or accessed_at),
+                        "merged_visitors": merged_sketch(stored[link_id].visitors, link_sketches[link_id]) if link_id in link_sketches else stored[link_id].visitors,
+                    }
+                    for link_id, (clicks, accessed_at, _) in batch.items() if link_id in stored
+                ],
+            )
+
+            bucket_rows = [{"link_id": link_id, "granularity": "hour", "bucket": hour, "count": clicks} for (link_id, hour), clicks in buckets.items() if link_id in stored]
+            if bucket_rows:
+                upsert = sqlite_insert(link_click_buckets)
+                await connection.execute(
+                    upsert.on_conflict_do_update(index_elements=["link_id", "granularity", "bucket"], set_={"count": link_click_buckets.c.count + upsert.excluded["count"]}),
+                    bucket_rows,
+                )
+            sketches = {key: sketch for key, sketch in sketches.items() if key[0] in stored}
+            if sketches:
+                await self.merge_sketches(connection, "hour", {key: [sketch] for key, sketch in sketches.items()})
+
+    async def merge_sketches(self, connection, granularity: str, sketches: dict):
+        # sketches maps (link_id, bucket) to HyperLogLogs that are merged into the stored sketch of the bucket
+        stored = dict(((link_id, bucket), sketch) for link_id, bucket, sketch in await connection.execute(
+            select(link_visitor_sketches.c.link_id, link_visitor_sketches.c.bucket, link_visitor_sketches.c.sketch).where(
+                link_visitor_sketches.c.granularity == granularity,
+                link_visitor_sketches.c.link_id.in_({link_id for link_id, _ in sketches}),
+                link_visitor_sketches.c.bucket.in_({bucket for _, bucket in sketches}),
+            )
+        ))
+        upsert = sqlite_insert(link_visitor_sketches)
+        await connection.execute(
+            upsert.on_conflict_do_update(index_elements=["link_id", "granularity", "bucket"], set_={"sketch": upsert.excluded["sketch"]}),
+            [
+                {"link_id": link_id, "granularity": granularity, "bucket": bucket, "sketch": merged_sketch(stored.get((link_id, bucket)), partials)}
+                for (link_id, bucket), partials in sketches.items()
+            ],
+        )
+
+    async def compact_clicks(self, closed, before):
+        # hours older than the cutoff are folded into one daily row per link
+        async with self.engine.begin() as connection:
+            hourly = link_click_buckets.c.granularity == "hour"
+            days = {}
+            for link_id, bucket, clicks in await connection.execute(
+                select(link_click_buckets.c.link_id, link_click_buckets.c.bucket, link_click_buckets.c.count).where(hourly, link_click_buckets.c.bucket < before)
+            ):
+                day = (link_id, truncate_to(bucket, "day"))
+                days[day] = days.get(day, 0) + clicks
+            if days:
+                upsert = sqlite_insert(link_click_buckets)
+                await connection.execute(
+                    upsert.on_conflict_do_update(index_elements=["link_id", "granularity", "bucket"], set_={"count": link_click_buckets.c.count + upsert.excluded["count"]}),
+                    [{"link_id": link_id, "granularity": "day", "bucket": day, "count": clicks} for (link_id, day), clicks in days.items()],
+                )
+                await connection.execute(delete(link_click_buckets).where(hourly, link_click_buckets.c.bucket < before))
+
+            hourly = link_visitor_sketches.c.granularity == "hour"
+            days = {}
+            for link_id, bucket, sketch in await connection.execute(
+                select(link_visitor_sketches.c.link_id, link_visitor_sketches.c.bucket, link_visitor_sketches.c.sketch).where(hourly, link_visitor_sketches.c.bucket < before)
+            ):
+                days.setdefault((link_id, truncate_to(bucket, "day")), []).append(HyperLogLog.from_bytes(sketch))
+            if days:
+                await self.merge_sketches(connection, "day", days)
+                await connection.execute(delete(link_visitor_sketches).where(hourly, link_visitor_sketches.c.bucket < before))
@@ -0,0 +1,77 @@
+import heapq
+from collections import OrderedDict
+from .config import EXPIRED_CODES_MAX_SIZE
+
+
+class ExpiryScheduler:
+    # min-heap of upcoming expirations plus a bounded set of codes already known to be expired
+    def __init__(self, max_expired: int):
+        self.max_expired = max_expired
+        self._heap = []
+        self._scheduled = {}
+        self._expired = OrderedDict()
+        self.loaded_until = None
+        self.expired_hits = 0
+        self.swept = 0
+
+    def schedule(self, short_code: str, expires_at):
+        self._scheduled[short_code] = expires_at
+        heapq.heappush(self._heap, (expires_at, short_code))
+
+    def add(self, short_code: str, expires_at, now):
+        if expires_at is None:
+            return
+        if expires_at < now:
+            self.mark_expired(short_code)
+        elif self.loaded_until is None or expires_at < self.loaded_until:
+            # later expirations are picked up when the horizon moves forward
+            self.schedule(short_code, expires_at)
+
+    def pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] < now:
+            expires_at, short_code = heapq.heappop(self._heap)
+            # entries of renamed, deleted or rescheduled links are skipped lazily
+            if self._scheduled.get(short_code) == expires_at:
+                del self._scheduled[short_code]
+                self.mark_expired(short_code)
+                due.append(short_code)
+        self.swept += len(due)
+        return due
+
+    def mark_expired(self, short_code: str):
+        self._expired[short_code] = True
+        self._expired.move_to_end(short_code)
+        while len(self._expired) > self.max_expired:
+            self._expired.popitem(last=False)
+
+    def __contains__(self, short_code: str):
+        return short_code in self._expired
+
+    def is_expired(self, short_code: str):
+        if short_code in self._expired:
+            self.expired_hits += 1
+            return True
+        return False
+
+    def forget(self, *short_codes: str):
+        for short_code in short_codes:
+            self._scheduled.pop(short_code, None)
+            self._expired.pop(short_code, None)
+
+    def clear(self):
+        self._heap.clear()
+        self._scheduled.clear()
+        self._expired.clear()
+        self.loaded_until = None
+
+    def stats(self):
+        return {
+            "scheduled": len(self._scheduled),
+            "known_expired": len(self._expired),
+            "expired_hits": self.expired_hits,
+            "swept": self.swept,
+        }
+
+
+expiry_scheduler = ExpiryScheduler(EXPIRED_CODES_MAX_SIZE)
@@ -0,0 +1,62 @@
+from urllib.parse import quote
+
+
+# returned by the lookup for a code the store was already asked about and does not have
+NOT_FOUND = object()
+NOT_FOUND_BODY = b'{"detail":"Link not found"}'
+
+
+class FastRedirectMiddleware:
+    # answers GET /links/{short_code} without routing, dependency injection or a response object,
+    # anything it cannot answer (unchecked, expired or reserved codes) goes to the wrapped app unchanged
+    def __init__(self, app, lookup, record_click, now, prefix: str = "/links/", reserved=(), route=None):
+        self.app = app
+        self.route = route
+        self.lookup = lookup
+        self.record_click = record_click
+        self.now = now
+        self.prefix = prefix
+        self.reserved = frozenset(reserved)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET" or not scope["path"].startswith(self.prefix):
+            return await self.app(scope, receive, send)
+
+        short_code = scope["path"][len(self.prefix):]
+        if not short_code or "/" in short_code or short_code in self.reserved:
+            return await self.app(scope, receive, send)
+
+        link = await self.lookup(short_code)
+        if link is None or (link is not NOT_FOUND and link.expires_at is not None and link.expires_at < self.now()):
+            return await self.app(scope, receive, send)
+
+        if self.route is not None:
+            # reported as the route it stands in for, e.g. by the metrics middleware
+            scope["route"] = self.route
+        if link is NOT_FOUND:
+            # the same response as the HTTPException of the route, which would query the store a second time
+            await send({
+                "type": "http.response.start",
+                "status": 404,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(NOT_FOUND_BODY)).encode("latin-1"))],
+            })
+            await send({"type": "http.response.body", "body": NOT_FOUND_BODY})
+            return
+        client = scope.get("client")
+        user_agent = referrer = b""
+        for name, value in scope["headers"]:
+            if name == b"user-agent":
+                user_agent = value
+            elif name == b"referer":
+                referrer = value
+        self.record_click(short_code, link.id, link.expires_at, client[0] if client else "", user_agent.decode("latin-1"), referrer.decode("latin-1"))
+        # same status and quoting as starlette's RedirectResponse
+        await send({
+            "type": "http.response.start",
+            "status": 307,
+            "headers": [
+                (b"location", quote(link.original_url, safe=":/%#?=@[]!$&'()*+,;").encode("latin-1")),
+                (b"content-length", b"0"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,71 @@
+import hashlib
+import math
+from .config import HLL_PRECISION
+
+
+SPARSE = 0x80
+
+
+def visitor_hash(client: str, user_agent: str):
+    digest = hashlib.blake2b(f"{client}\0{user_agent}".encode("utf-8", "replace"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class HyperLogLog:
+    # 2^precision one-byte registers, the standard error of count() is 1.04 / sqrt(2^precision)
+    # (3.25% at the default precision of 10); sketches of the same precision merge losslessly by register-wise max
+    def __init__(self, precision: int = HLL_PRECISION, registers: bytearray = None):
+        if not 4 <= precision <= 16:
+            raise ValueError("HyperLogLog precision must be between 4 and 16")
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.size)
+
+    def add(self, value: int):
+        # value is a uniformly distributed 64-bit hash
+        index = value >> (64 - self.precision)
+        rank = 64 - self.precision - (value & ((1 << (64 - self.precision)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        if other.precision != self.precision:
+            raise ValueError("Only sketches of the same precision can be merged")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size) if self.size >= 128 else {16: 0.673, 32: 0.697, 64: 0.709}[self.size]
+        estimate = alpha * self.size ** 2 / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            # linear counting is more accurate while many registers are still empty
+            estimate = self.size * math.log(self.size / zeros)
+        return round(estimate)
+
+    def to_bytes(self):
+        # small sketches are stored as (index, rank) pairs, 3 bytes per non-empty register
+        filled = [(index, rank) for index, rank in enumerate(self.registers) if rank]
+        if 3 * len(filled) < self.size:
+            return bytes([self.precision | SPARSE]) + b"".join(index.to_bytes(2, "big") + bytes([rank]) for index, rank in filled)
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        sketch = cls(data[0] & ~SPARSE)
+        if data[0] & SPARSE:
+            for offset in range(1, len(data), 3):
+                sketch.registers[int.from_bytes(data[offset:offset + 2], "big")] = data[offset + 2]
+        else:
+            sketch.registers[:] = data[1:]
+        return sketch
+
+    def copy(self):
+        return HyperLogLog(self.precision, bytearray(self.registers))
+
+    @classmethod
+    def union(cls, sketches):
+        merged = None
+        for sketch in sketches:
+            merged = sketch.copy() if merged is None else merged.merge(sketch)
+        return merged
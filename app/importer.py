@@ -0,0 +1,184 @@
+import csv
+import json
+import logging
+import time
+from datetime import datetime
+from pydantic import ValidationError
+from sqlalchemy import text
+from . import schemas
+from .bloom import short_code_filter
+from .short_codes import RESERVED_SHORT_CODES
+from .shards import shard_router, shard_session, taken_at_previous_locations
+from .urls import url_digest
+import pytz
+
+
+tz = pytz.timezone('Europe/Moscow')
+
+logger = logging.getLogger(__name__)
+
+IMPORT_FORMATS = ("csv", "ndjson")
+STAGING_COLUMNS = ["original_url", "short_code", "expires_at", "is_custom", "url_digest"]
+SHORT_CODE_MERGE_ATTEMPTS = 5
+
+
+async def iter_lines(byte_chunks, encoding="utf-8"):
+    # splits a stream of byte chunks into lines without holding more than one partial line in memory
+    remainder = b""
+    async for chunk in byte_chunks:
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            yield line.decode(encoding).rstrip("\r")
+    if remainder:
+        yield remainder.decode(encoding).rstrip("\r")
+
+
+def parse_line(line: str, fmt: str, header):
+    if fmt == "ndjson":
+        data = json.loads(line)
+        if not isinstance(data, dict):
+            raise ValueError("NDJSON rows must be objects")
+    else:
+        data = dict(zip(header, next(csv.reader([line]))))
+    data = {key: value for key, value in data.items() if value not in (None, "")}
+    link = schemas.LinkCreate(**data)
+    if link.custom_alias in RESERVED_SHORT_CODES:
+        raise ValueError("Short code is reserved")
+    return link
+
+
+class ImportProgress:
+    def __init__(self, offset: int):
+        self.started_at = time.perf_counter()
+        self.offset = offset
+        self.rows_read = 0
+        self.imported = 0
+        self.conflicts = 0
+        self.invalid = 0
+
+    def as_dict(self):
+        elapsed = time.perf_counter() - self.started_at
+        return {
+            "offset": self.offset,
+            "rows_read": self.rows_read,
+            "imported": self.imported,
+            "conflicts": self.conflicts,
+            "invalid": self.invalid,
+            "elapsed": round(elapsed, 3),
+            "rows_per_sec": round(self.rows_read / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+async def copy_to_staging(db, records):
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        "link_import_staging", records=records, columns=STAGING_COLUMNS
+    )
+
+
+async def insert_staged(db, records, created_at, user_id):
+    # the staging table is per connection, so it is created after code generation, which may commit
+    await db.execute(text(
+        "CREATE TEMP TABLE IF NOT EXISTS link_import_staging "
+        "(original_url varchar NOT NULL, short_code varchar NOT NULL, expires_at timestamp, is_custom boolean NOT NULL, url_digest bytea) "
+        "ON COMMIT DELETE ROWS"
+    ))
+    await copy_to_staging(db, records)
+    # rows with a taken code are skipped by the links_claim_short_code trigger and missing from RETURNING
+    inserted = set((await db.execute(text(
+        "INSERT INTO links (original_url, short_code, created_at, expires_at, access_count, url_digest, user_id) "
+        "SELECT original_url, short_code, :created_at, expires_at, 0, url_digest, :user_id FROM link_import_staging "
+        "RETURNING short_code"
+    ), {"created_at": created_at, "user_id": user_id})).scalars())
+    await db.execute(text("TRUNCATE link_import_staging"))
+    return inserted
+
+
+async def insert_records(db, records, created_at, user_id=None):
+    # every record goes to the shard of its short code, db is the main database and shard 0
+    taken = await taken_at_previous_locations(db, [record[1] for record in records])
+    inserted = set()
+    for shard, shard_records in shard_router.group([record for record in records if record[1] not in taken], key=lambda record: record[1]).items():
+        if shard == 0:
+            inserted |= await insert_staged(db, shard_records, created_at, user_id)
+        else:
+            async with shard_session(shard) as shard_db:
+                inserted |= await insert_staged(shard_db, shard_records, created_at, user_id)
+                await shard_db.commit()
+    return inserted
+
+
+async def merge_chunk(repository, links, created_at, progress: ImportProgress, user_id=None):
+    # repository is a LinkRepository, on postgres it stages every chunk through COPY with insert_records
+    if not links:
+        return
+
+    for attempt in range(SHORT_CODE_MERGE_ATTEMPTS):
+        records = []
+        for link in links:
+            short_code = link.custom_alias or await repository.next_short_code()
+            records.append((link.original_url, short_code, link.expires_at, bool(link.custom_alias), url_digest(link.original_url)))
+
+        inserted = await repository.import_records(records, created_at, user_id)
+
+        progress.imported += len(inserted)
+        short_code_filter.add(*inserted)
+        retry = []
+        for link, record in zip(links, records):
+            if record[1] in inserted:
+                inserted.discard(record[1])
+            elif link.custom_alias:
+                progress.conflicts += 1
+            else:
+                retry.append(link)
+        links = retry
+        if not links:
+            break
+
+    progress.conflicts += len(links)
+
+
+async def import_links(repository, lines, fmt: str, offset: int = 0, chunk_size: int = 10000, on_progress=None, user_id=None):
+    # user_id is the owner of the imported links, the command line import leaves it empty
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f"Unknown import format: {fmt}")
+
+    created_at = datetime.strptime(datetime.now(tz).strftime("%Y-%m-%d %H:%M"), "%Y-%m-%d %H:%M")
+    progress = ImportProgress(offset)
+    header = None
+    position = 0
+    chunk = []
+
+    async for line in lines:
+        if not line.strip():
+            continue
+        if fmt == "csv" and header is None:
+            header = next(csv.reader([line]))
+            continue
+
+        position += 1
+        if position <= offset:
+            continue
+
+        progress.rows_read += 1
+        try:
+            chunk.append(parse_line(line, fmt, header))
+        except (ValueError, ValidationError, csv.Error):
+            progress.invalid += 1
+
+        if progress.rows_read % chunk_size == 0:
+            await merge_chunk(repository, chunk, created_at, progress, user_id)
+            progress.offset = position
+            chunk = []
+            if on_progress is not None:
+                on_progress(progress.as_dict())
+
+    if chunk:
+        await merge_chunk(repository, chunk, created_at, progress, user_id)
+    progress.offset = position
+    if on_progress is not None:
+        on_progress(progress.as_dict())
+
+    return progress.as_dict()
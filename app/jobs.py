@@ -0,0 +1,86 @@
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+
+class Job:
+    def __init__(self, name: str, params: dict):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.params = params
+        self.status = "pending"
+        self.rows_deleted = 0
+        self.message = None
+        self.error = None
+        self.created_at = datetime.now(timezone.utc)
+        self.finished_at = None
+
+    def start(self):
+        self.status = "running"
+
+    def finish(self, message: str):
+        self.status = "finished"
+        self.message = message
+        self.finished_at = datetime.now(timezone.utc)
+
+    def fail(self, error: str):
+        self.status = "failed"
+        self.error = error
+        self.finished_at = datetime.now(timezone.utc)
+
+    @classmethod
+    def from_row(cls, row):
+        job = cls(row.name, row.params)
+        job.id = row.id
+        job.status = row.status
+        job.rows_deleted = row.rows_deleted
+        job.message = row.message
+        job.error = row.error
+        job.created_at = row.created_at
+        job.finished_at = row.finished_at
+        return job
+
+    def as_row(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "params": self.params,
+            "status": self.status,
+            "rows_deleted": self.rows_deleted,
+            "message": self.message,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+    def as_dict(self):
+        return {
+            "job_id": self.id,
+            "name": self.name,
+            "params": self.params,
+            "status": self.status,
+            "rows_deleted": self.rows_deleted,
+            "message": self.message,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at is not None else None,
+        }
+
+
+class JobRegistry:
+    # keeps the most recent jobs of this worker, older ones are forgotten; the embedded stores run in one
+    # process and keep their jobs here, the postgres one in the jobs table
+    def __init__(self, max_jobs: int = 100):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+
+    def save(self, job: Job):
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.max_jobs:
+            self._jobs.popitem(last=False)
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+
+jobs = JobRegistry()
@@ -1,56 +1,290 @@
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_
+from fastapi import FastAPI, Depends, HTTPException, Request, Query, BackgroundTasks
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from .database import SessionLocal, engine
-from . import models, schemas, auth, hash
+from . import models, schemas, auth, hash, importer, database
+from .cache import link_cache
+from .clicks import click_buffer
+from .hll import HyperLogLog, visitor_hash
+from .jobs import Job
+from .expiry import expiry_scheduler
+from .urls import url_digest
+from .fast_redirect import FastRedirectMiddleware, NOT_FOUND
+from .bloom import short_code_filter
+from .singleflight import link_lookups
+from .top_links import top_links, merge_summaries
+from .click_log import click_log
+from .metrics import metrics, MetricsMiddleware
+from .replica import ReadYourWritesMiddleware, reads_from_primary, recent_writes
+from .shards import shard_router
+from .partitions import link_partitions
+from .short_codes import RESERVED_SHORT_CODES
+from .repositories import create_repositories
+from contextlib import asynccontextmanager
+import asyncio
+import json
+import logging
 import string
+import time
 import random
 from datetime import datetime, timezone, timedelta
-from fastapi.responses import RedirectResponse
-from .config import SECRET, ALG
-from jose import JWTError, jwt
+from typing import List, Optional
+from fastapi.responses import RedirectResponse, StreamingResponse, PlainTextResponse
+from .config import (
+    SECRET, ALG, CLICK_FLUSH_INTERVAL, CLICK_HOURLY_RETENTION_DAYS, CLICK_COMPACT_INTERVAL, SHORT_CODE_LENGTH, SHORTEN_BATCH_MAX_SIZE, IMPORT_CHUNK_SIZE,
+    REMOVE_UNUSED_LINKS_BATCH_SIZE, REMOVE_UNUSED_LINKS_BATCH_PAUSE,
+    EXPIRY_SWEEP_INTERVAL, EXPIRY_HORIZON_HOURS, EXPIRED_LINKS_RETENTION_DAYS, EXPIRED_LINKS_PURGE_INTERVAL,
+    DEDUPLICATE_LINKS, FAST_REDIRECT, TOP_LINKS_CAPACITY, TOP_LINKS_PUBLISH_INTERVAL, TOP_LINKS_PREWARM,
+    CLICK_LOG, CLICK_LOG_FLUSH_INTERVAL, CLICK_LOG_INGEST_INTERVAL, METRICS, STORAGE_BACKEND, DB_REPLICA_HOST, READ_YOUR_WRITES_SECONDS, SHORT_CODE_FILTER, SHORT_CODE_FILTER_REFRESH_INTERVAL, SHORT_CODE_FILTER_REBUILD_INTERVAL,
+)
+from jose import JWTError
 import pytz
 
 
 tz = pytz.timezone('Europe/Moscow')
 
+logger = logging.getLogger(__name__)
+
 SECRET_KEY = SECRET
 ALGORITHM = ALG
 
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 INACTIVITY_DAYS = 30
+SHORT_CODE_INSERT_ATTEMPTS = 5
 
-models.Base.metadata.create_all(bind=engine)
+async def get_db():
+    async with database.AsyncSessionLocal() as db:
+        yield db
 
-app = FastAPI()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+async def get_replica_db():
+    async with database.ReplicaSessionLocal() as db:
+        yield db
 
 
-def get_db():
-    db = SessionLocal()
+def replica_enabled():
+    return bool(DB_REPLICA_HOST) or get_replica_db in app.dependency_overrides
+
+
+@asynccontextmanager
+async def session_scope(read_only: bool = False):
+    # background jobs open sessions through get_db, so dependency overrides apply to them too
+    dependency = get_replica_db if read_only and replica_enabled() else get_db
+    sessions = app.dependency_overrides.get(dependency, dependency)()
     try:
-        yield db
+        yield await sessions.__anext__()
     finally:
-        db.close()
+        await sessions.aclose()
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# every query goes through these, see app/repositories.py
+link_repository, user_repository = create_repositories(STORAGE_BACKEND, session_scope)
+
+
+async def flush_clicks_periodically():
+    while True:
+        await asyncio.sleep(CLICK_FLUSH_INTERVAL)
+        try:
+            await link_repository.flush_clicks(click_buffer)
+        except Exception:
+            logger.exception("Failed to flush clicks")
+
+
+async def write_click_log_periodically():
+    while True:
+        await asyncio.sleep(CLICK_LOG_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(click_log.write, click_log.take())
+        except Exception:
+            logger.exception("Failed to write click log")
+
+
+async def ingest_click_log_periodically():
+    while True:
+        await asyncio.sleep(CLICK_LOG_INGEST_INTERVAL)
+        try:
+            await link_repository.ingest_click_log(click_log)
+        except Exception:
+            logger.exception("Failed to ingest click log")
+
+
+def hourly_clicks_cutoff():
+    return (current_minute() - timedelta(days=CLICK_HOURLY_RETENTION_DAYS)).replace(hour=0, minute=0)
+
+
+async def compact_click_buckets_periodically():
+    while True:
+        try:
+            await link_repository.compact_clicks(current_minute().replace(minute=0), hourly_clicks_cutoff())
+        except Exception:
+            logger.exception("Failed to compact click buckets")
+        await asyncio.sleep(CLICK_COMPACT_INTERVAL)
+
+
+def current_time():
+    return datetime.now(tz).replace(tzinfo=None)
+
+
+async def publish_top_links():
+    now = current_time()
+    # rows of workers that stopped without cleaning up are removed along the way
+    await link_repository.publish_top_links(top_links.worker_id, top_links.snapshot(), now, now - timedelta(seconds=10 * TOP_LINKS_PUBLISH_INTERVAL))
+
+
+async def load_top_links(window: str, limit: int):
+    # other workers are read from their last published snapshot, this one from memory
+    snapshots = await link_repository.top_links_snapshots(top_links.worker_id, current_time() - timedelta(seconds=3 * TOP_LINKS_PUBLISH_INTERVAL))
+    summaries = [snapshot[window] for snapshot in snapshots] + [top_links.snapshot()[window]]
+    return merge_summaries(summaries, limit), len(summaries)
+
+
+async def prewarm_link_cache(short_codes):
+    missing = [short_code for short_code in short_codes if short_code not in link_cache and short_code not in expiry_scheduler]
+    if not missing:
+        return 0
+    links = await link_repository.get_many(missing)
+    now = current_minute()
+    warmed = 0
+    for link in links:
+        expiry_scheduler.add(link.short_code, link.expires_at, now)
+        if link.expires_at is None or link.expires_at >= now:
+            link_cache.put(link.short_code, link.id, normalize_redirect_url(link.original_url), link.expires_at)
+            warmed += 1
+    return warmed
+
+
+async def publish_top_links_periodically():
+    while True:
+        await asyncio.sleep(TOP_LINKS_PUBLISH_INTERVAL)
+        try:
+            await publish_top_links()
+            if TOP_LINKS_PREWARM:
+                # links that are hot on any worker are loaded here before the first request for them misses
+                top, _ = await load_top_links("minute", TOP_LINKS_PREWARM)
+                await prewarm_link_cache(top["items"])
+        except Exception:
+            logger.exception("Failed to publish top links")
+
+
+async def sweep_expired_links(purge: bool = False):
+    now = current_minute()
+    horizon = now + timedelta(hours=EXPIRY_HORIZON_HOURS)
+    if expiry_scheduler.loaded_until is None or expiry_scheduler.loaded_until < now + (horizon - now) / 2:
+        async for short_code, expires_at in link_repository.upcoming_expiries(expiry_scheduler.loaded_until or now, horizon):
+            expiry_scheduler.schedule(short_code, expires_at)
+        expiry_scheduler.loaded_until = horizon
+
+    link_cache.invalidate(*expiry_scheduler.pop_due(now))
+
+    if purge:
+        def forget_links(short_codes):
+            link_cache.invalidate(*short_codes)
+            expiry_scheduler.forget(*short_codes)
+
+        # on postgres this also attaches the partitions of the coming months
+        before = now - timedelta(days=EXPIRED_LINKS_RETENTION_DAYS) if EXPIRED_LINKS_RETENTION_DAYS is not None else None
+        purged = await link_repository.purge_expired(before, forget_links)
+        if purged:
+            logger.info("Purged %s expired links", purged)
+
+
+async def sweep_expired_links_periodically():
+    # the first purge runs at startup, before requests are served
+    next_purge = time.monotonic() + EXPIRED_LINKS_PURGE_INTERVAL
+    while True:
+        purge = time.monotonic() >= next_purge
+        if purge:
+            next_purge = time.monotonic() + EXPIRED_LINKS_PURGE_INTERVAL
+        try:
+            await sweep_expired_links(purge)
+        except Exception:
+            logger.exception("Failed to sweep expired links")
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
+
+
+async def refresh_short_code_filter_periodically():
+    while True:
+        try:
+            rebuild = short_code_filter.needs_rebuild() or time.monotonic() - short_code_filter.built_at > SHORT_CODE_FILTER_REBUILD_INTERVAL
+            await link_repository.refresh_short_code_filter(short_code_filter, rebuild)
+        except Exception:
+            logger.exception("Failed to refresh the short code filter")
+        await asyncio.sleep(SHORT_CODE_FILTER_REFRESH_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await link_repository.prepare()
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        user = db.query(models.User).filter(models.User.username == username).first()
-        if user is None:
-            raise HTTPException(status_code=401, detail="Not authorized")
-        return user
+        await sweep_expired_links(purge=True)
+    except Exception:
+        logger.exception("Failed to sweep expired links")
+    click_flusher = asyncio.create_task(flush_clicks_periodically())
+    expiry_sweeper = asyncio.create_task(sweep_expired_links_periodically())
+    filter_refresher = asyncio.create_task(refresh_short_code_filter_periodically()) if SHORT_CODE_FILTER else None
+    click_compactor = asyncio.create_task(compact_click_buckets_periodically())
+    top_links_publisher = asyncio.create_task(publish_top_links_periodically())
+    if CLICK_LOG:
+        click_log.open()
+        click_log_writer = asyncio.create_task(write_click_log_periodically())
+        click_log_ingester = asyncio.create_task(ingest_click_log_periodically())
+    yield
+    if CLICK_LOG:
+        click_log_ingester.cancel()
+        click_log_writer.cancel()
+        # the last segment is sealed and left for the next start to ingest
+        click_log.write(click_log.take())
+        click_log.seal()
+    top_links_publisher.cancel()
+    click_compactor.cancel()
+    if filter_refresher is not None:
+        filter_refresher.cancel()
+    expiry_sweeper.cancel()
+    click_flusher.cancel()
+    await link_repository.flush_clicks(click_buffer)
+    await link_repository.forget_top_links(top_links.worker_id)
+    await link_repository.close()
+    hash.password_hasher.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
 
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    try:
+        username = auth.decode_access_token(token)
     except JWTError:
         raise HTTPException(status_code=401, detail="Not authorized")
 
+    if username is None:
+        raise HTTPException(status_code=401, detail="Not authorized")
+
+    cached = auth.principal_cache.get_user(username)
+    if cached is None:
+        user = await user_repository.get(username)
+        if user is None:
+            raise HTTPException(status_code=401, detail="Not authorized")
+        cached = auth.principal_cache.put_user(user)
+
+    # a detached snapshot, handlers only need the identity of the caller
+    return models.User(id=cached.id, username=cached.username, email=cached.email)
+
+
+def current_minute():
+    return datetime.strptime(datetime.now(tz).strftime("%Y-%m-%d %H:%M"), "%Y-%m-%d %H:%M")
+
+
+def normalize_redirect_url(original_url: str):
+    if ((original_url[:8] != 'https://') and (original_url[:7] != 'http://')):
+        original_url = 'http://' + original_url
+    return original_url
+
 
 def generate_link_short_code():
-    return ''.join(random.choice(string.ascii_letters + string.digits) for i in range(6))
+    while True:
+        short_code = ''.join(random.choice(string.ascii_letters + string.digits) for i in range(SHORT_CODE_LENGTH))
+        if short_code not in RESERVED_SHORT_CODES:
+            return short_code
 
 
 @app.get("/")
@@ -59,176 +293,502 @@ async def root_message():
 
 
 @app.post("/register")
-async def register(user: schemas.User, db: Session = Depends(get_db)):
-    user_in_db = db.query(models.User).filter(models.User.username == user.username).first()
-    if user_in_db:
+async def register(user: schemas.User):
+    # no connection is held while bcrypt runs
+    if await user_repository.get(user.username):
         raise HTTPException(status_code=400, detail="User with this username already exist")
 
-    hashed_password = hash.hash_password(user.password)
-    created_user = models.User(username=user.username, email=user.email, password=hashed_password)
-
-    db.add(created_user)
-    db.commit()
-    db.refresh(created_user)
+    try:
+        hashed_password = await hash.password_hasher.hash(user.password)
+    except hash.PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Too many password operations, try again later", headers={"Retry-After": "1"})
+    created_user = await user_repository.create(user.username, user.email, hashed_password)
+    auth.principal_cache.invalidate_user(created_user.username)
 
     return {"message": "User created successfully"}
 
 
 @app.post("/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.username == form_data.username).first()
+async def login(form_data: OAuth2PasswordRequestForm = Depends()):
+    user = await user_repository.get(form_data.username)
     if not user:
         raise HTTPException(status_code=401, detail="Not authorized")
 
-    password_is_correct = hash.verify_password(form_data.password, user.password)
+    try:
+        password_is_correct, new_hash = await hash.password_hasher.verify_and_update(form_data.password, user.password)
+    except hash.PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Too many password operations, try again later", headers={"Retry-After": "1"})
     if not password_is_correct:
         raise HTTPException(status_code=401, detail="Not authorized")
 
+    if new_hash is not None:
+        await user_repository.set_password(user.username, new_hash)
+
     access_token = auth.create_access_token(user.username)
     return {"access_token": access_token}
 
 
+async def next_unseen_short_code():
+    # a candidate the filter has never seen is certainly free, a seen one is skipped instead of failing an insert
+    for attempt in range(SHORT_CODE_INSERT_ATTEMPTS):
+        short_code = await link_repository.next_short_code()
+        if not short_code_filter.ready or short_code not in short_code_filter:
+            return short_code
+        short_code_filter.skipped_candidates += 1
+    return short_code
+
+
 @app.post("/links/shorten")
-async def shorten_link(link_create: schemas.LinkCreate, db: Session = Depends(get_db)):
-    if link_create.custom_alias:
-        short_code = link_create.custom_alias
-        link = db.query(models.Link).filter(models.Link.short_code == short_code).first()
-        if link is not None:
+async def shorten_link(link_create: schemas.LinkCreate):
+    expires_at = link_create.expires_at
+    original_url = link_create.original_url
+    original_url_digest = url_digest(original_url)
+    if link_create.custom_alias in RESERVED_SHORT_CODES:
+        raise HTTPException(status_code=400, detail="Short code is reserved")
+
+    if DEDUPLICATE_LINKS and not link_create.custom_alias:
+        existing_short_code = await link_repository.find_duplicate(original_url_digest, expires_at)
+        if existing_short_code is not None:
+            return {"message" : "Link successfully created", "original_url" : original_url, "short_code": existing_short_code}
+
+    # uniqueness is enforced by the store, a conflict only costs a retry
+    for attempt in range(SHORT_CODE_INSERT_ATTEMPTS):
+        short_code = link_create.custom_alias or await next_unseen_short_code()
+        inserted = await link_repository.insert([{
+            "original_url": original_url,
+            "short_code": short_code,
+            "created_at": current_minute(),
+            "expires_at": expires_at,
+            "access_count": 0,
+            "url_digest": original_url_digest,
+        }])
+        if inserted:
+            break
+        if link_create.custom_alias:
             raise HTTPException(status_code=400, detail="Short code already exist")
     else:
-        short_code = generate_link_short_code()
-        link = db.query(models.Link).filter(models.Link.short_code == short_code).first()
-        while link is not None:
-            short_code = generate_link_short_code()
-            link = db.query(models.Link).filter(models.Link.short_code == short_code).first()
+        raise HTTPException(status_code=503, detail="Could not generate a unique short code")
 
-    expires_at = link_create.expires_at
-    original_url = link_create.original_url
+    short_code_filter.add(short_code)
+    expiry_scheduler.add(short_code, expires_at, current_minute())
 
-    link_with_short_code = models.Link(
-        original_url=original_url,
-        short_code=short_code,
-        created_at=datetime.strptime(datetime.now(tz).strftime("%Y-%m-%d %H:%M"), "%Y-%m-%d %H:%M"),
-        expires_at=expires_at
-    )
+    return {"message" : "Link successfully created", "original_url" : original_url, "short_code": short_code}
 
-    db.add(link_with_short_code)
-    db.commit()
-    db.refresh(link_with_short_code)
 
-    return {"message" : "Link successfully created", "original_url" : original_url, "short_code": short_code}
+@app.post("/links/shorten/batch")
+async def shorten_links_batch(links_create: List[schemas.LinkCreate]):
+    if len(links_create) > SHORTEN_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch size is limited to {SHORTEN_BATCH_MAX_SIZE} links")
+
+    custom_aliases = {link_create.custom_alias for link_create in links_create if link_create.custom_alias}
+    taken_aliases = await link_repository.taken_short_codes(custom_aliases) if custom_aliases else set()
+
+    results = [None] * len(links_create)
+    pending = {}
+    for index, link_create in enumerate(links_create):
+        if link_create.custom_alias:
+            if link_create.custom_alias in RESERVED_SHORT_CODES:
+                results[index] = {"detail": "Short code is reserved", "original_url": link_create.original_url, "short_code": link_create.custom_alias}
+                continue
+            if link_create.custom_alias in taken_aliases:
+                results[index] = {"detail": "Short code already exist", "original_url": link_create.original_url, "short_code": link_create.custom_alias}
+                continue
+            taken_aliases.add(link_create.custom_alias)
+        pending[index] = link_create
+
+    created_at = current_minute()
+    for attempt in range(SHORT_CODE_INSERT_ATTEMPTS):
+        if not pending:
+            break
+
+        short_codes = {}
+        for index, link_create in pending.items():
+            short_code = link_create.custom_alias or await next_unseen_short_code()
+            short_codes.setdefault(short_code, index)
+
+        inserted_short_codes = await link_repository.insert([
+            {
+                "original_url": pending[index].original_url,
+                "short_code": short_code,
+                "created_at": created_at,
+                "expires_at": pending[index].expires_at,
+                "access_count": 0,
+                "url_digest": url_digest(pending[index].original_url),
+            }
+            for short_code, index in short_codes.items()
+        ])
 
+        for short_code, index in short_codes.items():
+            if short_code in inserted_short_codes:
+                short_code_filter.add(short_code)
+                expiry_scheduler.add(short_code, pending[index].expires_at, created_at)
+                results[index] = {"message": "Link successfully created", "original_url": pending.pop(index).original_url, "short_code": short_code}
+            elif pending[index].custom_alias:
+                results[index] = {"detail": "Short code already exist", "original_url": pending.pop(index).original_url, "short_code": short_code}
+
+    for index, link_create in pending.items():
+        results[index] = {"detail": "Could not generate a unique short code", "original_url": link_create.original_url, "short_code": None}
+
+    return results
+
+
+@app.post("/links/import")
+async def import_links_file(request: Request, format: str = "csv", offset: int = 0, current_user: models.User = Depends(get_current_user)):
+    if format not in importer.IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format must be one of: {', '.join(importer.IMPORT_FORMATS)}")
+
+    last_progress = {"offset": offset}
+
+    def report_progress(progress):
+        last_progress.update(progress)
+        logger.info("Link import progress: %s", progress)
+
+    try:
+        return await importer.import_links(
+            link_repository, importer.iter_lines(request.stream()), format,
+            offset=offset, chunk_size=IMPORT_CHUNK_SIZE, on_progress=report_progress, user_id=current_user.id,
+        )
+    except Exception:
+        logger.exception("Link import failed, it can be resumed from offset %s", last_progress["offset"])
+        raise HTTPException(status_code=500, detail={"message": "Import failed", "offset": last_progress["offset"]})
+
+
+def cache_stats():
+    return {"links": link_cache.stats(), "clicks": click_buffer.stats(), "expiry": expiry_scheduler.stats(), "auth": auth.principal_cache.stats(), "passwords": hash.password_hasher.stats(), "short_codes": short_code_filter.stats(), "lookups": link_lookups.stats(), "top_links": {"worker_id": top_links.worker_id, "clicks": top_links.clicks}, "click_log": click_log.stats(), "shards": {"count": shard_router.count, "previous_count": shard_router.previous_count or 0}, "partitions": link_partitions.stats()}
 
-@app.get("/links/{short_code}")
-async def redirect_link(short_code: str, db: Session = Depends(get_db)):
-    link = db.query(models.Link).filter(models.Link.short_code == short_code).first()
 
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return cache_stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(gauges=cache_stats()), media_type="text/plain; version=0.0.4")
+
+
+async def load_redirect_target(short_code: str):
+    read_only = replica_enabled() and short_code not in recent_writes
+    link = await link_repository.get_redirect_target(short_code, read_only)
+    if link is None and read_only:
+        # a link created moments ago may not have reached the replica yet
+        link = await link_repository.get_redirect_target(short_code, False)
     if link is None:
-        raise HTTPException(status_code=404, detail="Link not found")
+        short_code_filter.false_positives += short_code_filter.ready
+        return None
+
+    expiry_scheduler.add(short_code, link.expires_at, current_minute())
+    return link_cache.put(short_code, link.id, normalize_redirect_url(link.original_url), link.expires_at)
+
+
+async def refresh_short_code_filter():
+    await link_repository.refresh_short_code_filter(short_code_filter, False)
+
+
+async def fetch_redirect_target(short_code: str):
+    if not await short_code_filter.might_exist(short_code, refresh_short_code_filter):
+        return None
+    # concurrent cache misses for the same code share one query
+    return await link_lookups.do(("redirect", short_code), load_redirect_target, short_code)
+
+
+async def fast_redirect_lookup(short_code: str):
+    # known expired codes are answered by redirect_link, which also counts them
+    if short_code in expiry_scheduler:
+        return None
+    cached_link = link_cache.get(short_code)
+    if cached_link is None:
+        # unknown codes are left to redirect_link, which has the filter catch up before answering them
+        if short_code not in short_code_filter:
+            return None
+        cached_link = await fetch_redirect_target(short_code)
+        if cached_link is None:
+            return NOT_FOUND
+    return cached_link
+
+
+def record_redirect(short_code: str, link_id: int, expires_at, client: str, user_agent: str, referrer: str):
+    click_buffer.record(link_id, visitor_hash(client, user_agent), expires_at)
+    top_links.record(short_code)
+    if CLICK_LOG:
+        click_log.append(short_code, client, user_agent, referrer)
 
-    link.access_count += 1
-    link.last_accessed_at = datetime.strptime(datetime.now(tz).strftime("%Y-%m-%d %H:%M"), "%Y-%m-%d %H:%M")
-    db.commit()
 
-    if ((link.expires_at is not None) and (link.expires_at < datetime.strptime(datetime.now(tz).strftime("%Y-%m-%d %H:%M"), "%Y-%m-%d %H:%M"))):
+@app.get("/links/top")
+async def get_top_links(window: str = "minute", limit: int = Query(default=100, ge=1, le=TOP_LINKS_CAPACITY)):
+    if window not in top_links.windows:
+        raise HTTPException(status_code=400, detail="Window must be one of: minute, hour")
+
+    top, workers = await load_top_links(window, limit)
+    return {
+        "window": window,
+        "workers": workers,
+        "links": [{"short_code": short_code, "count": count, "error": error} for short_code, (count, error) in top["items"].items()],
+    }
+
+
+@app.get("/links/{short_code}")
+async def redirect_link(short_code: str, request: Request):
+    if expiry_scheduler.is_expired(short_code):
         raise HTTPException(status_code=400, detail="Link expired")
 
-    original_url = link.original_url
+    cached_link = link_cache.get(short_code)
+    if cached_link is None:
+        cached_link = await fetch_redirect_target(short_code)
+        if cached_link is None:
+            raise HTTPException(status_code=404, detail="Link not found")
 
-    if ((original_url[:8] != 'https://') and (original_url[:7] != 'http://')):
-        original_url = 'http://' + original_url
+    if ((cached_link.expires_at is not None) and (cached_link.expires_at < current_minute())):
+        link_cache.invalidate(short_code)
+        expiry_scheduler.mark_expired(short_code)
+        raise HTTPException(status_code=400, detail="Link expired")
 
-    return RedirectResponse(url=original_url)
+    record_redirect(short_code, cached_link.id, cached_link.expires_at, request.client.host if request.client else "", request.headers.get("user-agent", ""), request.headers.get("referer", ""))
+
+    return RedirectResponse(url=cached_link.original_url)
 
 
 @app.delete("/links/{short_code}")
-async def delete_link(short_code: str, current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    link = db.query(models.Link).filter(models.Link.short_code == short_code).first()
-    if link is None:
+async def delete_link(short_code: str, current_user: models.User = Depends(get_current_user)):
+    if not await link_repository.delete(short_code):
         raise HTTPException(status_code=404, detail="Link not found")
 
-    db.delete(link)
-    db.commit()
+    recent_writes.add(short_code)
+    link_cache.invalidate(short_code)
+    expiry_scheduler.forget(short_code)
 
     return {"message": "Link successfully deleted"}
 
 
 @app.put("/links/{short_code}")
-async def update_link(link_update_data: schemas.LinkUpdate, current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def update_link(link_update_data: schemas.LinkUpdate, current_user: models.User = Depends(get_current_user)):
     short_code_old = link_update_data.short_code_old
     short_code_new = link_update_data.short_code_new
+    if short_code_new in RESERVED_SHORT_CODES:
+        raise HTTPException(status_code=400, detail="Short code is reserved")
 
-    link = db.query(models.Link).filter(models.Link.short_code == short_code_old).first()
+    try:
+        link = await link_repository.rename(short_code_old, short_code_new)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Short code already exist")
     if link is None:
         raise HTTPException(status_code=404, detail="Link not found")
 
-    link.short_code = short_code_new
-    db.commit()
+    short_code_filter.add(short_code_new)
+    recent_writes.add(short_code_old, short_code_new)
+    link_cache.invalidate(short_code_old, short_code_new)
+    expiry_scheduler.forget(short_code_old, short_code_new)
+    expiry_scheduler.add(short_code_new, link.expires_at, current_minute())
+
+    return {"message" : "short_code updated successfully", "original_url" : link.original_url, "short_code" : short_code_new}
+
 
-    return {"message" : "short_code updated successfully", "original_url" : link.original_url, "short_code" : link.short_code}
+CLICK_GRANULARITIES = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+CLICK_DEFAULT_WINDOW = {"hour": timedelta(hours=47), "day": timedelta(days=29)}
+
+
+def truncate_bucket(moment: datetime, granularity: str):
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(tz).replace(tzinfo=None)
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0) if granularity == "day" else moment
+
+
+def merge_link_stats(link, stored_buckets, stored_sketches, granularity: Optional[str], since: Optional[datetime], until: Optional[datetime]):
+    # clicks still waiting in the buffer are added to what the store returned
+    pending_sketches = click_buffer.pending_sketches(link.id)
+    visitors = HyperLogLog.union(
+        ([HyperLogLog.from_bytes(link.visitors)] if link.visitors is not None else []) + list(pending_sketches.values())
+    )
+
+    buckets = None
+    if granularity is not None:
+        buckets = {bucket_start: [count, None] for bucket_start, count in stored_buckets.items()}
+        for hour, count in click_buffer.pending_buckets(link.id).items():
+            hour = truncate_bucket(hour, granularity)
+            if since <= hour <= until:
+                buckets.setdefault(hour, [0, None])[0] += count
+
+        sketches = [(hour, HyperLogLog.from_bytes(sketch)) for hour, sketch in stored_sketches] + list(pending_sketches.items())
+        for hour, sketch in sketches:
+            hour = truncate_bucket(hour, granularity)
+            if since <= hour <= until:
+                entry = buckets.setdefault(hour, [0, None])
+                entry[1] = sketch if entry[1] is None else entry[1].merge(sketch)
+
+    return link, click_buffer.pending(link.id), visitors, buckets
+
+
+async def load_link_stats(short_code: str, granularity: Optional[str] = None, since: Optional[datetime] = None, until: Optional[datetime] = None, read_only: bool = False):
+    # the buffer repeats a read that overlapped a flush, so flushed clicks are not counted twice or not at all
+    # (on a lagging replica a just-flushed batch can briefly be missing instead)
+    before = until + CLICK_GRANULARITIES[granularity] if granularity is not None else None
+    stored = await click_buffer.read_settled(lambda: link_repository.read_stats(short_code, granularity, since, before, read_only=read_only))
+    if stored is None:
+        return None
+    return merge_link_stats(*stored, granularity, since, until)
 
 
 @app.get("/links/{short_code}/stats")
-async def get_link_stats(short_code: str, db: Session = Depends(get_db)):
-    link = db.query(models.Link).filter(models.Link.short_code == short_code).first()
-    if link is None:
+async def get_link_stats(
+    short_code: str,
+    request: Request,
+    granularity: Optional[str] = None,
+    from_: Optional[datetime] = Query(default=None, alias="from"),
+    to: Optional[datetime] = None,
+):
+    since = until = None
+    if granularity is not None:
+        if granularity not in CLICK_GRANULARITIES:
+            raise HTTPException(status_code=400, detail="Granularity must be one of: hour, day")
+        until = truncate_bucket(to or current_minute(), granularity)
+        since = truncate_bucket(from_, granularity) if from_ is not None else until - CLICK_DEFAULT_WINDOW[granularity]
+        if since > until:
+            raise HTTPException(status_code=400, detail="from must not be later than to")
+
+    # requests that arrive while a lookup for the same code is running share its result
+    read_only = not reads_from_primary(request.cookies) and short_code not in recent_writes
+    snapshot = await link_lookups.do(("stats", short_code, granularity, since, until, read_only), load_link_stats, short_code, granularity, since, until, read_only)
+    if snapshot is None:
         raise HTTPException(status_code=404, detail="Link not found")
+    link, (pending_clicks, pending_accessed_at), visitors, buckets = snapshot
 
-    return {
+    access_count = (link.access_count or 0) + pending_clicks
+    last_accessed_at = link.last_accessed_at
+    if pending_accessed_at is not None and (last_accessed_at is None or pending_accessed_at > last_accessed_at):
+        last_accessed_at = pending_accessed_at
+
+    stats = {
         "original_url" : link.original_url,
         "short_code" : link.short_code,
         "created_at" : link.created_at.strftime("%Y-%m-%d %H:%M"),
-        "last_accessed_at" : link.last_accessed_at.strftime("%Y-%m-%d %H:%M") if link.last_accessed_at is not None else link.last_accessed_at,
+        "last_accessed_at" : last_accessed_at.strftime("%Y-%m-%d %H:%M") if last_accessed_at is not None else last_accessed_at,
         "expires_at": link.expires_at.strftime("%Y-%m-%d %H:%M") if link.expires_at is not None else link.expires_at,
-        "access_count" : link.access_count,
+        "access_count" : access_count,
+        "unique_visitors": visitors.count() if visitors is not None else 0,
     }
+    if granularity is not None:
+        stats["clicks"] = {
+            "granularity": granularity,
+            "from": since.strftime("%Y-%m-%d %H:%M"),
+            "to": until.strftime("%Y-%m-%d %H:%M"),
+            "buckets": [
+                {"bucket": bucket.strftime("%Y-%m-%d %H:%M"), "count": count, "unique_visitors": sketch.count() if sketch is not None else 0}
+                for bucket, (count, sketch) in sorted(buckets.items())
+            ],
+        }
+    return stats
 
 
 @app.get("/links/search/link")
-async def search_link(original_url: str, db: Session = Depends(get_db)):
-    link = db.query(models.Link).filter(models.Link.original_url == original_url).first()
-    if link is None:
+async def search_link(original_url: str, request: Request):
+    # clients that wrote moments ago keep reading from the primary until the replica has caught up
+    short_code = await link_repository.find_by_url(url_digest(original_url), read_only=not reads_from_primary(request.cookies))
+    if short_code is None:
         raise HTTPException(status_code=404, detail="Link not found")
 
-    return {"short_code": link.short_code}
+    return {"short_code": short_code}
 
 
-@app.delete("/links/remove_unused/links")
-async def remove_unused_links(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    unused_links = db.query(models.Link).filter(
-        or_(
-            models.Link.last_accessed_at.is_(None),
-            models.Link.last_accessed_at < datetime.strptime((datetime.now(tz) - timedelta(days=INACTIVITY_DAYS)).strftime("%Y-%m-%d %H:%M"), "%Y-%m-%d %H:%M")
-        )
-    ).all()
-    unused_links_ids = [link.id for link in unused_links]
+async def delete_unused_links_in_batches(job: Job, inactivity_days: int):
+    job.start()
+    await link_repository.save_job(job)
+    last_accessed_before = datetime.strptime((datetime.now(tz) - timedelta(days=inactivity_days)).strftime("%Y-%m-%d %H:%M"), "%Y-%m-%d %H:%M")
+
+    async def forget_links(deleted_short_codes):
+        recent_writes.add(*deleted_short_codes)
+        link_cache.invalidate(*deleted_short_codes)
+        expiry_scheduler.forget(*deleted_short_codes)
+        job.rows_deleted += len(deleted_short_codes)
+        await link_repository.save_job(job)
 
-    if unused_links_ids:
-        db.query(models.Link).filter(models.Link.id.in_(unused_links_ids)).delete(synchronize_session=False)
-        db.commit()
-        return {"message": f"Deleted {len(unused_links_ids)} unused links"}
+    try:
+        await link_repository.flush_clicks(click_buffer)
+        await link_repository.delete_unused(last_accessed_before, REMOVE_UNUSED_LINKS_BATCH_SIZE, REMOVE_UNUSED_LINKS_BATCH_PAUSE, forget_links)
+    except Exception as e:
+        logger.exception("Unused links removal failed")
+        job.fail(str(e))
     else:
-        return {"message": "There are no unused links"}
+        if job.rows_deleted:
+            job.finish(f"Deleted {job.rows_deleted} unused links")
+        else:
+            job.finish("There are no unused links")
+    await link_repository.save_job(job)
 
 
-@app.get("/links/expired/links", response_model=list)
-async def get_expired_links(db: Session = Depends(get_db)):
-    expired_links = db.query(models.Link).filter(
-        and_(
-            models.Link.expires_at.isnot(None),
-            models.Link.expires_at < datetime.strptime(datetime.now(tz).strftime("%Y-%m-%d %H:%M"), "%Y-%m-%d %H:%M"),
-        )
-    ).all()
+@app.delete("/links/remove_unused/links", status_code=202)
+async def remove_unused_links(background_tasks: BackgroundTasks, inactivity_days: int = Query(default=INACTIVITY_DAYS, ge=0), current_user: models.User = Depends(get_current_user)):
+    job = Job("remove_unused_links", {"inactivity_days": inactivity_days})
+    await link_repository.save_job(job)
+    background_tasks.add_task(delete_unused_links_in_batches, job, inactivity_days)
+
+    return {"message": "Unused links removal started", "job_id": job.id}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, current_user: models.User = Depends(get_current_user)):
+    job = await link_repository.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
 
-    expired_links_list = []
-    for expired_link in expired_links:
-        expired_links_list.append(
+    return job.as_dict()
+
+
+@app.get("/links/expired/links")
+async def get_expired_links(request: Request, after: Optional[int] = None, limit: Optional[int] = Query(default=None, ge=1), format: str = "json"):
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="Format must be one of: json, ndjson")
+
+    def dump_expired_link(expired_link):
+        return json.dumps(
             {
+                "id": expired_link.id,
                 "original_url": expired_link.original_url,
                 "short_code": expired_link.short_code,
                 "created_at": expired_link.created_at.strftime("%Y-%m-%d %H:%M"),
                 "expires_at": expired_link.expires_at.strftime("%Y-%m-%d %H:%M")
-            }
+            },
+            ensure_ascii=False,
         )
 
-    return expired_links_list
+    read_only = not reads_from_primary(request.cookies)
+
+    async def expired_link_batches():
+        # keyset pagination: clients pass the id of the last link they received as `after`; the store is read
+        # here rather than through Depends so that its session lives as long as the stream
+        async for batch in link_repository.expired_links(current_minute(), after, limit, read_only=read_only):
+            yield [dump_expired_link(expired_link) for expired_link in batch]
+
+    async def ndjson_body():
+        async for batch in expired_link_batches():
+            yield "\n".join(batch) + "\n"
+
+    async def json_body():
+        separator = "["
+        async for batch in expired_link_batches():
+            yield separator + ",".join(batch)
+            separator = ","
+        yield "[]" if separator == "[" else "]"
+
+    if format == "ndjson":
+        return StreamingResponse(ndjson_body(), media_type="application/x-ndjson")
+    return StreamingResponse(json_body(), media_type="application/json")
+
+
+if FAST_REDIRECT:
+    # added last so that every static /links/... route is already registered and never shadowed
+    app.add_middleware(
+        FastRedirectMiddleware,
+        lookup=fast_redirect_lookup,
+        record_click=record_redirect,
+        now=current_minute,
+        route=next(route for route in app.routes if getattr(route, "endpoint", None) is redirect_link),
+        reserved={route.path.split("/")[2] for route in app.routes if route.path.startswith("/links/") and route.path.count("/") == 2 and "{" not in route.path},
+    )
+
+if DB_REPLICA_HOST and READ_YOUR_WRITES_SECONDS > 0:
+    app.add_middleware(ReadYourWritesMiddleware, window=READ_YOUR_WRITES_SECONDS)
+
+if METRICS:
+    # outermost, so requests answered by the fast redirect path are measured too
+    app.add_middleware(MetricsMiddleware)
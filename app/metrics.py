@@ -0,0 +1,218 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# SQL time of the request being served, a list so that the engine events can add to it in place
+request_db_time = ContextVar("request_db_time", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metrics:
+    def __init__(self):
+        self.requests = {}
+        self.request_seconds = {}
+        self.request_db_seconds = {}
+        self.query_seconds = {}
+        self.pool_wait_seconds = {}
+        self.engines = {}
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float, db_seconds: float):
+        key = (method, route, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        key = (method, route)
+        histogram = self.request_seconds.get(key)
+        if histogram is None:
+            histogram = self.request_seconds[key] = Histogram()
+            self.request_db_seconds[key] = Histogram()
+        histogram.observe(seconds)
+        self.request_db_seconds[key].observe(db_seconds)
+
+    def observe_query(self, operation: str, seconds: float):
+        histogram = self.query_seconds.get(operation)
+        if histogram is None:
+            histogram = self.query_seconds[operation] = Histogram()
+        histogram.observe(seconds)
+        db_time = request_db_time.get()
+        if db_time is not None:
+            db_time[0] += seconds
+
+    def observe_pool_wait(self, pool: str, seconds: float):
+        histogram = self.pool_wait_seconds.get(pool)
+        if histogram is None:
+            histogram = self.pool_wait_seconds[pool] = Histogram()
+        histogram.observe(seconds)
+
+    def clear(self):
+        self.requests.clear()
+        self.request_seconds.clear()
+        self.request_db_seconds.clear()
+        self.query_seconds.clear()
+        self.pool_wait_seconds.clear()
+
+    def render(self, gauges=None):
+        lines = []
+
+        def counter(name, help_text, label_names, values):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{format_labels(label_names, labels)} {value}")
+
+        def histograms(name, help_text, label_names, values):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in sorted(values.items()):
+                labels = labels if isinstance(labels, tuple) else (labels,)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    le = 'le="%s"' % bound
+                    lines.append(f"{name}_bucket{format_labels(label_names, labels, le)} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(label_names, labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(label_names, labels)} {histogram.count}")
+
+        def gauge(name, help_text, label_names, values):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{format_labels(label_names, labels)} {value}")
+
+        counter("http_requests_total", "Requests by route and status.", ("method", "route", "status"), self.requests)
+        histograms("http_request_duration_seconds", "Time until the response body was sent.", ("method", "route"), self.request_seconds)
+        histograms("http_request_db_seconds", "SQL time spent while serving a request.", ("method", "route"), self.request_db_seconds)
+        histograms("db_query_duration_seconds", "SQL statements by their first keyword, COMMIT included.", ("operation",), self.query_seconds)
+        histograms("db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection.", ("pool",), self.pool_wait_seconds)
+        # read from the engine because dispose() replaces its pool; NullPool keeps no counts
+        pools = {(name,): engine.pool for name, engine in self.engines.items() if hasattr(engine.pool, "checkedout")}
+        gauge("db_pool_connections_in_use", "Connections checked out of the pool.", ("pool",), {name: pool.checkedout() for name, pool in pools.items()})
+        gauge("db_pool_connections_idle", "Connections idle in the pool.", ("pool",), {name: pool.checkedin() for name, pool in pools.items()})
+        for group, stats in (gauges or {}).items():
+            for key, value in stats.items():
+                if type(value) in (int, float):
+                    gauge(f"{group}_{key}", f"{key} of {group}, as in /cache/stats.", (), {(): value})
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class CheckoutTimingMixin:
+    # waiting for a free connection (or opening an overflow one) happens in _do_get, which has no pool event
+    metrics_name = "default"
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics_name = self.metrics_name
+        return pool
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.observe_pool_wait(self.metrics_name, time.perf_counter() - started)
+
+
+class TimedQueuePool(CheckoutTimingMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(CheckoutTimingMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def statement_operation(statement: str):
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+
+
+def instrument_engine(engine, name: str):
+    engine = getattr(engine, "sync_engine", engine)
+    metrics.engines[name] = engine
+    engine.pool.metrics_name = name
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        metrics.observe_query(statement_operation(statement), time.perf_counter() - conn.info["query_started"].pop())
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            metrics.observe_query("ERROR", time.perf_counter() - started.pop())
+
+    # commits go straight to the driver without a cursor event, so the dialect call is timed instead
+    do_commit = engine.dialect.do_commit
+
+    def timed_do_commit(dbapi_connection):
+        started = time.perf_counter()
+        try:
+            do_commit(dbapi_connection)
+        finally:
+            metrics.observe_query("COMMIT", time.perf_counter() - started)
+
+    engine.dialect.do_commit = timed_do_commit
+    return engine
+
+
+class MetricsMiddleware:
+    # outermost middleware, so the fast redirect path is measured as well; the latency ends with the last
+    # body message, before any background task the endpoint scheduled
+    def __init__(self, app, metrics: Metrics = metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        response = [500, None]
+        db_time = [0.0]
+        token = request_db_time.set(db_time)
+
+        async def send_and_observe(message):
+            if message["type"] == "http.response.start":
+                response[0] = message["status"]
+            elif not message.get("more_body", False):
+                response[1] = time.perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_observe)
+        finally:
+            request_db_time.reset(token)
+            route = scope.get("route")
+            finished = response[1] if response[1] is not None else time.perf_counter()
+            self.metrics.observe_request(scope["method"], route.path if route is not None else "unmatched", response[0], finished - started, db_time[0])
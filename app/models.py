@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Sequence, LargeBinary, Index, JSON, DDL, event, func, literal, literal_column, select
 from sqlalchemy.orm import relationship
 from .database import Base
 import pytz
@@ -15,13 +15,193 @@ class User(Base):
     password = Column(String)
 
 
+links_id_seq = Sequence('links_id_seq', metadata=Base.metadata)
+
+# links are range partitioned by expiry, one partition per month, and links that never expire sort after every
+# date into links_never; there is no default partition, so attaching a month never locks the big one
+LINK_PARTITION_KEY = "coalesce(expires_at, 'infinity'::timestamp)"
+
+
 class Link(Base):
     __tablename__ = 'links'
+    __table_args__ = (
+        Index('ix_links_short_code', 'short_code'),
+        Index('ix_links_expires_at', 'expires_at', postgresql_where=literal_column('expires_at IS NOT NULL')),
+        {'postgresql_partition_by': f'RANGE (({LINK_PARTITION_KEY}))'},
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    # a partitioned table cannot have a primary key or unique constraint without the partition key, ids come
+    # from the sequence and short codes are kept unique by link_short_codes
+    id = Column(BigInteger, links_id_seq, server_default=links_id_seq.next_value(), nullable=False, index=True)
     original_url = Column(String, nullable=False)
-    short_code = Column(String, unique=True, nullable=False)
+    short_code = Column(String, nullable=False)
     created_at = Column(DateTime)
     last_accessed_at = Column(DateTime, nullable=True)
     access_count = Column(Integer, default=0)
-    expires_at = Column(DateTime, nullable=True)
\ No newline at end of file
+    expires_at = Column(DateTime, nullable=True)
+    url_digest = Column(LargeBinary, nullable=True, index=True)
+    visitors = Column(LargeBinary, nullable=True)
+    # the user who imported the link; no foreign key, the other shards have no users table
+    user_id = Column(Integer, nullable=True)
+
+    __mapper_args__ = {'primary_key': [id]}
+
+
+# the same expression as the partition key, so filters on it prune partitions
+link_expiry = func.coalesce(Link.expires_at, literal_column("'infinity'::timestamp"))
+
+
+link_short_codes_claim_seq = Sequence('link_short_codes_claim_seq', metadata=Base.metadata)
+
+
+class LinkShortCode(Base):
+    __tablename__ = 'link_short_codes'
+
+    short_code = Column(String, primary_key=True)
+    link_id = Column(BigInteger, nullable=False)
+    # copied from the link by the triggers, so a lookup by code knows which partition holds the row
+    expires_at = Column(DateTime, nullable=True)
+    # every claim takes the next number, a rename too since it claims the new code; the short code filter
+    # reads the codes claimed after the last number it has seen
+    claim_id = Column(BigInteger, link_short_codes_claim_seq, server_default=link_short_codes_claim_seq.next_value(), nullable=False, index=True)
+
+
+# the partition key of the link that holds a code
+short_code_expiry = func.coalesce(LinkShortCode.expires_at, literal_column("'infinity'::timestamp"))
+
+
+def link_partition_of(short_code):
+    # a lookup by code alone probes ix_links_short_code in every partition; compared to the key kept in the
+    # registry, the partitions are pruned down to one when the statement runs
+    return link_expiry == select(short_code_expiry).where(LinkShortCode.short_code == short_code).scalar_subquery()
+
+
+def link_partitions_of(expiries):
+    # the partitions of links with these expires_at values; given as constants, the planner drops the others
+    # where a lookup by id alone would probe ix_links_id of every partition
+    return link_expiry.in_([
+        literal_column("'infinity'::timestamp") if expires_at is None else literal(expires_at, DateTime)
+        for expires_at in set(expiries)
+    ])
+
+
+class LinkClickBucket(Base):
+    __tablename__ = 'link_click_buckets'
+
+    # no foreign key, links is partitioned; rows of deleted links are removed by the links_release trigger
+    link_id = Column(BigInteger, primary_key=True)
+    granularity = Column(String(4), primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class LinkVisitorSketch(Base):
+    __tablename__ = 'link_visitor_sketches'
+
+    id = Column(BigInteger, primary_key=True)
+    link_id = Column(BigInteger, nullable=False)
+    granularity = Column(String(4), nullable=False)
+    bucket = Column(DateTime, nullable=False)
+    sketch = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (Index('ix_link_visitor_sketches_link_id_bucket', 'link_id', 'bucket'),)
+
+
+# a code is claimed in link_short_codes before its row is inserted; a taken code skips the row like
+# ON CONFLICT DO NOTHING would, so inserts read the codes they got back from RETURNING
+LINK_TRIGGERS = [
+    """
+    CREATE OR REPLACE FUNCTION links_claim_short_code() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO link_short_codes (short_code, link_id, expires_at) VALUES (NEW.short_code, NEW.id, NEW.expires_at) ON CONFLICT DO NOTHING;
+        IF NOT FOUND THEN
+            RETURN NULL;
+        END IF;
+        RETURN NEW;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION links_rename_short_code() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM link_short_codes WHERE short_code = OLD.short_code AND link_id = OLD.id;
+        INSERT INTO link_short_codes (short_code, link_id, expires_at) VALUES (NEW.short_code, NEW.id, NEW.expires_at);
+        RETURN NEW;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION links_release() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM link_short_codes AS codes USING deleted_links WHERE codes.short_code = deleted_links.short_code AND codes.link_id = deleted_links.id;
+        DELETE FROM link_click_buckets AS buckets USING deleted_links WHERE buckets.link_id = deleted_links.id;
+        DELETE FROM link_visitor_sketches AS sketches USING deleted_links WHERE sketches.link_id = deleted_links.id;
+        RETURN NULL;
+    END $$
+    """,
+    "CREATE TRIGGER links_claim_short_code BEFORE INSERT ON links FOR EACH ROW EXECUTE FUNCTION links_claim_short_code()",
+    "CREATE TRIGGER links_rename_short_code BEFORE UPDATE OF short_code ON links FOR EACH ROW "
+    "WHEN (OLD.short_code IS DISTINCT FROM NEW.short_code) EXECUTE FUNCTION links_rename_short_code()",
+    "CREATE TRIGGER links_release AFTER DELETE ON links REFERENCING OLD TABLE AS deleted_links FOR EACH STATEMENT EXECUTE FUNCTION links_release()",
+]
+
+for statement in [
+    "CREATE TABLE links_never PARTITION OF links FOR VALUES FROM ('infinity') TO (MAXVALUE)",
+    *LINK_TRIGGERS,
+]:
+    event.listen(Link.__table__, "after_create", DDL(statement))
+for function in ("links_claim_short_code", "links_rename_short_code", "links_release"):
+    event.listen(Link.__table__, "after_drop", DDL(f"DROP FUNCTION IF EXISTS {function}()"))
+
+
+class ClickEvent(Base):
+    __tablename__ = 'click_events'
+    # rows are appended in time order, so a BRIN index covers range scans at a fraction of a btree's size
+    __table_args__ = (Index('ix_click_events_clicked_at', 'clicked_at', postgresql_using='brin'),)
+
+    id = Column(BigInteger, primary_key=True)
+    short_code = Column(String, nullable=False)
+    clicked_at = Column(DateTime, nullable=False)
+    client_ip = Column(String, nullable=False)
+    user_agent = Column(String, nullable=False)
+    referrer = Column(String, nullable=False)
+
+
+class ClickLogSegment(Base):
+    __tablename__ = 'click_log_segments'
+
+    name = Column(String, primary_key=True)
+    events = Column(Integer, nullable=False)
+    ingested_at = Column(DateTime, nullable=False)
+
+
+class TopLinksSnapshot(Base):
+    __tablename__ = 'top_links_snapshots'
+    # only live workers matter, so the table skips the WAL and is allowed to be emptied by a crash
+    __table_args__ = {'prefixes': ['UNLOGGED']}
+
+    worker_id = Column(String, primary_key=True)
+    updated_at = Column(DateTime, nullable=False)
+    snapshot = Column(JSON, nullable=False)
+
+
+class Job(Base):
+    __tablename__ = 'jobs'
+
+    # background jobs write their state here as they go, so any worker can report it
+    id = Column(String(32), primary_key=True)
+    name = Column(String, nullable=False)
+    params = Column(JSON, nullable=False)
+    status = Column(String, nullable=False)
+    rows_deleted = Column(Integer, nullable=False, default=0)
+    message = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    finished_at = Column(DateTime(timezone=True), nullable=True, index=True)
+
+
+class ShortCodePool(Base):
+    __tablename__ = 'short_code_pool'
+
+    code = Column(String, primary_key=True)
+
+
+short_code_block_seq = Sequence('short_code_block_seq', metadata=Base.metadata)
@@ -0,0 +1,225 @@
+import re
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from .models import LINK_PARTITION_KEY
+from .config import LINK_PARTITIONS_AHEAD_MONTHS, LINK_PARTITION_LOCK_TIMEOUT_MS, EXPIRED_LINKS_RETENTION_DAYS, LINK_MAX_TTL_DAYS
+import pytz
+
+
+tz = pytz.timezone('Europe/Moscow')
+
+LINK_PARTITION_LOCK = 0x504152544E
+LINK_PARTITION_DROP_LOCK = 0x4450415254
+MONTH_PARTITION = re.compile(r"^links_(\d{4})_(\d{2})$")
+BEFORE_PARTITION = re.compile(r"^links_before_(\d{4})_(\d{2})$")
+MIN_PARTITION_YEAR = 2000
+MAX_PARTITION_YEAR = 2999
+
+
+def month_start(moment: datetime):
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(start: datetime):
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def partition_name(start: datetime):
+    # names are parsed back with MONTH_PARTITION, so the year always takes four digits
+    if not MIN_PARTITION_YEAR <= start.year <= MAX_PARTITION_YEAR:
+        raise ValueError(f"No link partition for year {start.year}")
+    return f"links_{start.year:04d}_{start.month:02d}"
+
+
+def partition_month(name: str):
+    match = MONTH_PARTITION.match(name)
+    return datetime(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def before_partition_name(bound: datetime):
+    return "links_before" + partition_name(bound)[len("links"):]
+
+
+def partition_bound(name: str):
+    match = BEFORE_PARTITION.match(name)
+    return datetime(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def current_time():
+    return datetime.now(tz).replace(tzinfo=None)
+
+
+class LinkPartitions:
+    # links has one partition per month of expires_at, links_before_YYYY_MM for everything that expires before
+    # the first month and no default partition. Months are attached ahead of time by create_window, at startup
+    # and from the expiry sweep, so inserts never run DDL; ensure is only for rows moved between shards
+    def __init__(self, ahead_months: int, retention_days: float = None, lock_timeout_ms: int = 5000, max_ttl_days: float = 1830):
+        self.ahead_months = ahead_months
+        self.retention_days = retention_days
+        self.lock_timeout_ms = lock_timeout_ms
+        self.max_ttl_days = max_ttl_days
+        self._known = {}
+        self.created = 0
+        self.dropped = 0
+        self.purged = 0
+
+    def retained(self, month: datetime, now: datetime):
+        # months past the retention may be dropped by any worker at any time, so they are never taken from memory
+        return self.retention_days is None or next_month(month) > now - timedelta(days=self.retention_days)
+
+    def window(self, now: datetime):
+        # the first month that has to be kept and the last one an allowed expires_at can fall into, plus the months ahead
+        first = month_start(now if self.retention_days is None else now - timedelta(days=self.retention_days))
+        last = month_start(now + timedelta(days=self.max_ttl_days))
+        for _ in range(self.ahead_months):
+            last = next_month(last)
+        return first, last
+
+    async def lock(self, connection):
+        await connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": LINK_PARTITION_LOCK})
+        await connection.execute(text(f"SET LOCAL lock_timeout = {self.lock_timeout_ms}"))
+
+    async def attach(self, connection, month: datetime):
+        # attaching takes only a SHARE UPDATE EXCLUSIVE lock on links, concurrent inserts keep going
+        name = partition_name(month)
+        await connection.execute(text(f"CREATE TABLE {name} (LIKE links INCLUDING DEFAULTS)"))
+        await connection.execute(text(
+            f"ALTER TABLE links ATTACH PARTITION {name} FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month(month):%Y-%m-%d}')"
+        ))
+        self.created += 1
+
+    async def create_window(self, db):
+        first, last = self.window(current_time())
+        # a connection of its own, so the partitions are committed without touching the caller's transaction
+        async with db.bind.connect() as connection:
+            await self.lock(connection)
+            attached = await self.attached(connection)
+            months = {month for month, _ in attached}
+            bound = next((month for month, _ in await self.attached(connection, before=True)), None)
+            if bound is None:
+                bound = min(months | {first})
+                name = before_partition_name(bound)
+                await connection.execute(text(f"CREATE TABLE {name} (LIKE links INCLUDING DEFAULTS)"))
+                await connection.execute(text(f"ALTER TABLE links ATTACH PARTITION {name} FOR VALUES FROM (MINVALUE) TO ('{bound:%Y-%m-%d}')"))
+                self.created += 1
+            # without a retention every month from the first one on stays, with one the months before `first` are
+            # dropped by drop_expired and expires_at that old is rejected by schemas.LinkCreate
+            month = bound if self.retention_days is None else max(bound, first)
+            while month <= last:
+                if month not in months:
+                    await self.attach(connection, month)
+                month = next_month(month)
+            await connection.commit()
+
+    async def ensure(self, db, expiries):
+        now = current_time()
+        known = self._known.setdefault(str(db.bind.url), set())
+        months = {month_start(expires_at) for expires_at in expiries if expires_at is not None}
+        missing = {month for month in months if month not in known or not self.retained(month, now)}
+        if not missing:
+            return
+        async with db.bind.connect() as connection:
+            await self.lock(connection)
+            existing = {month for month, _ in await self.attached(connection)}
+            bound = next((month for month, _ in await self.attached(connection, before=True)), None)
+            for month in sorted(missing - existing):
+                # months before the bound are already covered by links_before_YYYY_MM
+                if bound is None or month >= bound:
+                    await self.attach(connection, month)
+            await connection.commit()
+        known.update(month for month in months if self.retained(month, now))
+
+    async def attached(self, connection, before: bool = False):
+        # (month, detach pending) of the monthly partitions, or (bound, detach pending) of links_before_YYYY_MM
+        rows = await connection.execute(text(
+            "SELECT child.relname, inherits.inhdetachpending FROM pg_inherits AS inherits "
+            "JOIN pg_class AS child ON child.oid = inherits.inhrelid WHERE inherits.inhparent = 'links'::regclass"
+        ))
+        parse = partition_bound if before else partition_month
+        return [(parse(name), pending) for name, pending in rows if parse(name) is not None]
+
+    async def drop_expired(self, db, before: datetime, on_removed=None):
+        # a month is dropped as a whole once it ended before `before`: DETACH ... CONCURRENTLY does not block
+        # readers or writers of other months, and dropping the table frees its space without dead tuples
+        removed = 0
+        known = self._known.setdefault(str(db.bind.url), set())
+        async with db.bind.connect() as connection:
+            connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+            # one worker drops at a time, the next one finds the months gone
+            await connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": LINK_PARTITION_DROP_LOCK})
+            await connection.execute(text(f"SET lock_timeout = {self.lock_timeout_ms}"))
+            try:
+                for month, pending in await self.attached(connection):
+                    if pending:
+                        # a detach interrupted by a crash or a timeout is finished first
+                        await connection.execute(text(f"ALTER TABLE links DETACH PARTITION {partition_name(month)} FINALIZE"))
+                    elif next_month(month) <= before:
+                        known.discard(month)
+                        await connection.execute(text(f"ALTER TABLE links DETACH PARTITION {partition_name(month)} CONCURRENTLY"))
+                removed = await self.drop_detached(db, before, on_removed)
+                for bound, _ in await self.attached(connection, before=True):
+                    removed += await self.purge_before(connection, bound, before, on_removed)
+            finally:
+                await connection.execute(text("RESET lock_timeout"))
+                await connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": LINK_PARTITION_DROP_LOCK})
+        return removed
+
+    async def purge_before(self, connection, bound: datetime, before: datetime, on_removed=None, batch_size: int = 10000):
+        # links_before_YYYY_MM only gets links created already expired, it stays attached and is purged row by row;
+        # the statement goes through links, so the links_release trigger cleans up after the rows
+        removed = 0
+        while True:
+            short_codes = (await connection.scalars(text(
+                f"DELETE FROM links WHERE {LINK_PARTITION_KEY} < :bound "
+                f"AND id IN (SELECT id FROM links WHERE {LINK_PARTITION_KEY} < :bound AND expires_at < :before LIMIT :limit) "
+                "RETURNING short_code"
+            ), {"bound": bound, "before": before, "limit": batch_size})).all()
+            removed += len(short_codes)
+            if short_codes and on_removed is not None:
+                on_removed(short_codes)
+            if len(short_codes) < batch_size:
+                break
+        self.purged += removed
+        return removed
+
+    async def drop_detached(self, db, before: datetime, on_removed=None):
+        # detached months, including ones left over by an earlier run, lose their codes, click history and table
+        removed = 0
+        async with db.bind.connect() as connection:
+            names = (await connection.scalars(text(
+                "SELECT relname FROM pg_class WHERE relkind = 'r' AND NOT relispartition "
+                "AND relnamespace = current_schema()::regnamespace AND relname ~ '^links_[0-9]{4}_[0-9]{2}$'"
+            ))).all()
+            for name in names:
+                if next_month(partition_month(name)) > before:
+                    continue
+                # read in keyset batches, an open cursor on the table would keep it from being dropped
+                last_id = 0
+                while True:
+                    batch = (await connection.execute(
+                        text(f"SELECT id, short_code FROM {name} WHERE id > :last_id ORDER BY id LIMIT :limit"), {"last_id": last_id, "limit": 10000}
+                    )).all()
+                    if not batch:
+                        break
+                    last_id = batch[-1].id
+                    removed += len(batch)
+                    if on_removed is not None:
+                        on_removed([short_code for _, short_code in batch])
+                await connection.execute(text(
+                    f"DELETE FROM link_short_codes AS codes USING {name} AS dropped WHERE codes.short_code = dropped.short_code AND codes.link_id = dropped.id"
+                ))
+                await connection.execute(text(f"DELETE FROM link_click_buckets AS buckets USING {name} AS dropped WHERE buckets.link_id = dropped.id"))
+                await connection.execute(text(f"DELETE FROM link_visitor_sketches AS sketches USING {name} AS dropped WHERE sketches.link_id = dropped.id"))
+                await connection.execute(text(f"DROP TABLE {name}"))
+                await connection.commit()
+                self.dropped += 1
+        return removed
+
+    def clear(self):
+        self._known.clear()
+
+    def stats(self):
+        return {"created": self.created, "dropped": self.dropped, "purged": self.purged, "ahead_months": self.ahead_months, "max_ttl_days": self.max_ttl_days}
+
+
+link_partitions = LinkPartitions(LINK_PARTITIONS_AHEAD_MONTHS, EXPIRED_LINKS_RETENTION_DAYS, LINK_PARTITION_LOCK_TIMEOUT_MS, LINK_MAX_TTL_DAYS)
@@ -0,0 +1,63 @@
+import math
+import time
+from collections import OrderedDict
+from .config import READ_YOUR_WRITES_SECONDS
+
+
+READ_PRIMARY_COOKIE = "read_primary_until"
+SAFE_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+
+def reads_from_primary(cookies) -> bool:
+    try:
+        return float(cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReadYourWritesMiddleware:
+    # a successful write pins the client's reads to the primary for `window` seconds, which should be
+    # longer than the replication lag, so the client never reads a replica that has not seen its write yet
+    def __init__(self, app, window: float):
+        self.app = app
+        self.window = window
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in SAFE_METHODS:
+            return await self.app(scope, receive, send)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                cookie = f"{READ_PRIMARY_COOKIE}={time.time() + self.window:.3f}; Max-Age={math.ceil(self.window)}; Path=/; HttpOnly; SameSite=Lax"
+                message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", cookie.encode("latin-1"))]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+
+class RecentWrites:
+    # short codes this worker changed within the window; cache fills for them skip the replica,
+    # otherwise a lagging replica could put the old target back into the cache right after an update
+    def __init__(self, window: float):
+        self.window = window
+        self._until = OrderedDict()
+
+    def add(self, *short_codes: str):
+        until = time.monotonic() + self.window
+        for short_code in short_codes:
+            self._until[short_code] = until
+            self._until.move_to_end(short_code)
+        # every entry gets the same window, so the oldest deadlines are always at the front
+        now = time.monotonic()
+        while self._until and next(iter(self._until.values())) <= now:
+            self._until.popitem(last=False)
+
+    def __contains__(self, short_code: str):
+        until = self._until.get(short_code)
+        return until is not None and until > time.monotonic()
+
+    def clear(self):
+        self._until.clear()
+
+
+recent_writes = RecentWrites(READ_YOUR_WRITES_SECONDS)
@@ -0,0 +1,527 @@
+import abc
+import asyncio
+from contextlib import asynccontextmanager, AsyncExitStack
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, delete, update, and_, or_, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from . import models, importer, database
+from .clicks import compact_click_buckets, compact_visitor_sketches
+from .click_log import ingest_click_log
+from .short_codes import short_code_generator
+from .shards import shard_router, shard_session, taken_at_previous_locations, move_links, merge_sorted, create_shard_tables, prepare_id_sequences
+from .partitions import link_partitions
+from .jobs import Job, jobs
+from .config import EXPIRED_LINKS_YIELD_PER, SHORT_CODE_STRATEGY, SQLITE_PATH, JOB_RETENTION_DAYS
+
+
+STORAGE_BACKENDS = ("postgres", "sqlite", "memory")
+
+
+class UserRepository(abc.ABC):
+    # returned users carry id, username, email and password
+    @abc.abstractmethod
+    async def get(self, username: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def create(self, username: str, email: str, password: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def set_password(self, username: str, password: str):
+        raise NotImplementedError
+
+
+class LinkRepository(abc.ABC):
+    # every read and write of links and their click history; returned links carry the columns of models.Link.
+    # Maintenance that only matters to a shared database server does nothing by default
+    async def prepare(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abc.abstractmethod
+    async def next_short_code(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def find_by_url(self, digest: bytes, read_only: bool = False):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def find_duplicate(self, digest: bytes, expires_at):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def taken_short_codes(self, short_codes):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def insert(self, rows):
+        # rows whose short code is taken are skipped, the codes that were inserted are returned
+        raise NotImplementedError
+
+    async def import_records(self, records, created_at, user_id=None):
+        # records are (original_url, short_code, expires_at, is_custom, url_digest) tuples of the importer
+        return await self.insert([
+            {"original_url": original_url, "short_code": short_code, "created_at": created_at, "expires_at": expires_at, "access_count": 0, "url_digest": digest, "user_id": user_id}
+            for original_url, short_code, expires_at, _, digest in records
+        ])
+
+    @abc.abstractmethod
+    async def get_redirect_target(self, short_code: str, read_only: bool = False):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_many(self, short_codes):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def delete(self, short_code: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def rename(self, short_code_old: str, short_code_new: str):
+        # returns the renamed link, None if there is none, and raises ValueError if the new code is taken
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def read_stats(self, short_code: str, granularity: str = None, since=None, before=None, read_only: bool = False):
+        # the link, its stored clicks per bucket truncated to the granularity and its visitor sketches in [since, before)
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def expired_links(self, now, after: int = None, limit: int = None, read_only: bool = False):
+        # batches of links that expired before now, in id order
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def upcoming_expiries(self, since, until):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def delete_unused(self, last_accessed_before, batch_size: int, pause: float, on_deleted):
+        # on_deleted is awaited with the short codes of every batch
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def purge_expired(self, before, on_removed):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def flush_clicks(self, buffer):
+        raise NotImplementedError
+
+    async def compact_clicks(self, closed, before):
+        pass
+
+    async def refresh_short_code_filter(self, short_code_filter, rebuild: bool):
+        pass
+
+    async def publish_top_links(self, worker_id: str, snapshot: dict, now, stale_before):
+        pass
+
+    async def top_links_snapshots(self, worker_id: str, since):
+        return []
+
+    async def forget_top_links(self, worker_id: str):
+        pass
+
+    async def ingest_click_log(self, log):
+        return 0
+
+    async def save_job(self, job: Job):
+        jobs.save(job)
+
+    async def get_job(self, job_id: str):
+        return jobs.get(job_id)
+
+
+@asynccontextmanager
+async def session_scope(read_only: bool = False):
+    async with database.AsyncSessionLocal() as db:
+        yield db
+
+
+async def first_short_code(db, condition):
+    return await db.scalar(select(models.Link.short_code).where(condition).limit(1))
+
+
+async def delete_links_in_batches(db, condition, batch_size: int, pause: float):
+    # deletes matching links one batch per transaction and yields the short codes of every batch
+    while True:
+        link_ids = select(models.Link.id).where(condition).limit(batch_size)
+        deleted_short_codes = (await db.scalars(
+            delete(models.Link).where(models.Link.id.in_(link_ids)).returning(models.Link.short_code)
+        )).all()
+        await db.commit()
+
+        yield deleted_short_codes
+        if len(deleted_short_codes) < batch_size:
+            break
+        await asyncio.sleep(pause)
+
+
+class PostgresUserRepository(UserRepository):
+    def __init__(self, session_scope=session_scope):
+        self.session_scope = session_scope
+
+    async def get(self, username: str):
+        async with self.session_scope() as db:
+            return await db.scalar(select(models.User).where(models.User.username == username))
+
+    async def create(self, username: str, email: str, password: str):
+        async with self.session_scope() as db:
+            user = models.User(username=username, email=email, password=password)
+            db.add(user)
+            await db.commit()
+            return user
+
+    async def set_password(self, username: str, password: str):
+        async with self.session_scope() as db:
+            await db.execute(update(models.User).where(models.User.username == username).values(password=password))
+            await db.commit()
+
+
+class PostgresLinkRepository(LinkRepository):
+    # links are spread over shards by short code, with partitions by expiry and the link_short_codes registry,
+    # see app/shards.py and app/partitions.py; session_scope opens sessions on the main database and its replica
+    def __init__(self, session_scope=session_scope):
+        self.session_scope = session_scope
+
+    @asynccontextmanager
+    async def shard_scope(self, shard: int, read_only: bool = False):
+        # shard 0 is the main database, the only one with a replica
+        if shard == 0:
+            async with self.session_scope(read_only=read_only) as db:
+                yield db
+        else:
+            async with shard_session(shard) as db:
+                yield db
+
+    @asynccontextmanager
+    async def all_shards_scope(self):
+        async with AsyncExitStack() as stack:
+            yield [await stack.enter_async_context(self.shard_scope(shard)) for shard in range(shard_router.count)]
+
+    async def on_every_shard(self, func, *args, read_only: bool = False):
+        # scatter-gather: func runs on every shard at once, results come back in shard order
+        async def run(shard):
+            async with self.shard_scope(shard, read_only=read_only) as db:
+                return await func(db, *args)
+
+        return await asyncio.gather(*(run(shard) for shard in range(shard_router.count)))
+
+    async def prepare(self):
+        # the main database gets its tables here rather than at import, so importing the app needs no database
+        async with self.session_scope() as db:
+            await db.run_sync(lambda session: models.Base.metadata.create_all(bind=session.connection()))
+            await db.commit()
+        if shard_router.count > 1:
+            async with self.all_shards_scope() as dbs:
+                for db in dbs[1:]:
+                    await create_shard_tables(db)
+                await prepare_id_sequences(dbs)
+        # inserts expect the partition of their month to exist, see LinkPartitions.create_window
+        await self.on_every_shard(link_partitions.create_window)
+
+    async def next_short_code(self):
+        # the counter and pool strategies reserve their codes in the main database
+        async with self.session_scope() as db:
+            short_code = await short_code_generator.next_code(db)
+            await db.commit()
+        return short_code
+
+    async def find_by_url(self, digest: bytes, read_only: bool = False):
+        short_codes = await self.on_every_shard(first_short_code, models.Link.url_digest == digest, read_only=read_only)
+        return next((short_code for short_code in short_codes if short_code is not None), None)
+
+    async def find_duplicate(self, digest: bytes, expires_at):
+        # the same URL may have been shortened on any shard
+        duplicate = and_(models.Link.url_digest == digest, models.Link.expires_at.is_not_distinct_from(expires_at))
+        short_codes = await self.on_every_shard(first_short_code, duplicate)
+        return next((short_code for short_code in short_codes if short_code is not None), None)
+
+    async def taken_short_codes(self, short_codes):
+        async with self.session_scope() as db:
+            taken = await taken_at_previous_locations(db, short_codes)
+        for shard, codes in shard_router.group(short_codes).items():
+            async with self.shard_scope(shard) as db:
+                taken.update(await db.scalars(select(models.LinkShortCode.short_code).where(models.LinkShortCode.short_code.in_(codes))))
+        return taken
+
+    async def insert(self, rows):
+        async with self.session_scope() as db:
+            taken = await taken_at_previous_locations(db, [row["short_code"] for row in rows])
+        # rows with a taken code are skipped by the links_claim_short_code trigger and missing from RETURNING
+        insert = pg_insert(models.Link).returning(models.Link.short_code)
+        inserted = set()
+        for shard, shard_rows in shard_router.group([row for row in rows if row["short_code"] not in taken], key=lambda row: row["short_code"]).items():
+            async with self.shard_scope(shard) as db:
+                inserted.update(await db.scalars(insert, shard_rows))
+                await db.commit()
+        return inserted
+
+    async def import_records(self, records, created_at, user_id=None):
+        # staged through COPY, see app/importer.py
+        async with self.session_scope() as db:
+            inserted = await importer.insert_records(db, records, created_at, user_id)
+            await db.commit()
+        return inserted
+
+    async def get_redirect_target(self, short_code: str, read_only: bool = False):
+        for shard in shard_router.locations(short_code):
+            async with self.shard_scope(shard, read_only=read_only) as db:
+                link = (await db.execute(
+                    select(models.Link.id, models.Link.original_url, models.Link.expires_at)
+                    .where(models.Link.short_code == short_code, models.link_partition_of(short_code))
+                )).first()
+            if link is not None:
+                return link
+        return None
+
+    async def get_many(self, short_codes):
+        links = []
+        for shard, codes in shard_router.group(short_codes).items():
+            async with self.shard_scope(shard) as db:
+                links += (await db.execute(
+                    select(models.Link.id, models.Link.short_code, models.Link.original_url, models.Link.expires_at)
+                    # joined through the registry, every code is looked up in the partition of its expiry only
+                    .join(models.LinkShortCode, and_(models.LinkShortCode.short_code == models.Link.short_code, models.link_expiry == models.short_code_expiry))
+                    .where(models.LinkShortCode.short_code.in_(codes))
+                )).all()
+        return links
+
+    async def delete(self, short_code: str):
+        for shard in shard_router.locations(short_code):
+            async with self.shard_scope(shard) as db:
+                deleted = await db.execute(
+                    delete(models.Link).where(models.Link.short_code == short_code, models.link_partition_of(short_code))
+                    .execution_options(synchronize_session=False)
+                )
+                if deleted.rowcount:
+                    await db.commit()
+                    return True
+        return False
+
+    async def rename(self, short_code_old: str, short_code_new: str):
+        for shard in shard_router.locations(short_code_old):
+            async with self.shard_scope(shard) as db:
+                link = (await db.execute(
+                    select(models.Link.id, models.Link.original_url, models.Link.expires_at)
+                    .where(models.Link.short_code == short_code_old, models.link_partition_of(short_code_old))
+                )).first()
+                if link is None:
+                    continue
+                target = shard_router.shard_for(short_code_new)
+                if target == shard:
+                    try:
+                        await db.execute(
+                            update(models.Link).where(models.Link.short_code == short_code_old, models.link_partition_of(short_code_old))
+                            .values(short_code=short_code_new).execution_options(synchronize_session=False)
+                        )
+                        await db.commit()
+                    except IntegrityError:
+                        # the links_rename_short_code trigger found the new code in the registry
+                        await db.rollback()
+                        raise ValueError("Short code is already taken")
+                else:
+                    # the row and its click history move to the shard of the new code
+                    async with self.shard_scope(target) as target_db:
+                        await move_links(db, target_db, [link.id], {short_code_old: short_code_new})
+                return link
+        return None
+
+    async def read_stats(self, short_code: str, granularity: str = None, since=None, before=None, read_only: bool = False):
+        for shard in shard_router.locations(short_code):
+            async with self.shard_scope(shard, read_only=read_only) as db:
+                link = await db.scalar(select(models.Link).where(models.Link.short_code == short_code, models.link_partition_of(short_code)))
+                if link is None:
+                    continue
+                if granularity is None:
+                    return link, None, None
+
+                # compacted days are stored as one daily bucket, so they show up at midnight in hourly series
+                bucket = func.date_trunc(granularity, models.LinkClickBucket.bucket)
+                buckets = dict((await db.execute(
+                    select(bucket, func.sum(models.LinkClickBucket.count))
+                    .where(
+                        models.LinkClickBucket.link_id == link.id,
+                        models.LinkClickBucket.bucket >= since,
+                        models.LinkClickBucket.bucket < before,
+                    )
+                    .group_by(bucket)
+                )).all())
+                # hourly sketches merge into daily ones, so the same rows serve both granularities
+                sketches = (await db.execute(
+                    select(models.LinkVisitorSketch.bucket, models.LinkVisitorSketch.sketch)
+                    .where(
+                        models.LinkVisitorSketch.link_id == link.id,
+                        models.LinkVisitorSketch.bucket >= since,
+                        models.LinkVisitorSketch.bucket < before,
+                    )
+                )).all()
+                return link, buckets, sketches
+        return None
+
+    async def expired_links(self, now, after: int = None, limit: int = None, read_only: bool = False):
+        query = select(
+            models.Link.id, models.Link.original_url, models.Link.short_code, models.Link.created_at, models.Link.expires_at
+        ).where(
+            and_(
+                models.Link.expires_at.isnot(None),
+                models.Link.expires_at < now,
+                # lets the planner skip links_never and the months that have not ended yet
+                models.link_expiry < now,
+            )
+        ).order_by(models.Link.id)
+        if after is not None:
+            query = query.where(models.Link.id > after)
+        if limit is not None:
+            query = query.limit(limit)
+        query = query.execution_options(yield_per=EXPIRED_LINKS_YIELD_PER)
+
+        if shard_router.count == 1:
+            async with self.session_scope(read_only=read_only) as db:
+                rows = await db.stream(query)
+                async for batch in rows.partitions():
+                    yield batch
+            return
+
+        async def shard_expired_links(shard):
+            async with self.shard_scope(shard, read_only=read_only) as db:
+                rows = await db.stream(query)
+                async for expired_link in rows:
+                    yield expired_link
+
+        # every shard streams its links in id order and the streams are merged, so `after` keeps working
+        batch = []
+        sent = 0
+        async for expired_link in merge_sorted([shard_expired_links(shard) for shard in range(shard_router.count)], key=lambda row: row.id):
+            batch.append(expired_link)
+            sent += 1
+            if len(batch) == EXPIRED_LINKS_YIELD_PER or sent == limit:
+                yield batch
+                batch = []
+            if sent == limit:
+                break
+        if batch:
+            yield batch
+
+    async def upcoming_expiries(self, since, until):
+        for shard in range(shard_router.count):
+            async with self.shard_scope(shard) as db:
+                upcoming = await db.stream(
+                    select(models.Link.short_code, models.Link.expires_at)
+                    .where(and_(models.Link.expires_at >= since, models.Link.expires_at < until))
+                    .where(and_(models.link_expiry >= since, models.link_expiry < until))
+                    .execution_options(yield_per=EXPIRED_LINKS_YIELD_PER)
+                )
+                async for short_code, expires_at in upcoming:
+                    yield short_code, expires_at
+
+    async def delete_unused(self, last_accessed_before, batch_size: int, pause: float, on_deleted):
+        unused = or_(models.Link.last_accessed_at.is_(None), models.Link.last_accessed_at < last_accessed_before)
+
+        async def delete_unused_links(db):
+            deleted = 0
+            async for short_codes in delete_links_in_batches(db, unused, batch_size, pause):
+                await on_deleted(short_codes)
+                deleted += len(short_codes)
+            return deleted
+
+        return sum(await self.on_every_shard(delete_unused_links))
+
+    async def purge_expired(self, before, on_removed):
+        async def maintain_link_partitions(db):
+            removed = 0
+            # expired links go away a whole month at a time, once the month is past the retention
+            if before is not None:
+                removed = await link_partitions.drop_expired(db, before, on_removed=on_removed)
+            await link_partitions.create_window(db)
+            return removed
+
+        return sum(await self.on_every_shard(maintain_link_partitions))
+
+    async def flush_clicks(self, buffer):
+        async with self.all_shards_scope() as dbs:
+            return await buffer.flush(*dbs)
+
+    async def compact_clicks(self, closed, before):
+        for shard in range(shard_router.count):
+            async with self.shard_scope(shard) as db:
+                await compact_click_buckets(db, before)
+                await compact_visitor_sketches(db, closed, before)
+
+    async def refresh_short_code_filter(self, short_code_filter, rebuild: bool):
+        async with self.all_shards_scope() as dbs:
+            if rebuild:
+                await short_code_filter.rebuild(*dbs)
+            else:
+                await short_code_filter.refresh(*dbs)
+
+    async def publish_top_links(self, worker_id: str, snapshot: dict, now, stale_before):
+        async with self.session_scope() as db:
+            published = pg_insert(models.TopLinksSnapshot).values(worker_id=worker_id, updated_at=now, snapshot=snapshot)
+            await db.execute(published.on_conflict_do_update(
+                index_elements=[models.TopLinksSnapshot.worker_id],
+                set_={"updated_at": published.excluded.updated_at, "snapshot": published.excluded.snapshot},
+            ))
+            # rows of workers that stopped without cleaning up
+            await db.execute(delete(models.TopLinksSnapshot).where(models.TopLinksSnapshot.updated_at < stale_before))
+            await db.commit()
+
+    async def top_links_snapshots(self, worker_id: str, since):
+        async with self.session_scope() as db:
+            return list(await db.scalars(
+                select(models.TopLinksSnapshot.snapshot).where(
+                    models.TopLinksSnapshot.worker_id != worker_id,
+                    models.TopLinksSnapshot.updated_at >= since,
+                )
+            ))
+
+    async def forget_top_links(self, worker_id: str):
+        async with self.session_scope() as db:
+            await db.execute(delete(models.TopLinksSnapshot).where(models.TopLinksSnapshot.worker_id == worker_id))
+            await db.commit()
+
+    async def ingest_click_log(self, log):
+        async with self.session_scope() as db:
+            return await ingest_click_log(db, log)
+
+    async def save_job(self, job: Job):
+        # written on every change of the job, GET /jobs/{id} may reach any worker
+        async with self.session_scope() as db:
+            saved = pg_insert(models.Job).values(**job.as_row())
+            await db.execute(saved.on_conflict_do_update(
+                index_elements=[models.Job.id],
+                set_={column: saved.excluded[column] for column in ("status", "rows_deleted", "message", "error", "finished_at")},
+            ))
+            if job.status == "pending":
+                # new jobs clear out the ones finished before the retention
+                await db.execute(delete(models.Job).where(models.Job.finished_at < datetime.now(timezone.utc) - timedelta(days=JOB_RETENTION_DAYS)))
+            await db.commit()
+
+    async def get_job(self, job_id: str):
+        async with self.session_scope() as db:
+            row = await db.get(models.Job, job_id)
+            return Job.from_row(row) if row is not None else None
+
+
+def create_repositories(backend: str, session_scope=session_scope):
+    if backend == "postgres":
+        return PostgresLinkRepository(session_scope), PostgresUserRepository(session_scope)
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    if SHORT_CODE_STRATEGY != "random":
+        # the counter and pool strategies keep their state in PostgreSQL
+        raise ValueError(f"SHORT_CODE_STRATEGY={SHORT_CODE_STRATEGY} needs the postgres storage backend")
+
+    from .embedded import MemoryLinkRepository, MemoryUserRepository, SqliteStore
+
+    if backend == "memory":
+        return MemoryLinkRepository(), MemoryUserRepository()
+    store = SqliteStore(SQLITE_PATH)
+    return store.links, store.users
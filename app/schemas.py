@@ -1,6 +1,8 @@
 from pydantic import BaseModel, field_validator, Field
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from typing import Optional
+from .partitions import MIN_PARTITION_YEAR, MAX_PARTITION_YEAR
+from .config import LINK_MAX_TTL_DAYS, EXPIRED_LINKS_RETENTION_DAYS
 import pytz
 
 
@@ -19,6 +21,21 @@ class LinkCreate(BaseModel):
     custom_alias: Optional[str] = None
     expires_at: Optional[datetime] = Field(default=None, example=datetime.now(tz).strftime("%Y-%m-%d %H:%M"))
 
+    @field_validator("expires_at")
+    @classmethod
+    def expires_at_in_partition_range(cls, expires_at):
+        # links are partitioned by the month of expires_at and only the months of this window exist in advance
+        if expires_at is None:
+            return expires_at
+        if not MIN_PARTITION_YEAR <= expires_at.year <= MAX_PARTITION_YEAR:
+            raise ValueError(f"expires_at must be between {MIN_PARTITION_YEAR} and {MAX_PARTITION_YEAR}")
+        now = datetime.now(tz).replace(tzinfo=None)
+        if expires_at.replace(tzinfo=None) > now + timedelta(days=LINK_MAX_TTL_DAYS):
+            raise ValueError(f"expires_at must be at most {LINK_MAX_TTL_DAYS:g} days ahead")
+        if EXPIRED_LINKS_RETENTION_DAYS is not None and expires_at.replace(tzinfo=None) < now - timedelta(days=EXPIRED_LINKS_RETENTION_DAYS):
+            raise ValueError("expires_at is older than the retention of expired links")
+        return expires_at
+
 class LinkUpdate(BaseModel):
     short_code_old: str
     short_code_new: str
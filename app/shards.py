@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import heapq
+from contextlib import asynccontextmanager
+from sqlalchemy import select, delete, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from . import database, models
+from .partitions import link_partitions
+from .config import LINK_SHARDS, LINK_SHARDS_PREVIOUS_COUNT
+
+
+# shard k hands out link ids congruent to k modulo the stride, so ids stay unique when rows move between shards
+SHARD_ID_STRIDE = 16
+SHARD_SEQUENCE_LOCK = 0x5348415244
+SHARDED_TABLES = (models.Link.__table__, models.LinkShortCode.__table__, models.LinkClickBucket.__table__, models.LinkVisitorSketch.__table__)
+
+
+def jump_hash(key: int, buckets: int):
+    # Lamping and Veach: going from n to n + 1 buckets moves only the keys that land in the new bucket
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def short_code_key(short_code: str):
+    return int.from_bytes(hashlib.blake2b(short_code.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class ShardRouter:
+    def __init__(self, count: int, previous_count: int = None):
+        if not 1 <= count <= SHARD_ID_STRIDE:
+            raise ValueError(f"Shard count must be between 1 and {SHARD_ID_STRIDE}")
+        self.count = count
+        # set while rows are rebalanced after shards were added, reads then also look where a code used to live
+        self.previous_count = previous_count
+
+    def shard_for(self, short_code: str, count: int = None):
+        count = count or self.count
+        return 0 if count == 1 else jump_hash(short_code_key(short_code), count)
+
+    def locations(self, short_code: str):
+        shard = self.shard_for(short_code)
+        if self.previous_count and self.previous_count != self.count:
+            previous = self.shard_for(short_code, self.previous_count)
+            if previous != shard:
+                return [shard, previous]
+        return [shard]
+
+    def group(self, items, key=lambda item: item):
+        groups = {}
+        for item in items:
+            groups.setdefault(self.shard_for(key(item)), []).append(item)
+        return groups
+
+
+@asynccontextmanager
+async def shard_session(shard: int):
+    # shard 0 is the main database and is reached through the caller's session instead
+    async with database.ShardSessionLocals[shard - 1]() as db:
+        yield db
+
+
+async def merge_sorted(streams, key):
+    # k-way merge of async iterators that are each sorted by key, their first rows are fetched concurrently
+    try:
+        heads = await asyncio.gather(*(anext(stream, None) for stream in streams))
+        heap = [(key(row), index, row) for index, row in enumerate(heads) if row is not None]
+        heapq.heapify(heap)
+        while heap:
+            _, index, row = heap[0]
+            yield row
+            following = await anext(streams[index], None)
+            if following is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (key(following), index, following))
+    finally:
+        for stream in streams:
+            await stream.aclose()
+
+
+async def create_shard_tables(db):
+    # the main database gets its tables from create_all and alembic, the other shards only hold links
+    await db.run_sync(lambda session: models.Base.metadata.create_all(bind=session.connection(), tables=SHARDED_TABLES))
+    await db.commit()
+
+
+async def taken_at_previous_locations(db, short_codes):
+    # while rows are rebalanced a code may still live on its old shard, where the new shard's registry cannot see it
+    if not shard_router.previous_count:
+        return set()
+    groups = {}
+    for short_code in short_codes:
+        locations = shard_router.locations(short_code)
+        if len(locations) > 1:
+            groups.setdefault(locations[1], []).append(short_code)
+    taken = set()
+    for shard, codes in groups.items():
+        query = select(models.LinkShortCode.short_code).where(models.LinkShortCode.short_code.in_(codes))
+        if shard == 0:
+            taken.update(await db.scalars(query))
+        else:
+            async with shard_session(shard) as shard_db:
+                taken.update(await shard_db.scalars(query))
+    return taken
+
+
+async def prepare_id_sequences(dbs):
+    if len(dbs) == 1:
+        return
+    # serialized on the main database, so workers starting together do not restart a sequence twice
+    await dbs[0].execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SHARD_SEQUENCE_LOCK})
+    states = []
+    for db in dbs:
+        sequence = (await db.execute(text(
+            "SELECT increment_by, coalesce(last_value + increment_by, start_value) AS next_value FROM pg_sequences "
+            "WHERE schemaname = current_schema() AND sequencename = 'links_id_seq'"
+        ))).one()
+        max_id = await db.scalar(select(models.Link.id).order_by(models.Link.id.desc()).limit(1)) or 0
+        states.append((sequence.increment_by, sequence.next_value, max_id))
+
+    base = (max(max(next_value, max_id) for _, next_value, max_id in states) // SHARD_ID_STRIDE + 1) * SHARD_ID_STRIDE
+    for shard, (db, (increment_by, next_value, _)) in enumerate(zip(dbs, states)):
+        if increment_by != SHARD_ID_STRIDE or next_value % SHARD_ID_STRIDE != shard:
+            await db.execute(text(f"ALTER SEQUENCE links_id_seq INCREMENT BY {SHARD_ID_STRIDE} RESTART WITH {base + shard}"))
+    for db in reversed(dbs):
+        await db.commit()
+
+
+async def move_links(source, target, link_ids, renamed=None):
+    # the rows stay locked on the source until their copy is committed on the target, so a click flush that
+    # waits for them finds them on the target; a move interrupted after that commit is simply run again
+    links, _, buckets, sketches = SHARDED_TABLES
+    rows = (await source.execute(select(links).where(links.c.id.in_(link_ids)).order_by(links.c.id).with_for_update())).mappings().all()
+    if not rows:
+        await source.commit()
+        return 0
+    ids = [row["id"] for row in rows]
+    bucket_rows = (await source.execute(select(buckets).where(buckets.c.link_id.in_(ids)))).mappings().all()
+    sketch_rows = (await source.execute(
+        select(sketches.c.link_id, sketches.c.granularity, sketches.c.bucket, sketches.c.sketch).where(sketches.c.link_id.in_(ids))
+    )).mappings().all()
+
+    renamed = renamed or {}
+    await link_partitions.ensure(target, [row["expires_at"] for row in rows])
+    # the trigger skips rows whose code is already claimed, which is the row itself when a move is run again
+    inserted = set(await target.scalars(
+        pg_insert(links).returning(links.c.id),
+        [{**row, "short_code": renamed.get(row["short_code"], row["short_code"])} for row in rows],
+    ))
+    skipped = [link_id for link_id in ids if link_id not in inserted]
+    if skipped and len((await target.scalars(select(links.c.id).where(links.c.id.in_(skipped)))).all()) < len(skipped):
+        # a renamed code that is taken on the target fails the move instead of losing the row
+        await target.rollback()
+        await source.rollback()
+        raise ValueError("Short code is already taken on the target shard")
+    if bucket_rows:
+        await target.execute(pg_insert(buckets).on_conflict_do_nothing(), [dict(row) for row in bucket_rows])
+    if sketch_rows:
+        # sketch ids are local to a shard; a partial sketch copied twice changes nothing once merged
+        await target.execute(pg_insert(sketches), [dict(row) for row in sketch_rows])
+    await target.commit()
+
+    await source.execute(delete(links).where(links.c.id.in_(ids)))
+    await source.commit()
+    return len(rows)
+
+
+async def rebalance(dbs, batch_size: int = 1000, pause: float = 0.0, on_progress=None):
+    # every shard is scanned in id order and rows whose code now hashes elsewhere are moved batch by batch
+    progress = {"scanned": 0, "moved": 0}
+    for shard, source in enumerate(dbs):
+        last_id = 0
+        while True:
+            rows = (await source.execute(
+                select(models.Link.id, models.Link.short_code).where(models.Link.id > last_id).order_by(models.Link.id).limit(batch_size)
+            )).all()
+            await source.commit()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            progress["scanned"] += len(rows)
+            misplaced = {}
+            for link_id, short_code in rows:
+                target = shard_router.shard_for(short_code)
+                if target != shard:
+                    misplaced.setdefault(target, []).append(link_id)
+            for target, link_ids in misplaced.items():
+                progress["moved"] += await move_links(source, dbs[target], link_ids)
+            if on_progress is not None:
+                on_progress({"shard": shard, "last_id": last_id, **progress})
+            await asyncio.sleep(pause)
+    return progress
+
+
+shard_router = ShardRouter(1 + len(LINK_SHARDS), LINK_SHARDS_PREVIOUS_COUNT)
@@ -0,0 +1,153 @@
+import hashlib
+import logging
+import random
+import string
+import sys
+from sqlalchemy import text
+from .config import SECRET, SHORT_CODE_LENGTH, SHORT_CODE_STRATEGY, SHORT_CODE_BLOCK_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+ALPHABET = string.digits + string.ascii_letters
+# first path segments of the static /links/... routes, a link with one of these codes could not be reached
+RESERVED_SHORT_CODES = frozenset({"top", "shorten", "import", "search", "expired", "remove_unused"})
+
+
+def encode_base62(number: int, length: int):
+    chars = []
+    for _ in range(length):
+        number, remainder = divmod(number, len(ALPHABET))
+        chars.append(ALPHABET[remainder])
+    return ''.join(reversed(chars))
+
+
+class FeistelPermutation:
+    # keyed bijection on [0, size): a balanced feistel network over enough bits, with cycle walking
+    def __init__(self, size: int, key: str, rounds: int = 4):
+        self.size = size
+        self.half_bits = ((size - 1).bit_length() + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+        self.round_keys = [hashlib.blake2b(f"{key}:{i}".encode(), digest_size=16).digest() for i in range(rounds)]
+
+    def _round(self, round_key: bytes, value: int):
+        digest = hashlib.blake2b(value.to_bytes(8, "big"), key=round_key, digest_size=8).digest()
+        return int.from_bytes(digest, "big") & self.mask
+
+    def _encrypt(self, value: int):
+        left, right = value >> self.half_bits, value & self.mask
+        for round_key in self.round_keys:
+            left, right = right, left ^ self._round(round_key, right)
+        return (left << self.half_bits) | right
+
+    def __call__(self, value: int):
+        if not 0 <= value < self.size:
+            raise ValueError("Value is out of the permutation domain")
+        value = self._encrypt(value)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+
+class RandomCodeGenerator:
+    def __init__(self, length: int):
+        self.length = length
+
+    def generate(self):
+        while True:
+            short_code = ''.join(random.choice(ALPHABET) for i in range(self.length))
+            if short_code not in RESERVED_SHORT_CODES:
+                return short_code
+
+    async def next_code(self, db):
+        return self.generate()
+
+
+class CounterCodeGenerator:
+    # counters are taken from blocks reserved with one nextval() each, so workers never share a value
+    def __init__(self, length: int, key: str, block_size: int):
+        self.length = length
+        self.block_size = block_size
+        self.permutation = FeistelPermutation(len(ALPHABET) ** length, key)
+        self._next = 0
+        self._end = 0
+
+    async def next_code(self, db):
+        if self._next >= self._end:
+            block = await db.scalar(text("SELECT nextval('short_code_block_seq')"))
+            self._next, self._end = (block - 1) * self.block_size, block * self.block_size
+
+        counter = self._next
+        self._next += 1
+        if counter >= self.permutation.size:
+            raise RuntimeError("Short code space is exhausted, increase SHORT_CODE_LENGTH")
+        short_code = encode_base62(self.permutation(counter), self.length)
+        if short_code in RESERVED_SHORT_CODES:
+            return await self.next_code(db)
+        return short_code
+
+
+class PoolCodeGenerator:
+    # codes are claimed in batches from short_code_pool, which is filled ahead of time with `python -m app.short_codes fill`
+    def __init__(self, length: int, batch_size: int):
+        self.batch_size = batch_size
+        self.fallback = RandomCodeGenerator(length)
+        self._codes = []
+
+    async def next_code(self, db):
+        if not self._codes:
+            result = await db.execute(
+                text(
+                    "DELETE FROM short_code_pool WHERE code IN "
+                    "(SELECT code FROM short_code_pool LIMIT :batch_size FOR UPDATE SKIP LOCKED) "
+                    "RETURNING code"
+                ),
+                {"batch_size": self.batch_size},
+            )
+            self._codes = list(result.scalars())
+            await db.commit()
+
+        if not self._codes:
+            logger.warning("Short code pool is empty, falling back to random codes")
+            return self.fallback.generate()
+        short_code = self._codes.pop()
+        if short_code in RESERVED_SHORT_CODES:
+            # filled before the code was reserved
+            return await self.next_code(db)
+        return short_code
+
+
+def create_short_code_generator(strategy: str, length: int = SHORT_CODE_LENGTH):
+    if strategy == "random":
+        return RandomCodeGenerator(length)
+    if strategy == "counter":
+        return CounterCodeGenerator(length, SECRET or "", SHORT_CODE_BLOCK_SIZE)
+    if strategy == "pool":
+        return PoolCodeGenerator(length, SHORT_CODE_BLOCK_SIZE)
+    raise ValueError(f"Unknown short code strategy: {strategy}")
+
+
+short_code_generator = create_short_code_generator(SHORT_CODE_STRATEGY)
+
+
+def fill_pool(count: int, length: int = SHORT_CODE_LENGTH):
+    from .database import engine
+
+    generator = RandomCodeGenerator(length)
+    with engine.begin() as connection:
+        for start in range(0, count, 10000):
+            codes = [{"code": generator.generate()} for _ in range(min(10000, count - start))]
+            connection.execute(
+                text(
+                    "INSERT INTO short_code_pool (code) SELECT :code "
+                    "WHERE NOT EXISTS (SELECT 1 FROM link_short_codes WHERE short_code = :code) "
+                    "ON CONFLICT DO NOTHING"
+                ),
+                codes,
+            )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "fill":
+        sys.exit("usage: python -m app.short_codes fill <count>")
+    fill_pool(int(sys.argv[2]))
@@ -0,0 +1,38 @@
+import asyncio
+
+
+class SingleFlight:
+    # concurrent calls with the same key wait for one shared call instead of each making their own
+    def __init__(self):
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def _finish(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.cancelled():
+            # marks a failure as retrieved even if every caller has gone away
+            flight.exception()
+
+    async def do(self, key, func, *args):
+        flight = self._flights.get(key)
+        if flight is None:
+            self.calls += 1
+            flight = asyncio.ensure_future(func(*args))
+            self._flights[key] = flight
+            flight.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.coalesced += 1
+        # a cancelled caller must not cancel the call that the others are still waiting for
+        return await asyncio.shield(flight)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._flights),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+        }
+
+
+link_lookups = SingleFlight()
@@ -0,0 +1,124 @@
+import os
+import socket
+import time
+import uuid
+from collections import deque
+from .config import TOP_LINKS_CAPACITY
+
+
+class SpaceSaving:
+    # keys are grouped by count (stream-summary), so counting a key and replacing the minimum are both O(1);
+    # a count overestimates the true one by at most its error
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._counts = {}
+        self._errors = {}
+        self._buckets = {}
+        self._min = 0
+
+    def add(self, key: str):
+        count = self._counts.get(key)
+        if count is not None:
+            bucket = self._buckets[count]
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[count]
+        elif len(self._counts) < self.capacity:
+            count = 0
+            self._errors[key] = 0
+        elif self.capacity > 0:
+            bucket = self._buckets[self._min]
+            evicted = bucket.pop()
+            if not bucket:
+                del self._buckets[self._min]
+            count = self._counts.pop(evicted)
+            del self._errors[evicted]
+            self._errors[key] = count
+        else:
+            return
+
+        self._counts[key] = count + 1
+        self._buckets.setdefault(count + 1, set()).add(key)
+        if count == 0:
+            self._min = 1
+        elif count == self._min and count not in self._buckets:
+            self._min = count + 1
+
+    def floor(self):
+        # an absent key may have been seen up to this many times
+        return self._min if len(self._counts) >= self.capacity else 0
+
+    def summary(self):
+        return {"floor": self.floor(), "items": {key: [count, self._errors[key]] for key, count in self._counts.items()}}
+
+
+def merge_summaries(summaries, limit: int = None):
+    merged = {}
+    floor = sum(summary["floor"] for summary in summaries)
+    for summary in summaries:
+        for key, (count, error) in summary["items"].items():
+            entry = merged.setdefault(key, [0, 0, 0])
+            entry[0] += count
+            entry[1] += error
+            entry[2] += summary["floor"]
+    # a key missing from some summaries may have been counted there up to their floor
+    items = {key: [count, error + floor - seen_floor] for key, (count, error, seen_floor) in merged.items()}
+    if limit is not None:
+        items = dict(sorted(items.items(), key=lambda item: -item[1][0])[:limit])
+    return {"floor": floor, "items": items}
+
+
+class SlidingTopLinks:
+    # a window is a ring of time slices with a summary each, expired slices are simply dropped
+    def __init__(self, window_seconds: float, slices: int, capacity: int):
+        self.window_seconds = window_seconds
+        self.slice_seconds = window_seconds / slices
+        self.slices = slices
+        self.capacity = capacity
+        self._slices = deque()
+
+    def _expire(self, index: int):
+        while self._slices and self._slices[0][0] <= index - self.slices:
+            self._slices.popleft()
+
+    def add(self, key: str, now: float):
+        index = int(now // self.slice_seconds)
+        if not self._slices or self._slices[-1][0] != index:
+            self._slices.append((index, SpaceSaving(self.capacity)))
+            self._expire(index)
+        self._slices[-1][1].add(key)
+
+    def summary(self, now: float, limit: int = None):
+        self._expire(int(now // self.slice_seconds))
+        return merge_summaries([summary.summary() for _, summary in self._slices], limit)
+
+    def clear(self):
+        self._slices.clear()
+
+
+class TopLinks:
+    def __init__(self, capacity: int):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.capacity = capacity
+        self.windows = {
+            "minute": SlidingTopLinks(60, 6, capacity),
+            "hour": SlidingTopLinks(3600, 12, capacity),
+        }
+        self.clicks = 0
+
+    def record(self, short_code: str):
+        now = time.time()
+        self.clicks += 1
+        for window in self.windows.values():
+            window.add(short_code, now)
+
+    def snapshot(self):
+        now = time.time()
+        return {name: window.summary(now, self.capacity) for name, window in self.windows.items()}
+
+    def clear(self):
+        for window in self.windows.values():
+            window.clear()
+
+
+top_links = TopLinks(TOP_LINKS_CAPACITY)
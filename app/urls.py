@@ -0,0 +1,33 @@
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def canonicalize_url(url: str):
+    # scheme and host are case-insensitive and default ports are redundant, path, query and fragment are kept as is
+    url = url.strip()
+    if "://" not in url:
+        url = "http://" + url
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if ":" in netloc:
+        netloc = f"[{netloc}]"
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{port}"
+    if parts.username is not None:
+        userinfo = parts.username if parts.password is None else f"{parts.username}:{parts.password}"
+        netloc = f"{userinfo}@{netloc}"
+
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, parts.fragment))
+
+
+def url_digest(url: str):
+    return hashlib.sha256(canonicalize_url(url).encode("utf-8")).digest()
@@ -0,0 +1,65 @@
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+
+
+def percentile(latencies, fraction):
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000
+
+
+async def redirect_worker(client, url, deadline, latencies):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await client.get(url)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code in (302, 307), response.status_code
+
+
+async def login_worker(client, credentials, deadline, statuses):
+    while time.perf_counter() < deadline:
+        response = await client.post("/token", data=credentials)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        if response.status_code == 503:
+            await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+
+
+async def measure(client, alias, credentials, redirect_concurrency, login_concurrency, duration):
+    latencies = []
+    statuses = {}
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(
+        *(redirect_worker(client, f"/links/{alias}", deadline, latencies) for _ in range(redirect_concurrency)),
+        *(login_worker(client, credentials, deadline, statuses) for _ in range(login_concurrency)),
+    )
+    latencies.sort()
+    print(f"logins={login_concurrency} redirects={len(latencies)} "
+          f"p50={percentile(latencies, 0.5):.1f}ms p99={percentile(latencies, 0.99):.1f}ms "
+          f"login_statuses={dict(sorted(statuses.items()))}")
+
+
+async def main(base_url, redirect_concurrency, login_concurrency, duration):
+    async with httpx.AsyncClient(base_url=base_url, follow_redirects=False, timeout=60,
+                                 limits=httpx.Limits(max_connections=redirect_concurrency + login_concurrency)) as client:
+        suffix = uuid.uuid4().hex[:8]
+        alias = "bench" + suffix
+        credentials = {"username": "bench" + suffix, "password": "bench_password"}
+        response = await client.post("/links/shorten", json={"original_url": "https://example.com/", "custom_alias": alias})
+        response.raise_for_status()
+        response = await client.post("/register", json={**credentials, "email": f"bench{suffix}@example.com"})
+        response.raise_for_status()
+
+        await measure(client, alias, credentials, redirect_concurrency, 0, duration)
+        await measure(client, alias, credentials, redirect_concurrency, login_concurrency, duration)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Redirect latency while clients hammer POST /token")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent redirect clients")
+    parser.add_argument("--logins", type=int, default=32, help="concurrent login clients")
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.base_url, args.concurrency, args.logins, args.duration))
@@ -0,0 +1,50 @@
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.metrics import Metrics, MetricsMiddleware, statement_operation
+
+
+class Route:
+    path = "/links/{short_code}"
+
+
+async def endpoint(scope, receive, send):
+    scope["route"] = Route
+    await send({"type": "http.response.start", "status": 307, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def discard(message):
+    pass
+
+
+async def time_app(app, requests):
+    scope = {"type": "http", "method": "GET", "path": "/links/goo", "headers": []}
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), None, discard)
+    return (time.perf_counter() - start) / requests
+
+
+async def main(requests):
+    metrics = Metrics()
+    bare = min([await time_app(endpoint, requests) for _ in range(5)])
+    measured = min([await time_app(MetricsMiddleware(endpoint, metrics), requests) for _ in range(5)])
+    print(f"request overhead={(measured - bare) * 1e6:.2f}us (bare {bare * 1e6:.2f}us, measured {measured * 1e6:.2f}us)")
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        metrics.observe_query(statement_operation("SELECT links.id FROM links WHERE links.short_code = $1"), 0.0003)
+    print(f"query overhead={(time.perf_counter() - start) / requests * 1e6:.2f}us (without the engine event dispatch)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-request cost of the metrics middleware")
+    parser.add_argument("--requests", type=int, default=200000)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
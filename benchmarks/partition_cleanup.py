@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import time
+from datetime import timedelta
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from app import models
+from app.database import ASYNC_SQLALCHEMY_DATABASE_URL
+from app.partitions import LinkPartitions, month_start, next_month, current_time
+
+
+# the links table as it was before partitioning, click history cascades through the foreign keys; expires_at
+# gets the same partial index in both layouts, so the comparison measures deleting rather than finding them
+ROW_WISE_SCHEMA = [
+    "CREATE TABLE links (id serial PRIMARY KEY, original_url varchar NOT NULL, short_code varchar NOT NULL UNIQUE, created_at timestamp, "
+    "last_accessed_at timestamp, access_count integer, expires_at timestamp, url_digest bytea, visitors bytea)",
+    "CREATE INDEX ix_links_url_digest ON links (url_digest)",
+    "CREATE INDEX ix_links_expires_at ON links (expires_at) WHERE expires_at IS NOT NULL",
+    "CREATE TABLE link_click_buckets (link_id integer NOT NULL REFERENCES links (id) ON DELETE CASCADE, granularity varchar(4) NOT NULL, "
+    "bucket timestamp NOT NULL, count integer NOT NULL, PRIMARY KEY (link_id, granularity, bucket))",
+    "CREATE TABLE link_visitor_sketches (id bigserial PRIMARY KEY, link_id integer NOT NULL REFERENCES links (id) ON DELETE CASCADE, "
+    "granularity varchar(4) NOT NULL, bucket timestamp NOT NULL, sketch bytea NOT NULL)",
+    "CREATE INDEX ix_link_visitor_sketches_link_id_bucket ON link_visitor_sketches (link_id, bucket)",
+]
+
+
+def schema_engine(schema):
+    return create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, connect_args={"server_settings": {"search_path": schema}})
+
+
+async def create_schema(schema, partitioned):
+    engine = schema_engine("public")
+    async with engine.begin() as connection:
+        await connection.execute(text(f"DROP SCHEMA IF EXISTS {schema} CASCADE"))
+        await connection.execute(text(f"CREATE SCHEMA {schema}"))
+    await engine.dispose()
+
+    engine = schema_engine(schema)
+    async with engine.begin() as connection:
+        if partitioned:
+            await connection.run_sync(lambda sync: models.Base.metadata.create_all(
+                sync, tables=[models.Link.__table__, models.LinkShortCode.__table__, models.LinkClickBucket.__table__, models.LinkVisitorSketch.__table__]
+            ))
+        else:
+            for statement in ROW_WISE_SCHEMA:
+                await connection.execute(text(statement))
+    return engine
+
+
+async def populate(engine, rows, expired_share, months, buckets, first_month):
+    # expired links are spread evenly over `months` months before the current one, the rest never expire
+    async with engine.begin() as connection:
+        await connection.execute(text(
+            "INSERT INTO links (original_url, short_code, created_at, access_count, expires_at) "
+            "SELECT 'https://example.com/' || i, 'b' || i, localtimestamp, 0, "
+            "CASE WHEN i % 1000 < :expired THEN CAST(:first_month AS timestamp) + (i % :months) * interval '1 month' + interval '14 days' END "
+            "FROM generate_series(1, :rows) AS i"
+        ), {"rows": rows, "expired": int(expired_share * 1000), "months": months, "first_month": first_month})
+        await connection.execute(text(
+            "INSERT INTO link_click_buckets (link_id, granularity, bucket, count) "
+            "SELECT id, 'day', timestamp '2025-01-01' + day * interval '1 day', 1 FROM links, generate_series(1, :buckets) AS day"
+        ), {"buckets": buckets})
+        await connection.execute(text(
+            "INSERT INTO link_visitor_sketches (link_id, granularity, bucket, sketch) SELECT id, 'day', timestamp '2025-01-01', '\\x00'::bytea FROM links"
+        ))
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await connection.execute(text("VACUUM ANALYZE"))
+
+
+async def measure(engine, cleanup):
+    async with engine.connect() as connection:
+        wal_before = await connection.scalar(text("SELECT pg_current_wal_lsn()"))
+    started = time.perf_counter()
+    removed = await cleanup()
+    seconds = time.perf_counter() - started
+    async with engine.connect() as connection:
+        wal_bytes = await connection.scalar(text("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), :before)"), {"before": wal_before})
+        # cumulative statistics are flushed by the backends every second or so
+        await asyncio.sleep(1.5)
+        # dead rows in links slow down every redirect until vacuum, the ones in the click history only the stats
+        links_dead, history_dead = (await connection.execute(text(
+            "SELECT coalesce(sum(n_dead_tup) FILTER (WHERE relname ~ '^links'), 0), coalesce(sum(n_dead_tup) FILTER (WHERE relname !~ '^links'), 0) "
+            "FROM pg_stat_user_tables WHERE schemaname = current_schema()"
+        ))).one()
+        links_size = await connection.scalar(text(
+            "SELECT sum(pg_total_relation_size(oid)) FROM pg_class WHERE relnamespace = current_schema()::regnamespace AND relkind = 'r' AND relname ~ '^links'"
+        ))
+    return removed, seconds, int(wal_bytes), int(links_dead), int(history_dead), links_size
+
+
+async def row_wise_cleanup(engine, before, batch_size):
+    # what the expiry sweep did before links were partitioned, one batch per transaction
+    removed = 0
+    async with engine.connect() as connection:
+        while True:
+            deleted = (await connection.execute(text(
+                "DELETE FROM links WHERE id IN (SELECT id FROM links WHERE expires_at IS NOT NULL AND expires_at < :before LIMIT :batch_size)"
+            ), {"before": before, "batch_size": batch_size})).rowcount
+            await connection.commit()
+            removed += deleted
+            if deleted < batch_size:
+                return removed
+
+
+async def main(rows, expired_share, months, buckets, batch_size, keep):
+    now = current_time()
+    current_month = month_start(now)
+    first_month = current_month
+    for _ in range(months):
+        first_month = (first_month - timedelta(days=1)).replace(day=1)
+
+    row_wise = await create_schema("bench_row_wise", partitioned=False)
+    partitioned = await create_schema("bench_partitioned", partitioned=True)
+    partitions = LinkPartitions(ahead_months=0)
+    async with async_sessionmaker(bind=partitioned)() as db:
+        month, expiries = first_month, []
+        while month < current_month:
+            expiries.append(month)
+            month = next_month(month)
+        await partitions.ensure(db, expiries)
+
+    for engine in (row_wise, partitioned):
+        await populate(engine, rows, expired_share, months, buckets, first_month)
+
+    results = {"row-wise": await measure(row_wise, lambda: row_wise_cleanup(row_wise, current_month, batch_size))}
+
+    async def drop_partitions():
+        async with async_sessionmaker(bind=partitioned)() as db:
+            return await partitions.drop_expired(db, current_month)
+
+    results["partition drop"] = await measure(partitioned, drop_partitions)
+
+    for name, (removed, seconds, wal_bytes, links_dead, history_dead, links_size) in results.items():
+        print(
+            f"rows={rows} cleanup={name} removed={removed} seconds={seconds:.2f} wal_mb={wal_bytes / 2 ** 20:.1f} "
+            f"links_dead_tuples={links_dead} other_dead_tuples={history_dead} links_size_after_mb={links_size / 2 ** 20:.1f}"
+        )
+
+    if not keep:
+        async with row_wise.begin() as connection:
+            await connection.execute(text("DROP SCHEMA bench_row_wise CASCADE"))
+            await connection.execute(text("DROP SCHEMA bench_partitioned CASCADE"))
+    await row_wise.dispose()
+    await partitioned.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Expired link cleanup: batched row-wise deletes against dropping monthly partitions")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--expired-share", type=float, default=0.5)
+    parser.add_argument("--months", type=int, default=6)
+    parser.add_argument("--buckets", type=int, default=3, help="daily click buckets per link")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--keep", action="store_true", help="keep the bench_* schemas for inspection")
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.expired_share, args.months, args.buckets, args.batch_size, args.keep))
@@ -0,0 +1,42 @@
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+
+
+async def worker(client, url, deadline, latencies, missing):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await client.get(f"/links/{uuid.uuid4().hex[:10]}" if missing else url)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 404 if missing else response.status_code in (302, 307), response.status_code
+
+
+async def main(base_url, concurrency, duration, missing):
+    async with httpx.AsyncClient(base_url=base_url, follow_redirects=False, timeout=30,
+                                 limits=httpx.Limits(max_connections=concurrency)) as client:
+        alias = "bench" + uuid.uuid4().hex[:8]
+        response = await client.post("/links/shorten", json={"original_url": "https://example.com/", "custom_alias": alias})
+        response.raise_for_status()
+
+        latencies = []
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(worker(client, f"/links/{alias}", deadline, latencies, missing) for _ in range(concurrency)))
+
+    latencies.sort()
+    print(f"concurrency={concurrency} requests={len(latencies)} "
+          f"rps={len(latencies) / duration:.0f} "
+          f"p50={latencies[len(latencies) // 2] * 1000:.1f}ms "
+          f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Redirect throughput under concurrent load")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--missing", action="store_true", help="request random unknown codes, as scanners do")
+    args = parser.parse_args()
+    asyncio.run(main(args.base_url, args.concurrency, args.duration, args.missing))
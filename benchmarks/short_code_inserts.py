@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app import models
+from app.database import async_engine, AsyncSessionLocal
+from app.short_codes import create_short_code_generator
+
+
+async def seed(rows):
+    async with async_engine.begin() as connection:
+        await connection.run_sync(models.Base.metadata.create_all)
+        existing = await connection.scalar(text("SELECT count(*) FROM links"))
+        if existing >= rows:
+            return existing
+
+        # seeded codes start with "_", which is outside the base62 alphabet, so they never collide with generated ones
+        await connection.execute(
+            text(
+                "INSERT INTO links (original_url, short_code, created_at, access_count) "
+                "SELECT 'https://example.com/' || i, '_' || i, now(), 0 FROM generate_series(CAST(:start AS bigint), CAST(:stop AS bigint)) AS i"
+            ),
+            {"start": existing + 1, "stop": rows},
+        )
+        return rows
+
+
+async def insert_link(db, generator, probe):
+    while True:
+        short_code = await generator.next_code(db)
+        if probe and await db.scalar(select(models.Link.id).where(models.Link.short_code == short_code)) is not None:
+            continue
+
+        # a taken code is skipped by the links_claim_short_code trigger and returns no id
+        inserted = await db.scalar(
+            pg_insert(models.Link).values(original_url="https://example.com/", short_code=short_code, access_count=0).returning(models.Link.id)
+        )
+        await db.commit()
+        if inserted is not None:
+            return
+
+
+async def worker(generator, probe, deadline, counter):
+    async with AsyncSessionLocal() as db:
+        while time.perf_counter() < deadline:
+            await insert_link(db, generator, probe)
+            counter[0] += 1
+
+
+async def run(strategy, concurrency, duration):
+    probe = strategy == "probe"
+    generator = create_short_code_generator("random" if probe else strategy)
+    counter = [0]
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(worker(generator, probe, deadline, counter) for _ in range(concurrency)))
+    return counter[0] / duration
+
+
+async def main(rows, strategies, concurrency, duration):
+    seeded = await seed(rows)
+    for strategy in strategies:
+        inserts_per_second = await run(strategy, concurrency, duration)
+        print(f"rows={seeded} strategy={strategy} concurrency={concurrency} inserts/sec={inserts_per_second:.0f}")
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Link inserts/sec per short code strategy on a large links table")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--strategies", nargs="+", default=["probe", "random", "counter"])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.strategies, args.concurrency, args.duration))
@@ -0,0 +1,46 @@
+import argparse
+import asyncio
+import json
+import sys
+
+from app.config import STORAGE_BACKEND
+from app.database import async_engine
+from app.importer import IMPORT_FORMATS, import_links
+from app.repositories import create_repositories
+
+
+async def read_lines(path):
+    with (sys.stdin if path == "-" else open(path, encoding="utf-8")) as file:
+        for line in file:
+            yield line.rstrip("\r\n")
+
+
+def print_progress(progress):
+    print(
+        f"offset={progress['offset']} imported={progress['imported']} conflicts={progress['conflicts']} "
+        f"invalid={progress['invalid']} rows/sec={progress['rows_per_sec']}",
+        file=sys.stderr,
+    )
+
+
+async def main(path, fmt, offset, chunk_size):
+    links, _ = create_repositories(STORAGE_BACKEND)
+    try:
+        await links.prepare()
+        result = await import_links(links, read_lines(path), fmt, offset=offset, chunk_size=chunk_size, on_progress=print_progress)
+        print(json.dumps(result))
+    finally:
+        await links.close()
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a CSV or NDJSON file of links into the links table")
+    parser.add_argument("path", help="file with original_url, custom_alias and expires_at columns, - for stdin")
+    parser.add_argument("--format", choices=IMPORT_FORMATS)
+    parser.add_argument("--offset", type=int, default=0, help="number of data rows to skip, the last reported offset resumes an interrupted import")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    fmt = args.format or ("ndjson" if args.path.endswith((".ndjson", ".jsonl")) else "csv")
+    asyncio.run(main(args.path, fmt, args.offset, args.chunk_size))
@@ -0,0 +1,160 @@
+import bisect
+import itertools
+import random
+import uuid
+
+import requests
+from locust import HttpUser, task, events, constant, constant_pacing, between
+
+
+SEED_BATCH_SIZE = 1000
+LOGIN_BURST = 5
+BATCH_CREATE_SIZE = 100
+
+
+class Dataset:
+    # links and the user every scenario works with; the aliases only depend on the seed, so a rerun against
+    # the same database finds them already there and redirects the same codes
+    def __init__(self):
+        self.host = None
+        self.seed = None
+        self.short_codes = []
+        self.cumulative = []
+        self.credentials = None
+        self.users = itertools.count()
+
+    def load(self, host, links, seed, zipf_exponent):
+        if (self.host, self.seed, len(self.short_codes)) == (host, seed, links):
+            return
+        session = requests.Session()
+        self.credentials = {"username": f"bench{seed}", "password": "bench_password"}
+        response = session.post(f"{host}/register", json={**self.credentials, "email": f"bench{seed}@example.com"})
+        if response.status_code not in (200, 400):
+            response.raise_for_status()
+
+        short_codes = [f"z{seed}-{index}" for index in range(links)]
+        for start in range(0, links, SEED_BATCH_SIZE):
+            response = session.post(f"{host}/links/shorten/batch", json=[
+                {"original_url": f"https://example.com/{seed}/{short_code}", "custom_alias": short_code}
+                for short_code in short_codes[start:start + SEED_BATCH_SIZE]
+            ])
+            response.raise_for_status()
+
+        # rank r is requested with probability proportional to 1 / r ** s, like real link popularity
+        total = 0
+        self.cumulative = []
+        for rank in range(1, links + 1):
+            total += 1 / rank ** zipf_exponent
+            self.cumulative.append(total)
+        self.short_codes = short_codes
+        self.host, self.seed = host, seed
+
+    def rng(self):
+        # every user gets its own generator, so two runs with the same seed send the same requests
+        return random.Random(f"{self.seed}-{next(self.users)}")
+
+    def popular_code(self, rng):
+        return self.short_codes[bisect.bisect_left(self.cumulative, rng.random() * self.cumulative[-1])]
+
+
+dataset = Dataset()
+
+
+@events.init_command_line_parser.add_listener
+def add_arguments(parser):
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated links and requests")
+    parser.add_argument("--seed-links", type=int, default=10000, help="links created before the run")
+    parser.add_argument("--zipf-exponent", type=float, default=1.1, help="skew of redirect popularity")
+
+
+@events.test_start.add_listener
+def seed_data(environment, **kwargs):
+    options = environment.parsed_options
+    dataset.load(environment.host, options.seed_links, options.seed, options.zipf_exponent)
+
+
+class BenchUser(HttpUser):
+    abstract = True
+
+    def on_start(self):
+        self.rng = dataset.rng()
+
+
+class ZipfRedirectUser(BenchUser):
+    weight = 80
+    wait_time = constant(0)
+
+    @task
+    def redirect(self):
+        self.client.get(f"/links/{dataset.popular_code(self.rng)}", name="/links/[short_code]", allow_redirects=False)
+
+
+class MissingCodeUser(BenchUser):
+    # scanners guessing codes, every request is a miss that must not reach the database
+    weight = 0
+    wait_time = constant(0)
+
+    @task
+    def miss(self):
+        short_code = uuid.UUID(int=self.rng.getrandbits(128)).hex[:10]
+        with self.client.get(f"/links/{short_code}", name="/links/[missing]", allow_redirects=False, catch_response=True) as response:
+            if response.status_code == 404:
+                response.success()
+            else:
+                response.failure(f"expected 404, got {response.status_code}")
+
+
+class ShortenUser(BenchUser):
+    weight = 10
+    wait_time = between(0.5, 1)
+
+    @task
+    def shorten(self):
+        self.client.post("/links/shorten", json={"original_url": f"https://example.com/new/{self.rng.getrandbits(64)}"})
+
+
+class BatchCreateUser(BenchUser):
+    weight = 0
+    wait_time = constant(0)
+
+    @task
+    def shorten_batch(self):
+        self.client.post("/links/shorten/batch", json=[
+            {"original_url": f"https://example.com/batch/{self.rng.getrandbits(64)}"} for _ in range(BATCH_CREATE_SIZE)
+        ])
+
+
+class StatsPollingUser(BenchUser):
+    # dashboards refreshing the stats of popular links a few times a second
+    weight = 10
+    wait_time = constant_pacing(0.25)
+
+    @task
+    def stats(self):
+        self.client.get(f"/links/{dataset.popular_code(self.rng)}/stats", name="/links/[short_code]/stats")
+
+    @task
+    def hourly_stats(self):
+        self.client.get(f"/links/{dataset.popular_code(self.rng)}/stats?granularity=hour", name="/links/[short_code]/stats?granularity=hour")
+
+
+class LoginUser(BenchUser):
+    weight = 0
+    wait_time = between(1, 2)
+
+    @task
+    def login_burst(self):
+        for _ in range(LOGIN_BURST):
+            with self.client.post("/token", data=dataset.credentials, catch_response=True) as response:
+                if response.status_code == 503:
+                    response.failure("shed by the password hasher")
+
+
+# scenario -> user class -> weight
+SCENARIOS = {
+    "redirect_mix": {ZipfRedirectUser: 80, ShortenUser: 10, StatsPollingUser: 10},
+    "miss_storm": {MissingCodeUser: 80, ZipfRedirectUser: 20},
+    "login_burst": {LoginUser: 50, ZipfRedirectUser: 50},
+    "batch_create": {BatchCreateUser: 1},
+    "stats_polling": {StatsPollingUser: 1},
+}
@@ -0,0 +1,38 @@
+PERCENTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+# latencies this close to the baseline are noise whatever the ratio
+MIN_LATENCY_DELTA_MS = 1.0
+
+
+def summarize(entry, seconds: float):
+    summary = {
+        "requests": entry.num_requests,
+        "failures": entry.num_failures,
+        "rps": round(entry.num_requests / seconds, 1),
+    }
+    for name, fraction in PERCENTILES.items():
+        summary[name] = entry.get_response_time_percentile(fraction) if entry.num_requests else None
+    return summary
+
+
+def compare(report: dict, baseline: dict, threshold: float):
+    # a regression is a percentile more than `threshold` above the baseline, throughput more than `threshold`
+    # below it or a failure share more than `threshold` / 10 above it; requests missing from either side are not compared
+    regressions = []
+    for scenario, requests in report["scenarios"].items():
+        for name, current in requests.items():
+            previous = baseline.get("scenarios", {}).get(scenario, {}).get(name)
+            if previous is None:
+                continue
+            label = f"{scenario} {name}"
+            for percentile in PERCENTILES:
+                if current[percentile] is None or previous[percentile] is None:
+                    continue
+                if current[percentile] > previous[percentile] * (1 + threshold) and current[percentile] - previous[percentile] > MIN_LATENCY_DELTA_MS:
+                    regressions.append(f"{label}: {percentile} {previous[percentile]:.0f}ms -> {current[percentile]:.0f}ms")
+            if current["rps"] < previous["rps"] * (1 - threshold):
+                regressions.append(f"{label}: rps {previous['rps']} -> {current['rps']}")
+            failure_share = current["failures"] / current["requests"] if current["requests"] else 0
+            previous_failure_share = previous["failures"] / previous["requests"] if previous["requests"] else 0
+            if failure_share > previous_failure_share + threshold / 10:
+                regressions.append(f"{label}: failures {previous_failure_share:.1%} -> {failure_share:.1%}")
+    return regressions
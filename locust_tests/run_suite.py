@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+import gevent
+from locust.argument_parser import get_parser
+from locust.env import Environment
+from locust import events
+
+from locust_tests import locustfile
+from locust_tests.report import summarize, compare
+
+
+def run_scenario(name, options, users, warmup, duration):
+    # the weights of the scenario replace the default ones of the user classes
+    user_classes = [type(user_class.__name__, (user_class,), {"weight": weight}) for user_class, weight in locustfile.SCENARIOS[name].items()]
+    environment = Environment(user_classes=user_classes, events=events, host=options.host, parsed_options=options)
+    runner = environment.create_local_runner()
+    runner.start(users, spawn_rate=users)
+    # counting starts once every user runs and the caches are warm
+    gevent.sleep(warmup)
+    environment.stats.reset_all()
+    started = time.perf_counter()
+    gevent.sleep(duration)
+    seconds = time.perf_counter() - started
+    runner.quit()
+
+    requests = {f"{entry.method} {entry.name}": summarize(entry, seconds) for entry in environment.stats.entries.values()}
+    requests["Aggregated"] = summarize(environment.stats.total, seconds)
+    return requests
+
+
+def main(args):
+    options = get_parser().parse_args([
+        "--headless", "--host", args.host,
+        "--seed", str(args.seed), "--seed-links", str(args.seed_links), "--zipf-exponent", str(args.zipf_exponent),
+    ])
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": args.host,
+        "settings": {
+            "users": args.users, "warmup": args.warmup, "duration": args.duration,
+            "seed": args.seed, "seed_links": args.seed_links, "zipf_exponent": args.zipf_exponent,
+        },
+        "scenarios": {},
+    }
+    for name in args.scenarios:
+        requests = run_scenario(name, options, args.users, args.warmup, args.duration)
+        report["scenarios"][name] = requests
+        for request, summary in requests.items():
+            print(f"scenario={name} request={request!r} requests={summary['requests']} failures={summary['failures']} "
+                  f"rps={summary['rps']} p50={summary['p50']}ms p95={summary['p95']}ms p99={summary['p99']}ms")
+
+    with open(args.report, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    if args.update_baseline:
+        shutil.copyfile(args.report, args.baseline)
+        print(f"Baseline {args.baseline} updated")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --update-baseline to store this one")
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline["settings"] != report["settings"]:
+        print(f"Baseline was recorded with other settings {baseline['settings']}, comparison is approximate")
+    regressions = compare(report, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"{len(regressions)} regressions against {args.baseline} (threshold {args.threshold:.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless load-test scenarios with a JSON report compared against a baseline")
+    parser.add_argument("--host", default="http://localhost:8000")
+    parser.add_argument("--scenarios", nargs="+", choices=list(locustfile.SCENARIOS), default=list(locustfile.SCENARIOS))
+    parser.add_argument("--users", type=int, default=32, help="concurrent users in every scenario")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds before the counters are reset")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds per scenario")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--seed-links", type=int, default=10000)
+    parser.add_argument("--zipf-exponent", type=float, default=1.1)
+    parser.add_argument("--report", default="locust_report.json")
+    parser.add_argument("--baseline", default="locust_tests/baseline.json")
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative change of latency and throughput")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,42 @@
+import argparse
+import asyncio
+import json
+import sys
+
+from app.database import AsyncSessionLocal, async_engine, ShardSessionLocals, shard_async_engines
+from app.shards import shard_router, create_shard_tables, prepare_id_sequences, rebalance
+
+
+def print_progress(progress):
+    print(f"shard={progress['shard']} last_id={progress['last_id']} scanned={progress['scanned']} moved={progress['moved']}", file=sys.stderr)
+
+
+async def main(batch_size, pause):
+    try:
+        dbs = [AsyncSessionLocal()] + [session_local() for session_local in ShardSessionLocals]
+        try:
+            for db in dbs[1:]:
+                await create_shard_tables(db)
+            await prepare_id_sequences(dbs)
+            result = await rebalance(dbs, batch_size=batch_size, pause=pause, on_progress=print_progress)
+        finally:
+            for db in dbs:
+                await db.close()
+        print(json.dumps(result))
+    finally:
+        await async_engine.dispose()
+        for shard_engine in shard_async_engines:
+            await shard_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Move links to the shard their short code hashes to under LINK_SHARDS, run after adding shards "
+                    "while the workers read with LINK_SHARDS_PREVIOUS_COUNT set to the old shard count"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000, help="links scanned per transaction on the source shard")
+    parser.add_argument("--pause", type=float, default=0.1, help="seconds to sleep between batches")
+    args = parser.parse_args()
+
+    print(f"shards={shard_router.count}", file=sys.stderr)
+    asyncio.run(main(args.batch_size, args.pause))
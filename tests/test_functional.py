@@ -1,35 +1,96 @@
+import asyncio
+import json
+import time
+import httpx
 import pytest
+from datetime import datetime, timedelta
 from fastapi.testclient import TestClient
+from app import main, hash, database
 from app.main import app, get_db
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from app.database import Base, SessionLocal
-from app.config import DB_USER, DB_PASS, DB_HOST, DB_PORT, DB_NAME
+from app.short_codes import CounterCodeGenerator
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from passlib.context import CryptContext
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
+from app.database import Base
+from app.embedded import MemoryLinkRepository, MemoryUserRepository, SqliteStore
+from app.repositories import PostgresLinkRepository
+from app.cache import link_cache
+from app.clicks import click_buffer, compact_click_buckets, compact_visitor_sketches, clicks_update, rollup_upsert, visitor_sketches_insert, locked_visitors
+from app.hll import HyperLogLog
+from app.expiry import expiry_scheduler
+from app.auth import principal_cache
+from app.bloom import ShortCodeFilter, short_code_filter
+from app.top_links import top_links
+from app.click_log import click_log, ingest_click_log
+from app.metrics import metrics, instrument_engine
+from app.replica import READ_PRIMARY_COOKIE, recent_writes
+from app.shards import shard_router, SHARD_ID_STRIDE
+from app.partitions import link_partitions
+from app.config import DB_USER, DB_PASS, DB_HOST, DB_PORT, DB_NAME, LINK_MAX_TTL_DAYS
 
 
 TEST_DATABASE_URL = f"postgresql+psycopg2://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/test_{DB_NAME}"
+ASYNC_TEST_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/test_{DB_NAME}"
+
+
+# the app runs against every storage backend; tests of what only postgres has (raw SQL, shards, partitions,
+# COPY, click_events) are limited to it with postgres_only
+postgres_only = pytest.mark.parametrize("storage_backend", ["postgres"], indirect=True)
+# tests that count SQL statements, the memory store runs none
+sql_backends = pytest.mark.parametrize("storage_backend", ["postgres", "sqlite"], indirect=True)
+
+
+@pytest.fixture(params=["postgres", "memory", "sqlite"])
+def storage_backend(request):
+    return request.param
 
 
 @pytest.fixture()
-def test_db():
-    engine = create_engine(TEST_DATABASE_URL)
-    Base.metadata.create_all(bind=engine)
+def test_db(storage_backend):
+    if storage_backend != "postgres":
+        pytest.skip("needs the postgres storage backend")
+    try:
+        engine = create_engine(TEST_DATABASE_URL)
+        Base.metadata.create_all(bind=engine)
+    except (ValueError, OperationalError):
+        # no DB_* settings or no server to connect to
+        pytest.skip("PostgreSQL is not available")
     yield engine
     Base.metadata.drop_all(bind=engine)
 
 
 @pytest.fixture()
-def test_client(test_db):
-    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=test_db)
+def test_client(request, storage_backend, monkeypatch, tmp_path):
+    if storage_backend == "postgres":
+        request.getfixturevalue("test_db")
+        async_test_engine = create_async_engine(ASYNC_TEST_DATABASE_URL, poolclass=NullPool)
+        instrument_engine(async_test_engine, "test")
+        TestingSessionLocal = async_sessionmaker(bind=async_test_engine, autoflush=False, expire_on_commit=False)
 
-    def test_get_db():
-        db = TestingSessionLocal()
-        try:
-            yield db
-        finally:
-            db.close()
+        async def test_get_db():
+            async with TestingSessionLocal() as db:
+                yield db
 
-    app.dependency_overrides[get_db] = test_get_db
+        app.dependency_overrides[get_db] = test_get_db
+    elif storage_backend == "memory":
+        monkeypatch.setattr(main, "link_repository", MemoryLinkRepository())
+        monkeypatch.setattr(main, "user_repository", MemoryUserRepository())
+    else:
+        store = SqliteStore(str(tmp_path / "links.sqlite3"))
+        monkeypatch.setattr(main, "link_repository", store.links)
+        monkeypatch.setattr(main, "user_repository", store.users)
+    link_cache.clear()
+    expiry_scheduler.clear()
+    principal_cache.clear()
+    short_code_filter.clear()
+    top_links.clear()
+    click_log.directory = str(tmp_path / "click_log")
+    metrics.clear()
+    recent_writes.clear()
+    link_partitions.clear()
 
     with TestClient(app) as c:
         yield c
@@ -87,6 +148,26 @@ def test_login_user_with_error(test_client, create_test_user):
     assert response.status_code == 401
 
 
+@postgres_only
+def test_login_user_rehashes_password_with_new_cost(test_db, test_client, create_test_user, monkeypatch):
+    monkeypatch.setattr(hash, "pwd_context", CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=4, bcrypt__min_rounds=4, bcrypt__max_rounds=4))
+    response = test_client.post("/token", data={"username": "test_user", "password": "test_user_password"})
+    assert response.status_code == 200
+    with test_db.connect() as connection:
+        assert connection.scalar(text("SELECT password FROM users WHERE username = 'test_user'")).startswith("$2b$04$")
+
+    response = test_client.post("/token", data={"username": "test_user", "password": "test_user_password"})
+    assert response.status_code == 200
+
+
+def test_register_user_when_password_hasher_is_busy(test_client, monkeypatch):
+    monkeypatch.setattr(hash.password_hasher, "queue_size", 0)
+    monkeypatch.setattr(hash.password_hasher, "in_flight", hash.password_hasher.workers)
+    response = test_client.post("/register", json={"username": "new_user", "email": "new_user@yandex.ru", "password": "new_user_password"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
 def test_create_short_link_with_custom_alias(test_client):
     response = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "goo"})
     assert response.status_code == 200
@@ -105,6 +186,19 @@ def test_create_short_link_without_custom_alias(test_client):
     assert len(response_json["short_code"]) == 6
 
 
+def test_create_short_link_with_counter_strategy(test_client, monkeypatch):
+    monkeypatch.setattr("app.repositories.short_code_generator", CounterCodeGenerator(length=6, key="test", block_size=2))
+
+    short_codes = set()
+    for _ in range(3):
+        response = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/"})
+        assert response.status_code == 200
+        short_codes.add(response.json()["short_code"])
+
+    assert len(short_codes) == 3
+    assert all(len(short_code) == 6 for short_code in short_codes)
+
+
 def test_create_short_link_with_existing_link(test_client):
     response = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "goo"})
     assert response.status_code == 200
@@ -114,6 +208,82 @@ def test_create_short_link_with_existing_link(test_client):
     assert response.status_code == 400
 
 
+def test_create_short_links_batch(test_client, create_test_short_link):
+    response = test_client.post("/links/shorten/batch", json=[
+        {"original_url": "https://www.google.com/", "custom_alias": "goo"},
+        {"original_url": "https://www.yandex.ru/", "custom_alias": "ya"},
+        {"original_url": "https://www.yandex.ru/maps", "custom_alias": "ya"},
+        {"original_url": "https://www.python.org/"},
+    ])
+    response_json = response.json()
+    assert response.status_code == 200
+    assert len(response_json) == 4
+    assert response_json[0] == {"detail": "Short code already exist", "original_url": "https://www.google.com/", "short_code": "goo"}
+    assert response_json[1] == {"message": "Link successfully created", "original_url": "https://www.yandex.ru/", "short_code": "ya"}
+    assert response_json[2] == {"detail": "Short code already exist", "original_url": "https://www.yandex.ru/maps", "short_code": "ya"}
+    assert response_json[3]["message"] == "Link successfully created"
+    assert len(response_json[3]["short_code"]) == 6
+
+    response = test_client.get(f"/links/{response_json[3]['short_code']}/stats")
+    assert response.status_code == 200
+    assert response.json()["original_url"] == "https://www.python.org/"
+
+
+def test_import_links_csv(test_client, create_test_short_link, get_token):
+    content = (
+        "original_url,custom_alias,expires_at\n"
+        "https://www.google.com/,goo,\n"
+        "https://www.yandex.ru/,ya,\n"
+        "https://www.python.org/,,2030-01-01 00:00\n"
+        "not a valid row,,not a date\n"
+    )
+    response = test_client.post("/links/import?format=csv", content=content, headers={"Authorization": f"Bearer {get_token}"})
+    response_json = response.json()
+    assert response.status_code == 200
+    assert response_json["imported"] == 2
+    assert response_json["conflicts"] == 1
+    assert response_json["invalid"] == 1
+    assert response_json["offset"] == 4
+
+    response = test_client.get("/links/ya/stats")
+    assert response.status_code == 200
+    assert response.json()["original_url"] == "https://www.yandex.ru/"
+
+
+def test_import_links_ndjson_with_offset(test_client, get_token):
+    content = "\n".join([
+        '{"original_url": "https://www.google.com/", "custom_alias": "goo"}',
+        '{"original_url": "https://www.yandex.ru/", "custom_alias": "ya"}',
+        '{"original_url": "https://www.python.org/"}',
+    ])
+    response = test_client.post("/links/import?format=ndjson&offset=1", content=content, headers={"Authorization": f"Bearer {get_token}"})
+    assert response.status_code == 200
+    assert response.json()["imported"] == 2
+    assert response.json()["offset"] == 3
+
+    assert test_client.get("/links/goo/stats").status_code == 404
+    assert test_client.get("/links/ya/stats").status_code == 200
+
+
+def test_import_links_requires_a_user(test_client):
+    response = test_client.post("/links/import?format=csv", content="original_url,custom_alias\nhttps://www.yandex.ru/,ya\n")
+    assert response.status_code == 401
+    assert test_client.get("/links/ya/stats").status_code == 404
+
+
+@postgres_only
+def test_imported_links_belong_to_the_importing_user(test_db, test_client, create_test_short_link, get_token):
+    content = "original_url,custom_alias\nhttps://www.yandex.ru/,ya\n"
+    response = test_client.post("/links/import?format=csv", content=content, headers={"Authorization": f"Bearer {get_token}"})
+    assert response.json()["imported"] == 1
+
+    with test_db.connect() as connection:
+        owners = dict(connection.execute(text(
+            "SELECT links.short_code, users.username FROM links LEFT JOIN users ON users.id = links.user_id"
+        )).all())
+    assert owners == {"ya": "test_user", "goo": None}
+
+
 def test_redirect(test_client, create_test_short_link):
     response = test_client.get("/links/goo")
     assert response.status_code == 200
@@ -124,6 +294,63 @@ def test_redirect_with_not_existing_link(test_client, create_test_short_link):
     assert response.status_code == 404
 
 
+@postgres_only
+def test_redirect_miss_past_the_filter_is_looked_up_once(test_db, test_client, create_test_short_link):
+    # deleted behind the application's back, so the filter still lets the code through
+    with test_db.begin() as connection:
+        connection.execute(text("DELETE FROM links WHERE short_code = 'goo'"))
+    calls = test_client.get("/cache/stats").json()["lookups"]["calls"]
+    response = test_client.get("/links/goo", follow_redirects=False)
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Link not found"}
+    assert test_client.get("/cache/stats").json()["lookups"]["calls"] - calls == 1
+
+
+@postgres_only
+def test_redirect_with_unknown_link_is_answered_by_filter(test_db, test_client):
+    for _ in range(100):
+        if short_code_filter.ready:
+            break
+        time.sleep(0.05)
+    response = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "goo"})
+    assert response.status_code == 200
+    with test_db.begin() as connection:
+        connection.execute(text("INSERT INTO links (original_url, short_code, created_at, access_count) VALUES ('https://www.ya.ru/', 'other', now(), 0)"))
+
+    before = test_client.get("/cache/stats").json()["short_codes"]
+    assert test_client.get("/links/some_link").status_code == 404
+    assert test_client.get("/links/goo", follow_redirects=False).status_code == 307
+    after = test_client.get("/cache/stats").json()["short_codes"]
+    assert after["rejected"] - before["rejected"] == 1
+    assert after["false_positives"] == before["false_positives"]
+
+    # links written by other processes show up after the next refresh
+    time.sleep(main.SHORT_CODE_FILTER_REFRESH_INTERVAL * 2)
+    assert test_client.get("/links/other", follow_redirects=False).status_code == 307
+
+
+@postgres_only
+def test_short_code_filter_of_another_worker_never_misses_new_codes(test_client, create_test_short_link, get_token):
+    # the filter of another worker, built before the rename and the new link that go through this one
+    other = ShortCodeFilter(0.01, 1000)
+    asyncio.run(main.link_repository.refresh_short_code_filter(other, True))
+
+    headers = {"Authorization": f"Bearer {get_token}"}
+    response = test_client.put("/links/goo", json={"short_code_old": "goo", "short_code_new": "gl"}, headers=headers)
+    assert response.status_code == 200
+    response = test_client.post("/links/shorten", json={"original_url": "https://www.ya.ru/", "custom_alias": "fresh"})
+    assert response.status_code == 200
+
+    async def refresh():
+        await main.link_repository.refresh_short_code_filter(other, False)
+
+    async def lookup():
+        return [await other.might_exist(short_code, refresh) for short_code in ("gl", "fresh", "missing")]
+
+    assert asyncio.run(lookup()) == [True, True, False]
+    assert other.rejected == 1
+
+
 def test_update_short_link(test_client, create_test_short_link, get_token):
     headers = {"Authorization": f"Bearer {get_token}"}
     response = test_client.put(f"/links/goo", json={"short_code_old": "goo", "short_code_new": "gl"}, headers=headers)
@@ -131,6 +358,35 @@ def test_update_short_link(test_client, create_test_short_link, get_token):
     assert response.json() == {"message" : "short_code updated successfully", "original_url" : "https://www.google.com/", "short_code" : "gl"}
 
 
+def test_redirect_after_update_short_link(test_client, create_test_short_link, get_token):
+    response = test_client.get("/links/goo", follow_redirects=False)
+    assert response.status_code == 307
+
+    headers = {"Authorization": f"Bearer {get_token}"}
+    response = test_client.put(f"/links/goo", json={"short_code_old": "goo", "short_code_new": "gl"}, headers=headers)
+    assert response.status_code == 200
+
+    response = test_client.get("/links/goo", follow_redirects=False)
+    assert response.status_code == 404
+    response = test_client.get("/links/gl", follow_redirects=False)
+    assert response.status_code == 307
+    assert response.headers["location"] == "https://www.google.com/"
+
+
+def test_reserved_short_codes_are_rejected(test_client, create_test_short_link, get_token):
+    response = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "top"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Short code is reserved"}
+
+    response = test_client.post("/links/shorten/batch", json=[{"original_url": "https://www.google.com/", "custom_alias": "search"}])
+    assert response.json() == [{"detail": "Short code is reserved", "original_url": "https://www.google.com/", "short_code": "search"}]
+
+    headers = {"Authorization": f"Bearer {get_token}"}
+    response = test_client.put("/links/goo", json={"short_code_old": "goo", "short_code_new": "expired"}, headers=headers)
+    assert response.status_code == 400
+    assert test_client.get("/links/goo", follow_redirects=False).status_code == 307
+
+
 def test_update_short_link_with_not_existing_link(test_client, create_test_short_link, get_token):
     headers = {"Authorization": f"Bearer {get_token}"}
     response = test_client.put(f"/links/some_link", json={"short_code_old": "some_link", "short_code_new": "gl"}, headers=headers)
@@ -144,11 +400,35 @@ def test_delete_short_link(test_client, create_test_short_link, get_token):
     assert response.json() == {"message": "Link successfully deleted"}
 
 
+def test_redirect_after_delete_short_link(test_client, create_test_short_link, get_token):
+    response = test_client.get("/links/goo", follow_redirects=False)
+    assert response.status_code == 307
+
+    headers = {"Authorization": f"Bearer {get_token}"}
+    response = test_client.delete(f"/links/goo", headers=headers)
+    assert response.status_code == 200
+
+    response = test_client.get("/links/goo", follow_redirects=False)
+    assert response.status_code == 404
+
+
 def test_delete_short_link_unauthorized(test_client, create_test_short_link):
     response = test_client.delete("/links/goo")
     assert response.status_code == 401
 
 
+def test_authenticated_calls_reuse_cached_principal(test_client, create_test_short_link, get_token):
+    headers = {"Authorization": f"Bearer {get_token}"}
+    before = test_client.get("/cache/stats").json()["auth"]
+    for _ in range(3):
+        response = test_client.delete("/links/missing", headers=headers)
+        assert response.status_code == 404
+    after = test_client.get("/cache/stats").json()["auth"]
+    assert after["verifications"] - before["verifications"] == 1
+    assert after["token_hits"] - before["token_hits"] == 2
+    assert after["user_hits"] - before["user_hits"] == 2
+
+
 def test_delete_short_link_with_not_existing_link(test_client, create_test_short_link, get_token):
     headers = {"Authorization": f"Bearer {get_token}"}
     response = test_client.delete(f"/links/some_link", headers=headers)
@@ -161,6 +441,22 @@ def test_search_link(test_client, create_test_short_link):
     assert response.json() == {"short_code": "goo"}
 
 
+def test_search_link_matches_canonical_url(test_client, create_test_short_link):
+    response = test_client.get("/links/search/link?original_url=HTTPS://WWW.GOOGLE.COM:443/")
+    assert response.status_code == 200
+    assert response.json() == {"short_code": "goo"}
+
+
+def test_create_short_link_deduplicates_urls(test_client, monkeypatch):
+    monkeypatch.setattr(main, "DEDUPLICATE_LINKS", True)
+    first = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/"}).json()
+    second = test_client.post("/links/shorten", json={"original_url": "https://WWW.google.com"}).json()
+    assert second["short_code"] == first["short_code"]
+
+    third = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "goo"}).json()
+    assert third["short_code"] == "goo"
+
+
 def test_search_link_with_not_existing_link(test_client, create_test_short_link):
     response = test_client.get("/links/search/link?original_url=https://www.somesite.com/")
     assert response.status_code == 404
@@ -178,23 +474,468 @@ def test_get_link_stats(test_client, create_test_short_link):
     assert "access_count" in response_json
 
 
+def test_get_cache_stats(test_client, create_test_short_link):
+    stats_before = test_client.get("/cache/stats").json()["links"]
+    test_client.get("/links/goo", follow_redirects=False)
+    test_client.get("/links/goo", follow_redirects=False)
+
+    response = test_client.get("/cache/stats")
+    assert response.status_code == 200
+    assert response.json()["links"]["hits"] - stats_before["hits"] == 1
+    assert response.json()["links"]["misses"] - stats_before["misses"] == 1
+    assert response.json()["links"]["size"] == 1
+
+
+def test_get_link_stats_counts_unflushed_clicks(test_client, create_test_short_link):
+    test_client.get("/links/goo", follow_redirects=False)
+    test_client.get("/links/goo", follow_redirects=False)
+
+    response = test_client.get("/links/goo/stats")
+    assert response.status_code == 200
+    assert response.json()["access_count"] == 2
+    assert response.json()["last_accessed_at"] is not None
+
+
+def flush_clicks():
+    asyncio.run(main.link_repository.flush_clicks(click_buffer))
+
+
+def test_get_link_stats_by_hour_and_day(test_client, create_test_short_link):
+    for _ in range(3):
+        test_client.get("/links/goo", follow_redirects=False)
+    flush_clicks()
+    test_client.get("/links/goo", follow_redirects=False)
+
+    for granularity in ("hour", "day"):
+        response = test_client.get("/links/goo/stats", params={"granularity": granularity})
+        assert response.status_code == 200
+        clicks = response.json()["clicks"]
+        assert clicks["granularity"] == granularity
+        assert sum(bucket["count"] for bucket in clicks["buckets"]) == 4
+        assert clicks["buckets"][-1]["bucket"] <= clicks["to"]
+
+
+def explain(connection, statement):
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={"render_postcompile": True})
+    return "\n".join(connection.exec_driver_sql(f"EXPLAIN {compiled}", compiled.params).scalars())
+
+
+@postgres_only
+def test_click_flush_touches_only_the_partitions_of_its_links(test_db, test_client, create_test_short_link):
+    expires_at = (datetime.now() + timedelta(days=40)).replace(second=0, microsecond=0)
+    test_client.post("/links/shorten", json={"original_url": "https://example.com", "custom_alias": "later", "expires_at": f"{expires_at:%Y-%m-%d %H:%M}"})
+    test_client.get("/links/goo", follow_redirects=False)
+    test_client.get("/links/later", follow_redirects=False)
+    flush_clicks()
+    assert test_client.get("/links/later/stats").json()["access_count"] == 1
+
+    with test_db.connect() as connection:
+        link_id = connection.execute(text("SELECT id FROM links WHERE short_code = 'goo'")).scalar()
+        partitions = connection.execute(text("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'links'::regclass")).scalars().all()
+        hour, expiries = datetime(2030, 1, 1), {link_id: None}
+        plans = [
+            explain(connection, clicks_update({link_id: [1, hour, None]}, {})),
+            explain(connection, rollup_upsert({(link_id, hour): 1}, expiries)),
+            explain(connection, visitor_sketches_insert({(link_id, hour): HyperLogLog()}, expiries)),
+            explain(connection, locked_visitors([link_id], expiries)),
+        ]
+    assert len(partitions) > 2
+    for plan in plans:
+        assert [partition for partition in partitions if partition in plan] == ["links_never"]
+
+
+@postgres_only
+def test_clicks_of_link_id_above_32_bits_are_flushed(test_db, test_client):
+    with test_db.begin() as connection:
+        connection.execute(text("SELECT setval('links_id_seq', 3000000000)"))
+    response = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "big"})
+    assert response.status_code == 200
+    test_client.get("/links/big", follow_redirects=False)
+    flush_clicks()
+
+    with test_db.connect() as connection:
+        assert connection.execute(text("SELECT id, access_count FROM links")).one() == (3000000001, 1)
+        assert connection.execute(text("SELECT link_id, count FROM link_click_buckets")).one() == (3000000001, 1)
+
+
+def test_get_link_stats_with_invalid_granularity(test_client, create_test_short_link):
+    assert test_client.get("/links/goo/stats", params={"granularity": "week"}).status_code == 400
+    response = test_client.get("/links/goo/stats", params={"granularity": "day", "from": "2025-03-25 00:00", "to": "2025-03-20 00:00"})
+    assert response.status_code == 400
+
+
+@postgres_only
+def test_compact_click_buckets(test_db, test_client, create_test_short_link):
+    with test_db.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO link_click_buckets (link_id, granularity, bucket, count) "
+            "SELECT id, 'hour', bucket, 2 FROM links, unnest(ARRAY[TIMESTAMP '2025-03-20 01:00', TIMESTAMP '2025-03-20 05:00', TIMESTAMP '2025-03-21 00:00']) AS bucket "
+            "WHERE short_code = 'goo'"
+        ))
+
+    async def compact():
+        async with main.session_scope() as db:
+            await compact_click_buckets(db, datetime(2025, 3, 21))
+
+    asyncio.run(compact())
+
+    with test_db.connect() as connection:
+        rows = connection.execute(text("SELECT granularity, bucket, count FROM link_click_buckets ORDER BY bucket")).all()
+    assert rows == [("day", datetime(2025, 3, 20), 4), ("hour", datetime(2025, 3, 21), 2)]
+
+    response = test_client.get("/links/goo/stats", params={"granularity": "day", "from": "2025-03-19 12:00", "to": "2025-03-21 00:00"})
+    assert response.json()["clicks"]["buckets"] == [
+        {"bucket": "2025-03-20 00:00", "count": 4, "unique_visitors": 0},
+        {"bucket": "2025-03-21 00:00", "count": 2, "unique_visitors": 0},
+    ]
+    response = test_client.get("/links/goo/stats", params={"granularity": "hour", "from": "2025-03-20 00:00", "to": "2025-03-20 23:00"})
+    assert response.json()["clicks"]["buckets"] == [{"bucket": "2025-03-20 00:00", "count": 4, "unique_visitors": 0}]
+
+
+@postgres_only
+def test_get_link_stats_counts_unique_visitors(test_db, test_client, create_test_short_link):
+    for user_agent in ["a", "b", "a", "c", "b"]:
+        test_client.get("/links/goo", headers={"User-Agent": user_agent}, follow_redirects=False)
+    assert test_client.get("/links/goo/stats").json()["unique_visitors"] == 3
+
+    flush_clicks()
+    for user_agent in ["a", "d"]:
+        test_client.get("/links/goo", headers={"User-Agent": user_agent}, follow_redirects=False)
+    flush_clicks()
+
+    response = test_client.get("/links/goo/stats", params={"granularity": "day"})
+    assert response.json()["access_count"] == 7
+    assert response.json()["unique_visitors"] == 4
+    assert sum(bucket["unique_visitors"] for bucket in response.json()["clicks"]["buckets"]) == 4
+
+    # the two flushes left two partial sketches for the same hour, compaction merges them into one row
+    async def compact():
+        async with main.session_scope() as db:
+            await compact_visitor_sketches(db, datetime(2100, 1, 1), datetime(2000, 1, 1))
+
+    asyncio.run(compact())
+    with test_db.connect() as connection:
+        assert connection.scalar(text("SELECT count(*) FROM link_visitor_sketches")) == 1
+    assert test_client.get("/links/goo/stats", params={"granularity": "day"}).json()["clicks"]["buckets"][-1]["unique_visitors"] == 4
+
+
+def count_link_lookups(paths):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if "FROM links" in statement and "links.short_code =" in statement:
+            statements.append(statement)
+
+    async def fire():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*(client.get(path) for path in paths))
+
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        responses = asyncio.run(fire())
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+    return responses, statements
+
+
+@sql_backends
+def test_concurrent_redirects_share_one_query(test_client, create_test_short_link):
+    link_cache.clear()
+    coalesced = main.link_lookups.coalesced
+    responses, statements = count_link_lookups(["/links/goo"] * 50)
+    assert all(response.status_code == 307 for response in responses)
+    assert len(statements) == 1
+    assert main.link_lookups.coalesced - coalesced == 49
+
+
+@sql_backends
+def test_concurrent_link_stats_share_one_query(test_client, create_test_short_link):
+    responses, statements = count_link_lookups(["/links/goo/stats"] * 50)
+    assert all(response.json()["short_code"] == "goo" for response in responses)
+    assert len(statements) == 1
+
+
+@postgres_only
+def test_get_top_links(test_db, test_client, create_test_short_link):
+    test_client.post("/links/shorten", json={"original_url": "https://example.com", "custom_alias": "exa"})
+    for _ in range(3):
+        test_client.get("/links/goo", follow_redirects=False)
+    test_client.get("/links/exa", follow_redirects=False)
+
+    response = test_client.get("/links/top", params={"window": "hour", "limit": 1})
+    assert response.status_code == 200
+    assert response.json()["window"] == "hour"
+    assert response.json()["links"] == [{"short_code": "goo", "count": 3, "error": 0}]
+
+    # snapshots published by other workers are merged in
+    with test_db.begin() as connection:
+        connection.execute(
+            main.models.TopLinksSnapshot.__table__.insert(),
+            {"worker_id": "other", "updated_at": main.current_time(), "snapshot": {
+                "minute": {"floor": 0, "items": {"exa": [5, 0]}},
+                "hour": {"floor": 0, "items": {"exa": [5, 0]}},
+            }},
+        )
+    response = test_client.get("/links/top")
+    assert response.json()["workers"] == 2
+    assert response.json()["links"] == [
+        {"short_code": "exa", "count": 6, "error": 0},
+        {"short_code": "goo", "count": 3, "error": 0},
+    ]
+
+    assert test_client.get("/links/top", params={"window": "day"}).status_code == 400
+
+
+@postgres_only
+def test_redirects_are_ingested_from_click_log(test_db, test_client, create_test_short_link):
+    test_client.get("/links/goo", follow_redirects=False, headers={"user-agent": "curl/8.0", "referer": "https://t.me/"})
+    test_client.get("/links/goo", follow_redirects=False)
+
+    async def ingest():
+        click_log.write(click_log.take())
+        click_log.seal()
+        segments = click_log.closed_segments()
+        data = {path: open(path, "rb").read() for path in segments}
+        async with main.session_scope() as db:
+            await ingest_click_log(db, click_log)
+        # a segment left behind after its checkpoint was committed is not loaded twice
+        for path, content in data.items():
+            open(path, "wb").write(content)
+        async with main.session_scope() as db:
+            await ingest_click_log(db, click_log)
+        return segments
+
+    segments = asyncio.run(ingest())
+    assert len(segments) == 1
+    assert click_log.closed_segments() == []
+    with test_db.connect() as connection:
+        events = connection.execute(text("SELECT short_code, user_agent, referrer FROM click_events ORDER BY id")).all()
+        checkpoints = connection.execute(text("SELECT events FROM click_log_segments")).scalars().all()
+    assert [tuple(event) for event in events] == [("goo", "curl/8.0", "https://t.me/"), ("goo", "testclient", "")]
+    assert checkpoints == [2]
+
+
+@postgres_only
+def test_get_metrics(test_client, create_test_short_link):
+    # the engines are created on first use and the test sessions have their own, so the app's pool is opened here
+    database.async_engine
+    test_client.get("/links/goo", follow_redirects=False)
+    test_client.get("/links/goo", follow_redirects=False)
+    test_client.get("/links/missing/stats")
+
+    response = test_client.get("/metrics")
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert 'http_requests_total{method="GET",route="/links/{short_code}",status="307"} 2' in lines
+    assert 'http_requests_total{method="GET",route="/links/{short_code}/stats",status="404"} 1' in lines
+    assert 'http_request_duration_seconds_count{method="POST",route="/links/shorten"} 1' in lines
+    db_seconds = next(line for line in lines if line.startswith('http_request_db_seconds_sum{method="POST",route="/links/shorten"}'))
+    assert float(db_seconds.split()[-1]) > 0
+    assert any(line.startswith('db_query_duration_seconds_count{operation="COMMIT"}') for line in lines)
+    assert any(line.startswith('db_pool_connections_in_use{pool="async"}') for line in lines)
+    assert any(line.startswith("links_hits ") for line in lines)
+
+
+@pytest.fixture()
+def lagging_replica(test_client):
+    # a second database with the schema but none of the rows stands in for a replica that has not caught up
+    server = create_engine(TEST_DATABASE_URL, isolation_level="AUTOCOMMIT")
+    with server.connect() as connection:
+        if not connection.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": f"test_{DB_NAME}_replica"}).scalar():
+            connection.execute(text(f'CREATE DATABASE "test_{DB_NAME}_replica"'))
+    server.dispose()
+    replica = create_engine(TEST_DATABASE_URL + "_replica")
+    Base.metadata.create_all(bind=replica)
+    ReplicaSessionLocal = async_sessionmaker(bind=create_async_engine(ASYNC_TEST_DATABASE_URL + "_replica", poolclass=NullPool), expire_on_commit=False)
+
+    async def test_get_replica_db():
+        async with ReplicaSessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[main.get_replica_db] = test_get_replica_db
+    yield replica
+    del app.dependency_overrides[main.get_replica_db]
+    Base.metadata.drop_all(bind=replica)
+    replica.dispose()
+
+
+@postgres_only
+def test_reads_go_to_replica_unless_client_wrote_recently(test_client, create_test_short_link, lagging_replica):
+    assert test_client.get("/links/goo/stats").status_code == 404
+    assert test_client.get("/links/search/link", params={"original_url": "https://www.google.com"}).status_code == 404
+
+    test_client.cookies.set(READ_PRIMARY_COOKIE, str(time.time() + 5))
+    assert test_client.get("/links/goo/stats").status_code == 200
+    assert test_client.get("/links/search/link", params={"original_url": "https://www.google.com"}).status_code == 200
+    test_client.cookies.clear()
+
+    # a cache fill falls back to the primary for links the replica does not have yet
+    assert test_client.get("/links/goo", follow_redirects=False).status_code == 307
+
+
+@postgres_only
+def test_cache_fill_skips_replica_for_recently_written_links(test_client, create_test_short_link, lagging_replica):
+    with lagging_replica.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO links (original_url, short_code, created_at, access_count) VALUES ('https://old.example.com', 'goo', now(), 0)"
+        ))
+    assert test_client.get("/links/goo", follow_redirects=False).headers["location"] == "https://old.example.com"
+
+    link_cache.invalidate("goo")
+    recent_writes.add("goo")
+    assert test_client.get("/links/goo", follow_redirects=False).headers["location"] == "https://www.google.com/"
+
+
+@pytest.fixture()
+def link_shard(test_db, monkeypatch):
+    # requested before test_client, so the lifespan already sees two shards
+    server = create_engine(TEST_DATABASE_URL, isolation_level="AUTOCOMMIT")
+    with server.connect() as connection:
+        if not connection.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": f"test_{DB_NAME}_shard1"}).scalar():
+            connection.execute(text(f'CREATE DATABASE "test_{DB_NAME}_shard1"'))
+    server.dispose()
+    shard = create_engine(TEST_DATABASE_URL + "_shard1")
+    ShardSessionLocal = async_sessionmaker(bind=create_async_engine(ASYNC_TEST_DATABASE_URL + "_shard1", poolclass=NullPool), autoflush=False, expire_on_commit=False)
+    monkeypatch.setattr(database, "ShardSessionLocals", [ShardSessionLocal])
+    monkeypatch.setattr(shard_router, "count", 2)
+    yield shard
+    Base.metadata.drop_all(bind=shard)
+    shard.dispose()
+
+
+def short_code_on_shard(shard, prefix):
+    return next(f"{prefix}{number}" for number in range(1000) if shard_router.shard_for(f"{prefix}{number}") == shard)
+
+
+@postgres_only
+def test_links_are_stored_on_the_shard_of_their_short_code(link_shard, test_client, get_token):
+    aliases = [f"s{number}" for number in range(20)]
+    response = test_client.post("/links/shorten/batch", json=[{"original_url": f"https://example.com/{alias}", "custom_alias": alias} for alias in aliases])
+    assert all(result["short_code"] == alias for result, alias in zip(response.json(), aliases))
+    generated = test_client.post("/links/shorten", json={"original_url": "https://example.com/generated"}).json()["short_code"]
+
+    with link_shard.connect() as connection:
+        rows = connection.execute(text("SELECT id, short_code FROM links")).all()
+    on_shard = {short_code for _, short_code in rows}
+    assert on_shard == {short_code for short_code in aliases + [generated] if shard_router.shard_for(short_code) == 1}
+    assert 0 < len(on_shard) < len(aliases)
+    # ids stay unique across shards, so rows can move without being renumbered
+    assert all(link_id % SHARD_ID_STRIDE == 1 for link_id, _ in rows)
+
+    remote = short_code_on_shard(1, "s")
+    assert test_client.get(f"/links/{remote}", follow_redirects=False).status_code == 307
+    flush_clicks()
+    assert test_client.get(f"/links/{remote}/stats").json()["access_count"] == 1
+    assert test_client.get("/links/search/link", params={"original_url": f"https://example.com/{remote}"}).json() == {"short_code": remote}
+    assert test_client.post("/links/shorten", json={"original_url": "https://example.com/other", "custom_alias": remote}).status_code == 400
+
+    # a new code on the other shard moves the row together with its click history
+    headers = {"Authorization": f"Bearer {get_token}"}
+    moved = short_code_on_shard(0, "moved")
+    response = test_client.put(f"/links/{remote}", json={"short_code_old": remote, "short_code_new": moved}, headers=headers)
+    assert response.status_code == 200
+    assert test_client.get(f"/links/{remote}/stats").status_code == 404
+    stats = test_client.get(f"/links/{moved}/stats", params={"granularity": "hour"}).json()
+    assert stats["access_count"] == 1
+    assert sum(bucket["count"] for bucket in stats["clicks"]["buckets"]) == 1
+
+    assert test_client.delete(f"/links/{next(alias for alias in aliases if alias in on_shard and alias != remote)}", headers=headers).status_code == 200
+    with link_shard.connect() as connection:
+        assert connection.execute(text("SELECT count(*) FROM links")).scalar() == len(on_shard) - 2
+
+
+@postgres_only
+def test_expired_links_are_merged_across_shards(link_shard, test_client):
+    aliases = [f"exp{number}" for number in range(8)]
+    for alias in aliases:
+        test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": alias, "expires_at": "2025-03-25 00:00"})
+
+    expired = test_client.get("/links/expired/links").json()
+    assert sorted(link["short_code"] for link in expired) == sorted(aliases)
+    assert [link["id"] for link in expired] == sorted(link["id"] for link in expired)
+
+    first_page = test_client.get("/links/expired/links", params={"limit": 3}).json()
+    second_page = test_client.get("/links/expired/links", params={"after": first_page[-1]["id"]}).json()
+    assert [link["id"] for link in first_page + second_page] == [link["id"] for link in expired]
+
+
 def test_get_link_stats_with_not_existing_link(test_client, create_test_short_link):
     response = test_client.get("/links/some_link/stats")
     assert response.status_code == 404
 
 
+def run_remove_unused_links(test_client, headers, params=None):
+    response = test_client.delete("/links/remove_unused/links", params=params, headers=headers)
+    assert response.status_code == 202
+    assert response.json()["message"] == "Unused links removal started"
+
+    response = test_client.get(f"/jobs/{response.json()['job_id']}", headers=headers)
+    assert response.status_code == 200
+    return response.json()
+
+
 def test_remove_unused_links(test_client, create_test_short_link, get_token):
     headers = {"Authorization": f"Bearer {get_token}"}
-    response = test_client.delete("/links/remove_unused/links", headers=headers)
-    assert response.status_code == 200
-    assert response.json() == {"message": f"Deleted 1 unused links"}
+    job = run_remove_unused_links(test_client, headers)
+    assert job["status"] == "finished"
+    assert job["rows_deleted"] == 1
+    assert job["message"] == "Deleted 1 unused links"
+
+
+def test_remove_unused_links_in_batches(test_client, get_token, monkeypatch):
+    monkeypatch.setattr(main, "REMOVE_UNUSED_LINKS_BATCH_SIZE", 2)
+    monkeypatch.setattr(main, "REMOVE_UNUSED_LINKS_BATCH_PAUSE", 0)
+    for alias in ["a1", "a2", "a3", "a4", "a5"]:
+        test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": alias})
+    test_client.get("/links/a5", follow_redirects=False)
+
+    headers = {"Authorization": f"Bearer {get_token}"}
+    job = run_remove_unused_links(test_client, headers, {"inactivity_days": 0})
+    assert job["status"] == "finished"
+    assert job["params"] == {"inactivity_days": 0}
+    assert job["rows_deleted"] == 4
+
+    assert test_client.get("/links/a1", follow_redirects=False).status_code == 404
+    assert test_client.get("/links/a5", follow_redirects=False).status_code == 307
+
+
+@postgres_only
+def test_job_status_is_shared_by_workers(test_db, test_client, create_test_short_link, get_token):
+    headers = {"Authorization": f"Bearer {get_token}"}
+    job = run_remove_unused_links(test_client, headers)
+
+    # any other worker reads the state the job has written
+    with test_db.connect() as connection:
+        row = connection.execute(text("SELECT status, rows_deleted, message FROM jobs WHERE id = :id"), {"id": job["job_id"]}).one()
+    assert tuple(row) == ("finished", 1, "Deleted 1 unused links")
+    other = PostgresLinkRepository(main.session_scope)
+    assert asyncio.run(other.get_job(job["job_id"])).as_dict() == job
+
+
+def test_remove_unused_links_flushes_clicks_first(test_client, create_test_short_link, get_token):
+    test_client.get("/links/goo", follow_redirects=False)
+
+    headers = {"Authorization": f"Bearer {get_token}"}
+    job = run_remove_unused_links(test_client, headers)
+    assert job["message"] == "There are no unused links"
+
+    response = test_client.get("/links/goo/stats")
+    assert response.json()["access_count"] == 1
 
 
 def test_remove_unused_links_without_unused_links(test_client, get_token):
     headers = {"Authorization": f"Bearer {get_token}"}
-    response = test_client.delete("/links/remove_unused/links", headers=headers)
-    assert response.status_code == 200
-    assert response.json() == {"message": "There are no unused links"}
+    job = run_remove_unused_links(test_client, headers)
+    assert job["status"] == "finished"
+    assert job["rows_deleted"] == 0
+    assert job["message"] == "There are no unused links"
+
+
+def test_get_job_status_with_not_existing_job(test_client, get_token):
+    headers = {"Authorization": f"Bearer {get_token}"}
+    response = test_client.get("/jobs/some_job", headers=headers)
+    assert response.status_code == 404
 
 
 def test_get_expired_links(test_client):
@@ -212,3 +953,125 @@ def test_get_expired_links(test_client):
     assert "expires_at" in response_json[0]
 
 
+def test_redirect_expired_link_is_answered_from_memory(test_client):
+    response = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "goo", "expires_at": "2025-03-25 00:00"})
+    assert response.status_code == 200
+
+    expired_hits = expiry_scheduler.expired_hits
+    response = test_client.get("/links/goo", follow_redirects=False)
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Link expired"}
+    assert expiry_scheduler.expired_hits == expired_hits + 1
+
+    response = test_client.get("/links/goo/stats")
+    assert response.json()["access_count"] == 0
+
+
+def test_sweep_expired_links_purges_old_expired_links(test_client, monkeypatch):
+    monkeypatch.setattr(main, "EXPIRED_LINKS_RETENTION_DAYS", 1)
+    test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "old", "expires_at": "2025-03-25 00:00"})
+    expires_soon = (datetime.now(main.tz) + timedelta(hours=2)).strftime("%Y-%m-%d %H:%M")
+    test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "fresh", "expires_at": expires_soon})
+
+    asyncio.run(main.sweep_expired_links(purge=True))
+
+    assert test_client.get("/links/old/stats").status_code == 404
+    assert test_client.get("/links/fresh/stats").status_code == 200
+    assert expiry_scheduler.stats()["scheduled"] == 1
+
+
+@postgres_only
+def test_purge_drops_expired_month_with_its_codes_and_clicks(test_db, test_client, monkeypatch):
+    monkeypatch.setattr(main, "EXPIRED_LINKS_RETENTION_DAYS", 1)
+    for alias in ["old1", "old2"]:
+        test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": alias, "expires_at": "2025-03-25 00:00"})
+    # the code registry spans every month, so a code stays unique across partitions
+    assert test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "old1"}).status_code == 400
+    with test_db.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO link_click_buckets (link_id, granularity, bucket, count) SELECT id, 'day', '2025-03-20', 3 FROM links WHERE short_code = 'old1'"
+        ))
+
+    asyncio.run(main.sweep_expired_links(purge=True))
+
+    with test_db.connect() as connection:
+        assert connection.execute(text("SELECT to_regclass('links_2025_03')")).scalar() is None
+        assert connection.execute(text("SELECT count(*) FROM link_short_codes")).scalar() == 0
+        assert connection.execute(text("SELECT count(*) FROM link_click_buckets")).scalar() == 0
+        assert connection.execute(text("SELECT to_regclass('links_never')")).scalar() is not None
+    assert test_client.get("/links/old1/stats").status_code == 404
+    assert test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "old1"}).status_code == 200
+
+
+def test_create_short_link_within_max_ttl_needs_no_new_partition(test_client):
+    now = datetime.now(main.tz)
+    too_far = (now + timedelta(days=LINK_MAX_TTL_DAYS + 40)).strftime("%Y-%m-%d %H:%M")
+    response = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "far", "expires_at": too_far})
+    assert response.status_code == 422
+    response = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "old", "expires_at": "0999-05-01 00:00"})
+    assert response.status_code == 422
+
+    # every month up to the longest allowed expiry was attached at startup, inserts never run DDL
+    created = link_partitions.stats()["created"]
+    latest = (now + timedelta(days=LINK_MAX_TTL_DAYS - 1)).strftime("%Y-%m-%d %H:%M")
+    for alias, expires_at in [("latest", latest), ("past", "2025-03-25 00:00")]:
+        response = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": alias, "expires_at": expires_at})
+        assert response.status_code == 200
+    assert link_partitions.stats()["created"] == created
+
+
+def test_get_expired_links_without_expired_links(test_client, create_test_short_link):
+    response = test_client.get("/links/expired/links")
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_get_expired_links_keyset_pagination(test_client):
+    for alias in ["exp1", "exp2", "exp3"]:
+        response = test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": alias, "expires_at": "2025-03-25 00:00"})
+        assert response.status_code == 200
+
+    response = test_client.get("/links/expired/links?limit=2")
+    first_page = response.json()
+    assert [link["short_code"] for link in first_page] == ["exp1", "exp2"]
+
+    response = test_client.get(f"/links/expired/links?limit=2&after={first_page[-1]['id']}")
+    assert [link["short_code"] for link in response.json()] == ["exp3"]
+
+
+def test_get_expired_links_ndjson(test_client):
+    for alias in ["exp1", "exp2"]:
+        test_client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": alias, "expires_at": "2025-03-25 00:00"})
+
+    response = test_client.get("/links/expired/links?format=ndjson")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = response.text.splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[1])["short_code"] == "exp2"
+
+
+def test_app_runs_on_the_in_memory_store(monkeypatch, tmp_path):
+    # no database server: every query goes to the embedded store
+
+    monkeypatch.setattr(main, "link_repository", MemoryLinkRepository())
+    monkeypatch.setattr(main, "user_repository", MemoryUserRepository())
+    for cache in (link_cache, expiry_scheduler, principal_cache, short_code_filter, top_links):
+        cache.clear()
+    click_log.directory = str(tmp_path / "click_log")
+
+    with TestClient(app) as client:
+        client.post("/register", json={"username": "test_user", "email": "test_user@yandex.ru", "password": "test_user_password"})
+        token = client.post("/token", data={"username": "test_user", "password": "test_user_password"}).json()["access_token"]
+        client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "goo"})
+        client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "exa"})
+        assert client.post("/links/shorten", json={"original_url": "https://www.google.com/", "custom_alias": "goo"}).status_code == 400
+        assert client.get("/links/goo", follow_redirects=False).status_code == 307
+        flush_clicks()
+        assert client.get("/links/goo/stats").json()["access_count"] == 1
+
+        headers = {"Authorization": f"Bearer {token}"}
+        response = client.put("/links/goo", json={"short_code_old": "goo", "short_code_new": "exa"}, headers=headers)
+        assert response.status_code == 400
+        assert client.delete("/links/goo", headers=headers).status_code == 200
+        assert client.get("/links/goo/stats").status_code == 404
@@ -0,0 +1,13 @@
+from locust_tests.report import compare
+
+
+def test_load_report_compare_flags_regressions_over_threshold():
+    def report(p99, rps, failures):
+        return {"scenarios": {"redirect_mix": {"GET /links/[short_code]": {"requests": 1000, "failures": failures, "rps": rps, "p50": 5, "p95": 10, "p99": p99}}}}
+
+    baseline = report(p99=20, rps=500, failures=0)
+    assert compare(report(p99=23, rps=450, failures=5), baseline, 0.2) == []
+    regressions = compare(report(p99=30, rps=300, failures=50), baseline, 0.2)
+    assert [regression.split(": ")[1].split()[0] for regression in regressions] == ["p99", "rps", "failures"]
+    # requests the baseline does not know are skipped
+    assert compare(report(p99=30, rps=300, failures=50), {"scenarios": {}}, 0.2) == []
@@ -1,7 +1,600 @@
 import pytest
-from app.main import generate_link_short_code
+import asyncio
+import time
+import threading
+from datetime import datetime
+from types import SimpleNamespace
+from app.main import app, generate_link_short_code
+from app.cache import LinkCache, CachedLink
+from app.clicks import ClickBuffer
+from app.short_codes import FeistelPermutation, CounterCodeGenerator, encode_base62, RESERVED_SHORT_CODES
+from app.expiry import ExpiryScheduler
+from app.urls import canonicalize_url, url_digest
+from app.auth import PrincipalCache
+from app.hash import PasswordHasher, PasswordHasherBusy
+from app.fast_redirect import FastRedirectMiddleware, NOT_FOUND
+from app.bloom import BloomFilter
+from app.singleflight import SingleFlight
+from app.hll import HyperLogLog, visitor_hash
+from app.top_links import SpaceSaving, SlidingTopLinks, merge_summaries
+from app.click_log import ClickLog, read_segment
+from app.metrics import Metrics, MetricsMiddleware
+from app.replica import READ_PRIMARY_COOKIE, ReadYourWritesMiddleware, RecentWrites, reads_from_primary
+from app.shards import ShardRouter, merge_sorted
+from app.partitions import LinkPartitions, next_month, partition_month, partition_name, before_partition_name, partition_bound
+from app.embedded import MemoryLinkRepository, SqliteStore
+from app.repositories import LinkRepository, UserRepository
+
 
 def test_generate_short_code_length():
     short_code = generate_link_short_code()
     assert len(short_code) == 6
 
+
+def test_link_cache_lru_eviction():
+    cache = LinkCache(max_size=2, ttl=60)
+    cache.put("a", 1, "http://a", None)
+    cache.put("b", 2, "http://b", None)
+    assert cache.get("a").id == 1
+    cache.put("c", 3, "http://c", None)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.evictions == 1
+
+
+def test_link_cache_ttl():
+    cache = LinkCache(max_size=10, ttl=-1)
+    cache.put("a", 1, "http://a", None)
+    assert cache.get("a") is None
+    assert cache.expirations == 1
+
+
+def test_link_cache_invalidate():
+    cache = LinkCache(max_size=10, ttl=60)
+    cache.put("a", 1, "http://a", None)
+    cache.invalidate("a", "missing")
+    assert cache.get("a") is None
+    assert cache.stats()["invalidations"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_click_buffer_record():
+    buffer = ClickBuffer()
+    buffer.record(1)
+    buffer.record(1)
+    buffer.record(2)
+    assert buffer.pending(1)[0] == 2
+    assert buffer.pending(1)[1] is buffer.pending(2)[1]
+    assert buffer.pending(3) == (0, None)
+    assert buffer.stats()["pending_clicks"] == 3
+    hour = buffer.pending(1)[1].replace(minute=0)
+    assert buffer.pending_buckets(1) == {hour: 2}
+    assert buffer.pending_buckets(3) == {}
+
+
+def test_click_buffer_counts_batch_being_written_once():
+    buffer = ClickBuffer()
+    buffer.record(1)
+    stored = {"clicks": 0}
+
+    async def main():
+        writing, release = asyncio.Event(), asyncio.Event()
+
+        async def apply(batch, buckets, sketches):
+            writing.set()
+            await release.wait()
+            stored["clicks"] += batch[1][0]
+
+        flush = asyncio.create_task(buffer.drain(apply))
+        await writing.wait()
+        # the lock is free while the batch is written and its clicks are still counted as pending
+        assert not buffer.lock.locked()
+        assert buffer.pending(1)[0] == 1
+
+        async def read():
+            # the batch lands while the store is read, so the read is repeated
+            release.set()
+            await asyncio.sleep(0)
+            return stored["clicks"]
+
+        clicks = await buffer.read_settled(read)
+        await flush
+        return clicks
+
+    assert asyncio.run(main()) + buffer.pending(1)[0] == 1
+    assert buffer.stats()["in_flight_batches"] == 0
+
+
+def test_feistel_permutation_is_bijective():
+    permutation = FeistelPermutation(62 ** 2, "key")
+    assert sorted(permutation(i) for i in range(62 ** 2)) == list(range(62 ** 2))
+
+
+def test_encode_base62_length():
+    assert encode_base62(0, 6) == "000000"
+    assert len(encode_base62(62 ** 6 - 1, 6)) == 6
+
+
+class FakeSequenceSession:
+    def __init__(self):
+        self.block = 0
+
+    async def scalar(self, statement):
+        self.block += 1
+        return self.block
+
+
+def test_reserved_short_codes_cover_static_link_routes():
+    segments = {route.path.split("/")[2] for route in app.routes if route.path.startswith("/links/")}
+    assert {segment for segment in segments if not segment.startswith("{")} == RESERVED_SHORT_CODES
+
+
+def test_counter_code_generator_codes_are_unique():
+    generator = CounterCodeGenerator(length=3, key="key", block_size=100)
+    db = FakeSequenceSession()
+
+    async def generate(count):
+        return [await generator.next_code(db) for _ in range(count)]
+
+    codes = asyncio.run(generate(5000))
+    assert len(set(codes)) == 5000
+    assert all(len(code) == 3 for code in codes)
+    assert db.block == 50
+
+
+def test_expiry_scheduler_pops_due_links_in_order():
+    scheduler = ExpiryScheduler(max_expired=10)
+    scheduler.schedule("b", datetime(2030, 1, 2))
+    scheduler.schedule("a", datetime(2030, 1, 1))
+    scheduler.schedule("c", datetime(2030, 1, 3))
+    scheduler.forget("b")
+
+    assert scheduler.pop_due(datetime(2030, 1, 2, 12)) == ["a"]
+    assert scheduler.is_expired("a")
+    assert not scheduler.is_expired("b")
+    assert not scheduler.is_expired("c")
+    assert scheduler.stats()["scheduled"] == 1
+
+
+def test_expiry_scheduler_add_marks_past_links_expired():
+    scheduler = ExpiryScheduler(max_expired=1)
+    scheduler.add("a", datetime(2020, 1, 1), datetime(2025, 1, 1))
+    scheduler.add("b", datetime(2020, 1, 1), datetime(2025, 1, 1))
+    scheduler.add("c", None, datetime(2025, 1, 1))
+    assert not scheduler.is_expired("a")
+    assert scheduler.is_expired("b")
+    assert not scheduler.is_expired("c")
+
+
+def test_canonicalize_url():
+    assert canonicalize_url("HTTPS://WWW.Google.com:443") == "https://www.google.com/"
+    assert canonicalize_url("google.com/Search?q=A") == "http://google.com/Search?q=A"
+    assert canonicalize_url("http://example.com:8080/#top") == "http://example.com:8080/#top"
+
+
+def test_url_digest_is_fixed_width():
+    assert len(url_digest("https://www.google.com/")) == 32
+    assert url_digest("https://www.google.com/") == url_digest("https://WWW.GOOGLE.COM")
+
+
+def test_principal_cache_keeps_token_until_exp():
+    cache = PrincipalCache(max_size=10, user_ttl=60)
+    cache.put_principal("token", "user", time.time() + 60)
+    cache.put_principal("expired", "user", time.time() - 1)
+    assert cache.get_principal("token") == "user"
+    assert cache.get_principal("expired") is None
+    assert cache.get_principal("unknown") is None
+    assert cache.stats()["token_hits"] == 1
+    assert cache.stats()["token_misses"] == 2
+
+
+def test_principal_cache_invalidates_and_evicts_users():
+    cache = PrincipalCache(max_size=2, user_ttl=60)
+    for user_id, username in enumerate(["a", "b", "c"]):
+        cache.put_user(SimpleNamespace(id=user_id, username=username, email=f"{username}@yandex.ru"))
+    assert cache.get_user("a") is None
+    assert cache.get_user("c").id == 2
+    cache.invalidate_user("c")
+    assert cache.get_user("c") is None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_password_hasher_rejects_calls_over_the_limit():
+    hasher = PasswordHasher(workers=1, queue_size=0)
+    release = threading.Event()
+
+    async def run():
+        first = asyncio.ensure_future(hasher.run(release.wait))
+        await asyncio.sleep(0)
+        with pytest.raises(PasswordHasherBusy):
+            await hasher.run(release.wait)
+        release.set()
+        assert await first is True
+
+    asyncio.run(run())
+    hasher.shutdown()
+    assert hasher.stats()["rejected"] == 1
+    assert hasher.stats()["completed"] == 1
+
+
+def run_fast_redirect(path, links, method="GET"):
+    fallthrough, sent, clicks = [], [], []
+
+    def record_click(short_code, link_id, expires_at, client, user_agent, referrer):
+        clicks.append((short_code, link_id, expires_at, client, user_agent, referrer))
+
+    async def app(scope, receive, send):
+        fallthrough.append(scope["path"])
+
+    async def lookup(short_code):
+        return links.get(short_code)
+
+    async def send(message):
+        sent.append(message)
+
+    middleware = FastRedirectMiddleware(app, lookup, record_click, lambda: datetime(2025, 3, 25), reserved={"top"})
+    scope = {"type": "http", "method": method, "path": path, "client": ("10.0.0.1", 50000), "headers": [(b"user-agent", b"curl/8.0")]}
+    asyncio.run(middleware(scope, None, send))
+    return fallthrough, sent, clicks
+
+
+def test_fast_redirect_answers_known_links():
+    links = {"goo": CachedLink(1, "https://www.google.com/search?q=a b", None, 0)}
+    fallthrough, sent, clicks = run_fast_redirect("/links/goo", links)
+    assert fallthrough == []
+    assert sent[0]["status"] == 307
+    assert (b"location", b"https://www.google.com/search?q=a%20b") in sent[0]["headers"]
+    assert clicks == [("goo", 1, None, "10.0.0.1", "curl/8.0", "")]
+
+
+def test_fast_redirect_answers_checked_misses():
+    fallthrough, sent, clicks = run_fast_redirect("/links/gone", {"gone": NOT_FOUND})
+    assert fallthrough == [] and clicks == []
+    assert sent[0]["status"] == 404
+    assert sent[1]["body"] == b'{"detail":"Link not found"}'
+
+
+def test_fast_redirect_falls_through():
+    links = {
+        "old": CachedLink(2, "https://www.google.com/", datetime(2025, 3, 24), 0),
+        "top": CachedLink(3, "https://www.google.com/", None, 0),
+        "goo": CachedLink(4, "https://www.google.com/", None, 0),
+    }
+    for path, method in [("/links/missing", "GET"), ("/links/old", "GET"), ("/links/top", "GET"), ("/links/goo/stats", "GET"), ("/links/goo", "DELETE")]:
+        fallthrough, sent, clicks = run_fast_redirect(path, links, method)
+        assert fallthrough == [path]
+        assert sent == [] and clicks == []
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(capacity=10000, error_rate=0.01)
+    codes = [f"code{i}" for i in range(10000)]
+    for code in codes:
+        bloom.add(code)
+    assert all(code in bloom for code in codes)
+    assert 9900 < bloom.count <= 10000
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom = BloomFilter(capacity=10000, error_rate=0.01)
+    for i in range(10000):
+        bloom.add(f"code{i}")
+    false_positives = sum(f"missing{i}" in bloom for i in range(10000))
+    assert false_positives < 200
+    assert bloom.estimated_false_positive_rate() == pytest.approx(0.01, rel=0.2)
+    assert bloom.memory_bytes() < 12000
+
+
+def test_single_flight_shares_result_and_errors():
+    flights = SingleFlight()
+    calls = []
+
+    async def lookup(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        if value == "missing":
+            raise KeyError(value)
+        return value.upper()
+
+    async def run():
+        assert await asyncio.gather(*(flights.do("goo", lookup, "goo") for _ in range(10))) == ["GOO"] * 10
+        results = await asyncio.gather(*(flights.do("missing", lookup, "missing") for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, KeyError) for result in results)
+        assert await flights.do("goo", lookup, "goo") == "GOO"
+
+    asyncio.run(run())
+    assert calls == ["goo", "missing", "goo"]
+    assert flights.stats() == {"in_flight": 0, "calls": 3, "coalesced": 11}
+
+
+def test_single_flight_survives_cancelled_caller():
+    flights = SingleFlight()
+
+    async def lookup():
+        await asyncio.sleep(0.01)
+        return "GOO"
+
+    async def run():
+        first = asyncio.ensure_future(flights.do("goo", lookup))
+        second = asyncio.ensure_future(flights.do("goo", lookup))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == "GOO"
+
+    asyncio.run(run())
+
+
+def test_hyperloglog_estimate_is_within_error_bounds():
+    sketch = HyperLogLog(precision=10)
+    for i in range(20000):
+        sketch.add(visitor_hash(f"10.0.{i // 256}.{i % 256}", "Mozilla/5.0"))
+    assert abs(sketch.count() - 20000) < 20000 * 0.0325 * 3
+
+
+def test_hyperloglog_merge_and_serialization():
+    first, second = HyperLogLog(precision=10), HyperLogLog(precision=10)
+    for i in range(300):
+        first.add(visitor_hash(str(i), "ua"))
+        second.add(visitor_hash(str(i + 150), "ua"))
+    merged = HyperLogLog.union([first, second])
+    assert abs(merged.count() - 450) < 450 * 0.1
+    assert first.count() == HyperLogLog.from_bytes(first.to_bytes()).count()
+
+    assert len(HyperLogLog(precision=10).to_bytes()) == 1
+    assert len(merged.to_bytes()) == 1 + 1024
+    assert HyperLogLog.from_bytes(merged.to_bytes()).registers == merged.registers
+    with pytest.raises(ValueError):
+        first.merge(HyperLogLog(precision=11))
+
+
+def test_space_saving_keeps_heavy_hitters():
+    summary = SpaceSaving(capacity=10)
+    for i in range(1000):
+        summary.add("hot")
+        summary.add(f"cold{i}")
+        if i % 2 == 0:
+            summary.add("warm")
+    items = summary.summary()["items"]
+    assert len(items) == 10
+    count, error = items["hot"]
+    assert count - error <= 1000 <= count
+    count, error = items["warm"]
+    assert count - error <= 500 <= count
+    assert summary.floor() > 0
+
+
+def test_merge_summaries_bounds_missing_keys():
+    first, second = SpaceSaving(capacity=2), SpaceSaving(capacity=2)
+    for key in ["a", "a", "a", "b", "c"]:
+        first.add(key)
+    for key in ["d", "d", "d", "a"]:
+        second.add(key)
+    merged = merge_summaries([first.summary(), second.summary()], limit=2)
+    assert list(merged["items"]) == ["a", "d"]
+    assert merged["items"]["a"] == [4, 0]
+    assert merged["items"]["d"][0] - merged["items"]["d"][1] <= 3 <= merged["items"]["d"][0]
+
+
+def test_sliding_top_links_drops_expired_slices():
+    window = SlidingTopLinks(window_seconds=60, slices=6, capacity=10)
+    window.add("old", now=0)
+    window.add("new", now=55)
+    assert set(window.summary(now=59)["items"]) == {"old", "new"}
+    assert set(window.summary(now=65)["items"]) == {"new"}
+    assert window.summary(now=200)["items"] == {}
+
+
+def test_click_log_recovers_torn_segment(tmp_path):
+    log = ClickLog(str(tmp_path), segment_bytes=1 << 20, segment_seconds=60, fsync="always", max_pending=10)
+    log.open()
+    log.append("goo", "10.0.0.1", "curl/8.0", "")
+    log.append("exa", "10.0.0.2", "Mozilla/5.0", "https://t.me/")
+    log.write(log.take())
+    # a crash in the middle of the next write leaves a partial record behind
+    open(log._path, "ab").write(b"\x30\x00\x00\x00\x01\x02")
+
+    recovered = ClickLog(str(tmp_path), segment_bytes=1 << 20, segment_seconds=60, fsync="always", max_pending=10)
+    recovered.open()
+    [segment] = recovered.closed_segments()
+    events = read_segment(segment)
+    assert [event[1:] for event in events] == [("goo", "10.0.0.1", "curl/8.0", ""), ("exa", "10.0.0.2", "Mozilla/5.0", "https://t.me/")]
+    assert recovered.recovered == 2
+
+
+def test_click_log_rotates_and_bounds_pending(tmp_path):
+    log = ClickLog(str(tmp_path), segment_bytes=100, segment_seconds=60, fsync="never", max_pending=3)
+    log.open()
+    for _ in range(5):
+        log.append("goo", "10.0.0.1", "curl/8.0", "")
+    assert log.dropped == 2
+    log.write(log.take())
+    log.append("goo", "10.0.0.1", "curl/8.0", "")
+    log.write(log.take())
+    assert log.sealed == 1
+    assert len(log.closed_segments()) == 1
+    with pytest.raises(ValueError):
+        ClickLog(str(tmp_path), 100, 60, fsync="sometimes", max_pending=3)
+
+
+def test_metrics_middleware_observes_route_and_status():
+    metrics = Metrics()
+
+    class Route:
+        path = "/links/{short_code}"
+
+    async def endpoint(scope, receive, send):
+        scope["route"] = Route
+        await send({"type": "http.response.start", "status": 307, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def discard(message):
+        pass
+
+    middleware = MetricsMiddleware(endpoint, metrics)
+    for _ in range(3):
+        asyncio.run(middleware({"type": "http", "method": "GET", "path": "/links/goo", "headers": []}, None, discard))
+    metrics.observe_query("SELECT", 0.003)
+
+    lines = metrics.render(gauges={"links": {"hits": 2, "hit_rate": 0.5, "worker": "a"}}).splitlines()
+    assert 'http_requests_total{method="GET",route="/links/{short_code}",status="307"} 3' in lines
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/links/{short_code}",le="+Inf"} 3' in lines
+    assert 'db_query_duration_seconds_bucket{operation="SELECT",le="0.0025"} 0' in lines
+    assert 'db_query_duration_seconds_bucket{operation="SELECT",le="0.005"} 1' in lines
+    assert "links_hits 2" in lines and "links_hit_rate 0.5" in lines
+    assert not any(line.startswith("links_worker") for line in lines)
+
+
+def test_read_your_writes_cookie_follows_successful_writes():
+    async def endpoint(scope, receive, send):
+        await send({"type": "http.response.start", "status": scope["status"], "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    def headers_for(method, status):
+        sent = []
+
+        async def collect(message):
+            sent.append(message)
+
+        asyncio.run(ReadYourWritesMiddleware(endpoint, window=5)({"type": "http", "method": method, "status": status}, None, collect))
+        return dict(sent[0]["headers"])
+
+    cookie = headers_for("POST", 200)[b"set-cookie"].decode()
+    assert cookie.startswith(READ_PRIMARY_COOKIE + "=") and "Max-Age=5" in cookie
+    assert reads_from_primary({READ_PRIMARY_COOKIE: cookie.split(";")[0].split("=")[1]})
+    assert b"set-cookie" not in headers_for("GET", 200)
+    assert b"set-cookie" not in headers_for("PUT", 404)
+    assert not reads_from_primary({READ_PRIMARY_COOKIE: str(time.time() - 1)})
+    assert not reads_from_primary({READ_PRIMARY_COOKIE: "garbage"})
+
+
+def test_recent_writes_expire_after_window(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("app.replica.time.monotonic", lambda: now[0])
+    writes = RecentWrites(window=5)
+    writes.add("goo", "exa")
+    assert "goo" in writes and "other" not in writes
+    now[0] = 103.0
+    writes.add("exa")
+    now[0] = 106.0
+    assert "goo" not in writes and "exa" in writes
+    writes.add("new")
+    assert list(writes._until) == ["exa", "new"]
+
+
+def test_jump_hash_only_moves_keys_to_new_shard():
+    codes = [generate_link_short_code() for _ in range(4000)]
+    before, after = ShardRouter(3), ShardRouter(4)
+    moved = [code for code in codes if before.shard_for(code) != after.shard_for(code)]
+    assert all(after.shard_for(code) == 3 for code in moved)
+    assert 0.15 < len(moved) / len(codes) < 0.35
+    counts = [len(group) for group in after.group(codes).values()]
+    assert len(counts) == 4 and min(counts) > 800
+    assert ShardRouter(1).shard_for("goo") == 0
+
+
+def test_shard_router_reads_previous_location_while_rebalancing():
+    router = ShardRouter(4, previous_count=3)
+    moved = next(code for code in (f"c{number}" for number in range(1000)) if router.shard_for(code) == 3)
+    assert router.locations(moved) == [3, router.shard_for(moved, 3)]
+    stayed = next(code for code in (f"c{number}" for number in range(1000)) if router.shard_for(code) != 3)
+    assert router.locations(stayed) == [router.shard_for(stayed)]
+    with pytest.raises(ValueError):
+        ShardRouter(0)
+
+
+def test_merge_sorted_interleaves_shard_streams():
+    async def stream(values):
+        for value in values:
+            yield value
+
+    async def merged():
+        return [value async for value in merge_sorted([stream([1, 4, 7]), stream([]), stream([2, 3, 9])], key=lambda value: value)]
+
+    assert asyncio.run(merged()) == [1, 2, 3, 4, 7, 9]
+
+
+def test_link_partitions_are_named_by_month():
+    assert next_month(datetime(2025, 12, 1)) == datetime(2026, 1, 1)
+    assert partition_name(datetime(2025, 3, 1)) == "links_2025_03"
+    assert partition_month("links_2025_03") == datetime(2025, 3, 1)
+    assert partition_month("links_never") is None
+    assert partition_month(partition_name(datetime(2999, 12, 1))) == datetime(2999, 12, 1)
+    with pytest.raises(ValueError):
+        partition_name(datetime(999, 5, 1))
+    assert before_partition_name(datetime(2025, 3, 1)) == "links_before_2025_03"
+    assert partition_bound("links_before_2025_03") == datetime(2025, 3, 1) and partition_month("links_before_2025_03") is None
+
+    # months past the retention are checked in the database every time, another worker may have dropped them
+    partitions = LinkPartitions(ahead_months=3, retention_days=30)
+    assert not partitions.retained(datetime(2025, 3, 1), datetime(2025, 5, 1))
+    assert partitions.retained(datetime(2025, 3, 1), datetime(2025, 4, 30))
+    # from the oldest retained month to the longest allowed expiry and three months more
+    partitions = LinkPartitions(ahead_months=3, retention_days=30, max_ttl_days=60)
+    assert partitions.window(datetime(2025, 5, 10)) == (datetime(2025, 4, 1), datetime(2025, 10, 1))
+
+
+def test_repository_interfaces_are_abstract():
+    with pytest.raises(TypeError):
+        LinkRepository()
+    with pytest.raises(TypeError):
+        UserRepository()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def embedded_links(request, tmp_path):
+    links = MemoryLinkRepository() if request.param == "memory" else SqliteStore(str(tmp_path / "links.sqlite3")).links
+    asyncio.run(links.prepare())
+    yield links
+    asyncio.run(links.close())
+
+
+def embedded_link(short_code, expires_at=None, digest=b"digest"):
+    return {"original_url": f"https://{short_code}.com/", "short_code": short_code, "created_at": datetime(2025, 1, 1), "expires_at": expires_at, "access_count": 0, "url_digest": digest}
+
+
+def test_embedded_link_repository_keeps_codes_unique_and_expires_links(embedded_links):
+    async def run():
+        inserted = await embedded_links.insert([embedded_link("old", datetime(2025, 2, 1)), embedded_link("new", datetime(2030, 1, 1)), embedded_link("keep")])
+        taken = await embedded_links.insert([embedded_link("old")])
+        with pytest.raises(ValueError):
+            await embedded_links.rename("keep", "new")
+        removed = []
+        return (
+            inserted, taken,
+            await embedded_links.find_duplicate(b"digest", None),
+            [[link.short_code for link in batch] async for batch in embedded_links.expired_links(datetime(2026, 1, 1))],
+            [short_code async for short_code, _ in embedded_links.upcoming_expiries(datetime(2026, 1, 1), datetime(2031, 1, 1))],
+            await embedded_links.purge_expired(datetime(2026, 1, 1), removed.extend), removed,
+            await embedded_links.get_redirect_target("old"),
+        )
+
+    inserted, taken, duplicate, expired, upcoming, purged, removed, target = asyncio.run(run())
+    assert inserted == {"old", "new", "keep"} and taken == set()
+    assert duplicate == "keep"
+    assert expired == [["old"]] and upcoming == ["new"]
+    assert purged == 1 and removed == ["old"] and target is None
+
+
+def test_embedded_link_repository_flushes_and_compacts_clicks(embedded_links):
+    buffer = ClickBuffer()
+
+    async def run():
+        await embedded_links.insert([embedded_link("goo")])
+        link = await embedded_links.get_redirect_target("goo")
+        for visitor in (1 << 60, 2 << 60, 2 << 60):
+            buffer.record(link.id, visitor)
+        await embedded_links.flush_clicks(buffer)
+        hourly = await embedded_links.read_stats("goo", "hour", datetime(2000, 1, 1), datetime(2100, 1, 1))
+        await embedded_links.compact_clicks(datetime(2100, 1, 1), datetime(2100, 1, 1))
+        daily = await embedded_links.read_stats("goo", "hour", datetime(2000, 1, 1), datetime(2100, 1, 1))
+        return hourly, daily
+
+    (link, hourly_buckets, hourly_sketches), (_, daily_buckets, daily_sketches) = asyncio.run(run())
+    assert link.access_count == 3 and HyperLogLog.from_bytes(link.visitors).count() == 2
+    assert list(hourly_buckets.values()) == [3] and list(hourly_buckets)[0].minute == 0
+    # compacted days show up at midnight in hourly series, like on postgres
+    assert list(daily_buckets.values()) == [3] and list(daily_buckets)[0].hour == 0
+    assert [HyperLogLog.from_bytes(sketch).count() for _, sketch in daily_sketches] == [2]
+    assert buffer.stats()["pending_links"] == 0